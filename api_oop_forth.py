@@ -1,8 +1,16 @@
 import abc
 from flask import Flask, request, jsonify
 import sqlite3
+import logging
 import matplotlib.pyplot as plt
 import seaborn as sns
+from smarthome_logging import setup_logging_from_env
+
+# 日志：原来直接 print 到控制台，现在和 api_oop_ten_jwt.py 一样走队列写 app.log（INFO 级别），控制台不再输出这些信息；
+# 需要换文件或级别时用 SMARTHOME_LOG_FILE、SMARTHOME_LOG_LEVEL
+setup_logging_from_env(filename='app.log', level=logging.INFO)
+db_logger = logging.getLogger('smarthome.forth.db')
+controller_logger = logging.getLogger('smarthome.forth.controller')
 
 #database
 
@@ -23,7 +31,7 @@ def init_db():
         conn.commit()
     
     except sqlite3.Error as e:
-        print(f"数据库初始化出错： {e}")
+        db_logger.error(f"数据库初始化出错： {e}")
     
     finally:
         conn.close()
@@ -61,7 +69,7 @@ def insert_or_replace_device(device_id, name, status, energy_usage, device_type,
                 ''',
                 (device_id, name, status, energy_usage, 'thermostat', temperature))
     except sqlite3.Error as e:
-        print(f"数据库插入或替换出错： {e}")
+        db_logger.error(f"数据库插入或替换出错： {e}")
     
     finally:
         if conn:
@@ -138,7 +146,7 @@ class Device(abc.ABC):
             conn.commit()
         
         except sqlite3.Error as e:
-            print(f"数据库更新出错： {e}")
+            db_logger.error(f"数据库更新出错： {e}")
             
         finally:
             if conn:
@@ -212,7 +220,7 @@ class DeviceController:
                 device.update_db()
         
         except sqlite3.Error as e:
-            print(f"数据库加载出错： {e}")
+            db_logger.error(f"数据库加载出错： {e}")
 
         finally:
             if conn:
@@ -230,7 +238,7 @@ class DeviceController:
         if device_id not in self.devices:
             self.devices[device_id] = device
         else:
-            print(f"Device {device_id} 已经存在")
+            controller_logger.warning(f"Device {device_id} 已经存在")
 
     def remove_device(self, device_id):
         if device_id in self.devices:
@@ -246,17 +254,17 @@ class DeviceController:
         if device:
             if command == 'on':
                 device.turn_on()
-                print(f"Executed {command} on {device.get_name()}")
+                controller_logger.info('Executed %s on %s', command, device.get_name())
                 return True
             elif command == 'off':
                 device.turn_off()
-                print(f"Executed {command} on {device.get_name()}")
+                controller_logger.info('Executed %s on %s', command, device.get_name())
                 return True
             else:
-                print(f"Invalid command: {command}")
+                controller_logger.warning(f"Invalid command: {command}")
                 return False
         else:
-            print(f"Device {device_id} not found")
+            controller_logger.warning(f"Device {device_id} not found")
             return False
 
 class SmartHomeHub:
@@ -270,7 +278,7 @@ class SmartHomeHub:
         return cls._instance
 
     def schedule_task(self, device_id, command, time):
-        print(f"Task scheduled: {command} {device_id} at {time}")
+        controller_logger.info(f"Task scheduled: {command} {device_id} at {time}")
 
     def display_status(self):
         return self.controller.list_devices()
@@ -358,7 +366,7 @@ def get_energy_usage_data():
         energy_usages = [row[1] for row in rows]
         return names, energy_usages
     except sqlite3.Error as e:
-        print(f"数据库查询出错： {e}")
+        db_logger.error(f"数据库查询出错： {e}")
     finally:
         if conn:
             conn.close()
@@ -1,74 +1,272 @@
 import abc
-from flask import Flask, request, jsonify
+import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import re
+import queue
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from itertools import count
+from functools import lru_cache
+from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
 from sqlite3 import Error
 import matplotlib.pyplot as plt
+import numpy as np
 import seaborn as sns
 import logging
+import os
+import threading
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 import jwt
-from flask import make_response
+from flask import make_response, g, has_request_context
+from smarthome_logging import setup_logging_from_env
+from smarthome_metrics import MetricsRegistry
+from smarthome_schema import (DEVICE_ORDER_COLUMNS, DEVICE_ROW_SQL, ENERGY_PERIODS, ENERGY_ROLLUP_TABLES, EXPORT_COLUMNS,
+                              MIGRATIONS, SCHEMA_VERSION, UPSERT_DEVICE_SQL, backfill_readings, build_device_query,
+                              device_row_to_dict, encode_export_chunks, explain_device_queries, get_schema_version,
+                              iter_export_rows, iter_import_records, migrate, rebuild_rollups, snapshot_rows,
+                              upsert_device_records)
+from smarthome_snapshot import SnapshotReader, write_snapshot
+
+# orjson 是可选依赖，没有安装时用标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# brotli 是可选依赖，没有安装时只支持 gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 配置日志：日志先进入队列，由后台线程写入 app.log，可以通过 SMARTHOME_LOG_* 环境变量调整
+setup_logging_from_env(filename='app.log', level=logging.ERROR)
+db_logger = logging.getLogger('smarthome.db')
+controller_logger = logging.getLogger('smarthome.controller')
+scheduler_logger = logging.getLogger('smarthome.scheduler')
+dispatcher_logger = logging.getLogger('smarthome.dispatcher')
+access_logger = logging.getLogger('smarthome.access')
+
+# 监控指标，/metrics 接口以 Prometheus 文本格式输出
+metrics = MetricsRegistry()
+http_requests_total = metrics.counter('smarthome_http_requests_total', '按接口和状态码统计的请求数',
+                                      ('endpoint', 'method', 'status'))
+http_request_seconds = metrics.histogram('smarthome_http_request_duration_seconds', '接口处理耗时', ('endpoint',))
+jwt_decode_seconds = metrics.histogram('smarthome_jwt_decode_seconds', 'JWT 校验耗时')
+db_connection_seconds = metrics.histogram('smarthome_db_connection_seconds', '每次数据库连接从打开到关闭的耗时')
+serialization_seconds = metrics.histogram('smarthome_json_serialization_seconds', '响应 JSON 序列化耗时')
+sql_statements_total = metrics.counter('smarthome_sql_statements_total', '执行的 SQL 语句数', ('endpoint',))
+sql_statement_seconds = metrics.histogram('smarthome_sql_statement_seconds', '单条 SQL 语句耗时')
+sql_queries_per_request = metrics.histogram('smarthome_sql_queries_per_request', '每个请求执行的 SQL 语句数',
+                                            ('endpoint',), buckets=(1, 2, 5, 10, 20, 50, 100, 500, 1000))
+sql_n_plus_one_total = metrics.counter('smarthome_sql_n_plus_one_total', '疑似 N+1 查询的次数', ('endpoint',))
+device_cache_total = metrics.counter('smarthome_device_cache_total', '设备序列化缓存命中情况', ('form', 'result'))
+compression_seconds = metrics.histogram('smarthome_compression_seconds', '响应压缩耗时', ('encoding',))
+compression_bytes_total = metrics.counter('smarthome_compression_bytes_total', '压缩前后的字节数', ('encoding', 'stage'))
+response_cache_total = metrics.counter('smarthome_response_cache_total', '设备列表响应缓存命中情况', ('result',))
+export_rows_total = metrics.counter('smarthome_export_rows_total', '导出的行数', ('kind', 'format'))
+import_rows_total = metrics.counter('smarthome_import_rows_total', '导入的行数', ('result',))
+anomaly_detection_seconds = metrics.histogram('smarthome_anomaly_detection_seconds', '能耗异常检测耗时')
+anomaly_devices = metrics.gauge('smarthome_anomaly_devices', '最近一次检测出的能耗异常设备数')
+admission_total = metrics.counter('smarthome_admission_total', '准入控制的结果', ('gate', 'result'))
+admission_wait_seconds = metrics.histogram('smarthome_admission_wait_seconds', '请求排队等待准入的时间', ('gate',))
+idempotency_total = metrics.counter('smarthome_idempotency_total', '带 Idempotency-Key 的请求', ('result',))
+rate_limited_total = metrics.counter('smarthome_rate_limited_total', '被限流拒绝的请求数', ('route_class', 'scope'))
+
+# 初始化数据库，多 worker 部署时可以用环境变量指定同一个数据库文件
+db_name = os.environ.get('SMARTHOME_DB', 'xjy_smarthome.db')
+
+# SQL 追踪配置：统计每个请求的查询次数，记录慢查询的执行计划，发现重复的语句形状时提示 N+1
+SQL_TRACE = os.environ.get('SMARTHOME_SQL_TRACE', '0') == '1'
+SQL_SLOW_SECONDS = float(os.environ.get('SMARTHOME_SQL_SLOW_MS', 50)) / 1000
+SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SMARTHOME_SQL_N_PLUS_ONE', 5))
+# JSON 序列化后端：auto（有 orjson 就用）、orjson、stdlib
+JSON_BACKEND = os.environ.get('SMARTHOME_JSON', 'auto')
+# 响应体达到这个大小才压缩；gzip 级别 1-9、brotli 质量 0-11，越高压缩率越高、CPU 开销越大
+COMPRESS_MIN_BYTES = int(os.environ.get('SMARTHOME_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('SMARTHOME_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('SMARTHOME_BROTLI_QUALITY', 5))
+# 删除设备时默认只做软删除（打上 deleted_at），由后台任务按批次真正删除
+SOFT_DELETE = os.environ.get('SMARTHOME_SOFT_DELETE', '0') == '1'
+PURGE_INTERVAL = float(os.environ.get('SMARTHOME_PURGE_INTERVAL', 60))
+PURGE_BATCH_SIZE = int(os.environ.get('SMARTHOME_PURGE_BATCH', 500))
+PURGE_GRACE_SECONDS = float(os.environ.get('SMARTHOME_PURGE_GRACE', 0))
+# 快照间隔（秒）和保留的快照个数，启动恢复时只需要重放最近一次快照之后的命令日志
+SNAPSHOT_INTERVAL = float(os.environ.get('SMARTHOME_SNAPSHOT_INTERVAL', 300))
+SNAPSHOT_KEEP = int(os.environ.get('SMARTHOME_SNAPSHOT_KEEP', 3))
+# 二进制快照文件，设置后启动时优先用 mmap 读取它，快照写入线程也会同时更新这个文件
+SNAPSHOT_FILE = os.environ.get('SMARTHOME_SNAPSHOT_FILE')
+# 读快照的发布间隔（秒）：把这段时间内的写入合并成一次发布，写入不用每次都去抢发布锁，设备列表等读接口最多落后这么久；
+# 0 表示每次写入后立即发布（写入之间会在发布锁上串行）
+FLEET_PUBLISH_INTERVAL = float(os.environ.get('SMARTHOME_FLEET_PUBLISH_INTERVAL', 0.1))
+# 变更日志只保留最近这么多条，由后台任务按间隔（秒）清理，落后更多的进程会全量重新加载
+CHANGE_LOG_KEEP = int(os.environ.get('SMARTHOME_CHANGE_LOG_KEEP', 100000))
+CHANGE_LOG_TRIM_INTERVAL = float(os.environ.get('SMARTHOME_CHANGE_LOG_TRIM_INTERVAL', 600))
+# 定时任务认领后处于 running，超过这么多秒还没有结果，认为执行它的进程已经退出，启动时重新放回 pending
+TASK_RUNNING_TIMEOUT = float(os.environ.get('SMARTHOME_TASK_RUNNING_TIMEOUT', 300))
+# 限流：每类接口“每秒补充的令牌数/桶容量”，按 JWT 用户和客户端 IP 各算一个令牌桶，默认 off 表示关闭
+# read 是 GET 请求，command 是其它写请求，login 是登录（按用户名和 IP），也可以按 endpoint 名单独配置，如 export_data=1/2
+# 对外部署时建议打开，例如 SMARTHOME_RATE_LIMITS=read=50/100,command=10/20,login=0.5/5
+RATE_LIMITS = os.environ.get('SMARTHOME_RATE_LIMITS', 'off')
+# 每类接口最多跟踪的用户/IP 数，超过时淘汰最久没有请求的；空闲这么多秒的桶也会被淘汰
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('SMARTHOME_RATE_LIMIT_MAX_KEYS', 10000))
+RATE_LIMIT_IDLE_SECONDS = float(os.environ.get('SMARTHOME_RATE_LIMIT_IDLE', 600))
+# 幂等键：带 Idempotency-Key 的命令和添加设备请求，第一次的响应保存 IDEMPOTENCY_TTL 秒，重试时直接返回
+# 内存里最多保存 IDEMPOTENCY_MAX_KEYS 个；IDEMPOTENCY_PERSIST 打开时同时存进数据库，重启后和多个 worker 之间也能去重
+IDEMPOTENCY_TTL = float(os.environ.get('SMARTHOME_IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('SMARTHOME_IDEMPOTENCY_MAX_KEYS', 10000))
+IDEMPOTENCY_PERSIST = os.environ.get('SMARTHOME_IDEMPOTENCY_PERSIST', '0') == '1'
+# 处理中的记录超过这么多秒还没有结果，认为处理它的进程已经退出，允许重新处理
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.environ.get('SMARTHOME_IDEMPOTENCY_PENDING_TIMEOUT', 60))
+# 准入控制：写请求（命令、添加和删除设备）同时最多执行 WRITE_CONCURRENCY 个，最多再排队 WRITE_QUEUE 个，
+# 排队超过 WRITE_QUEUE_TIMEOUT 秒或队列已满时直接返回 503；读请求有自己独立的容量，不会被写请求挤占
+WRITE_CONCURRENCY = int(os.environ.get('SMARTHOME_WRITE_CONCURRENCY', 4))
+WRITE_QUEUE = int(os.environ.get('SMARTHOME_WRITE_QUEUE', 32))
+WRITE_QUEUE_TIMEOUT = float(os.environ.get('SMARTHOME_WRITE_QUEUE_TIMEOUT', 2))
+# 异步命令队列最多排队的命令数，满了以后异步提交同样返回 503
+COMMAND_QUEUE_SIZE = int(os.environ.get('SMARTHOME_COMMAND_QUEUE_SIZE', 1000))
+READ_CONCURRENCY = int(os.environ.get('SMARTHOME_READ_CONCURRENCY', 16))
+READ_QUEUE = int(os.environ.get('SMARTHOME_READ_QUEUE', 64))
+READ_QUEUE_TIMEOUT = float(os.environ.get('SMARTHOME_READ_QUEUE_TIMEOUT', 1))
+# 能耗异常检测：最近一个窗口（小时数）的能耗和之前若干个窗口的基线、以及同类型设备比较，分数超过阈值就报异常
+ANOMALY_INTERVAL = float(os.environ.get('SMARTHOME_ANOMALY_INTERVAL', 60))
+ANOMALY_WINDOW_HOURS = int(os.environ.get('SMARTHOME_ANOMALY_WINDOW_HOURS', 24))
+ANOMALY_BASELINE_WINDOWS = int(os.environ.get('SMARTHOME_ANOMALY_BASELINE_WINDOWS', 7))
+ANOMALY_THRESHOLD = float(os.environ.get('SMARTHOME_ANOMALY_THRESHOLD', 3.5))
+sql_logger = logging.getLogger('smarthome.sql')
+# 打开追踪时慢查询和 N+1 提示默认要输出，除非已经通过 SMARTHOME_LOG_MODULES 单独配置
+if SQL_TRACE and sql_logger.level == logging.NOTSET:
+    sql_logger.setLevel(logging.WARNING)
+
+
+# 一个请求内的 SQL 统计
+class SqlTrace:
+    def __init__(self):
+        self.queries = 0
+        self.connections = 0
+        self.seconds = 0.0
+        self.shapes = {}
+        self.n_plus_one = []
+
+
+# 把语句归一成“形状”：去掉多余空白，字面量和 IN 列表替换成占位符
+def sql_shape(sql):
+    shape = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", '?', sql)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?...)', shape)
+    return ' '.join(shape.split())
+
+
+def current_sql_trace():
+    if has_request_context():
+        trace = g.get('sql_trace')
+        if trace is None:
+            trace = g.sql_trace = SqlTrace()
+        return trace
+    return None
+
+
+def record_statement(conn, sql, parameters, elapsed):
+    sql_statement_seconds.observe(elapsed)
+    endpoint = request.endpoint if has_request_context() else 'background'
+    sql_statements_total.inc((endpoint or 'unknown',))
+    if elapsed >= SQL_SLOW_SECONDS:
+        plan = ''
+        try:
+            # 用普通游标执行 EXPLAIN，避免被再次追踪
+            explain = sqlite3.Cursor(conn)
+            explain.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+            plan = '; '.join(row[-1] for row in explain.fetchall())
+        except sqlite3.Error:
+            pass
+        sql_logger.warning(f"慢查询 {elapsed * 1000:.1f}ms: {' '.join(sql.split())} | 执行计划: {plan}")
+    trace = current_sql_trace()
+    if trace is None:
+        return
+    trace.queries += 1
+    trace.seconds += elapsed
+    shape = sql_shape(sql)
+    count = trace.shapes.get(shape, 0) + 1
+    trace.shapes[shape] = count
+    if count == SQL_N_PLUS_ONE_THRESHOLD:
+        trace.n_plus_one.append(shape)
+        sql_n_plus_one_total.inc((endpoint or 'unknown',))
+        sql_logger.warning(f"疑似 N+1 查询（同一请求内已执行 {count} 次）: {shape}")
+
+
+# 会记录耗时的游标
+class TracingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_statement(self.connection, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_statement(self.connection, sql, (), time.perf_counter() - start)
 
-# 配置日志
-logging.basicConfig(level=logging.ERROR, filename='app.log', format='%(asctime)s - %(levelname)s - %(message)s')
 
-# 初始化数据库
-db_name = 'xjy_smarthome.db'
+# conn.cursor() 返回 TracingCursor；CPython 的 conn.execute()/executemany() 不经过 cursor()，
+# 所以这里也改成通过 TracingCursor 执行，PRAGMA 等直接在连接上执行的语句同样会被记录
+class TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
 
-# 数据库连接上下文管理器
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# 数据库连接上下文管理器，trace 为 None 时按 SQL_TRACE 配置决定是否追踪
 @contextmanager
-def get_db_connection():
+def get_db_connection(trace=None):
     conn = None
+    start = time.perf_counter()
+    trace = SQL_TRACE if trace is None else trace
     try:
-        conn = sqlite3.connect(db_name)
+        if trace:
+            conn = sqlite3.connect(db_name, factory=TracingConnection)
+            request_trace = current_sql_trace()
+            if request_trace is not None:
+                request_trace.connections += 1
+        else:
+            conn = sqlite3.connect(db_name)
+        # 外键约束默认是关闭的，每个连接都要单独打开，ON DELETE CASCADE 才会生效
+        conn.execute('PRAGMA foreign_keys = ON')
         yield conn
     except Error as e:
-        logging.error(f"数据库连接出错： {e}")
+        db_logger.error(f"数据库连接出错： {e}")
     finally:
         if conn:
             conn.close()
+        db_connection_seconds.observe(time.perf_counter() - start)
+
+
+# 把数据库迁移到 target 版本（默认最新），返回 (迁移前版本, 迁移后版本)；迁移本身在 smarthome_schema 里
+def migrate_db(target=None):
+    return migrate(db_name, target)
 
 
 def init_db():
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            # 创建主设备表
-            c.execute('''CREATE TABLE IF NOT EXISTS devices(
-                   device_id TEXT PRIMARY KEY, -- 设备id
-                   name TEXT,  -- 设备名
-                   status TEXT,  -- 设备状态
-                   energy_usage REAL,  -- 设备能量消耗
-                   device_type TEXT -- 设备类型
-                )''')
-            # 创建灯光属性表
-            c.execute('''CREATE TABLE IF NOT EXISTS light_attributes(
-                   device_id TEXT PRIMARY KEY,
-                   brightness INTEGER,
-                   FOREIGN KEY (device_id) REFERENCES devices(device_id)
-                )''')
-            # 创建恒温器属性表
-            c.execute('''CREATE TABLE IF NOT EXISTS thermostat_attributes(
-                   device_id TEXT PRIMARY KEY,
-                   temperature INTEGER,
-                   FOREIGN KEY (device_id) REFERENCES devices(device_id)
-                )''')
-            # 创建摄像头属性表
-            c.execute('''CREATE TABLE IF NOT EXISTS camera_attributes(
-                   device_id TEXT PRIMARY KEY,
-                   resolution TEXT,
-                   FOREIGN KEY (device_id) REFERENCES devices(device_id)
-                )''')
-            # 创建用户表
-            c.execute('''CREATE TABLE IF NOT EXISTS users(
-                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                   username TEXT UNIQUE,
-                   password TEXT
-                )''')
-            conn.commit()
+        migrate_db()
     except sqlite3.Error as e:
-        logging.error(f"数据库初始化出错： {e}")
+        db_logger.error(f"数据库初始化出错： {e}")
 
 
 # 备份数据库函数
@@ -83,46 +281,50 @@ def backup_database(backup_file=None):
         src_conn.close()
         dest_conn.close()
     except Exception as e:
-        logging.error(f"数据库备份出错： {e}")
+        db_logger.error(f"数据库备份出错： {e}")
+
 
+# 追加一条命令日志，必须和对应的设备写入在同一个事务里
+def log_command(c, op, device_id, payload=None, created_at=None):
+    c.execute('INSERT INTO command_log (op, device_id, payload, created_at) VALUES (?,?,?,?)',
+              (op, device_id, None if payload is None else json.dumps(payload, ensure_ascii=False),
+               time.time() if created_at is None else created_at))
 
-# 插入或替换设备信息
-def insert_or_replace_device(device_id, name, status, energy_usage, device_type, **kwargs):
+
+# 记录一次能耗读数，汇总表由触发器更新
+def record_energy(c, device_id, device_type, kwh, recorded_at=None, source='command'):
+    c.execute('INSERT INTO energy_readings (device_id, device_type, recorded_at, kwh, source) VALUES (?,?,?,?,?)',
+              (device_id, device_type, time.time() if recorded_at is None else recorded_at, kwh, source))
+
+
+# 插入或替换设备信息，op 是记到命令日志里的操作（新增设备或修改属性）
+def insert_or_replace_device(device_id, name, status, energy_usage, device_type, op='add', **kwargs):
+    row = (device_id, name, status, energy_usage, device_type,
+           kwargs.get('brightness') if device_type == 'light' else None,
+           kwargs.get('temperature') if device_type == 'thermostat' else None,
+           kwargs.get('resolution') if device_type == 'camera' else None)
     with get_db_connection() as conn:
         c = conn.cursor()
-        # 插入或替换主设备表信息
-        c.execute('''
-            INSERT OR REPLACE INTO devices (device_id, name, status, energy_usage, device_type)
-            VALUES (?,?,?,?,?)
-        ''', (device_id, name, status, energy_usage, device_type))
-        if device_type == 'light':
-            brightness = kwargs.get('brightness')
-            c.execute('''
-                INSERT OR REPLACE INTO light_attributes (device_id, brightness)
-                VALUES (?,?)
-            ''', (device_id, brightness))
-        elif device_type == 'thermostat':
-            temperature = kwargs.get('temperature')
-            c.execute('''
-                INSERT OR REPLACE INTO thermostat_attributes (device_id, temperature)
-                VALUES (?,?)
-            ''', (device_id, temperature))
-        elif device_type == 'camera':
-            resolution = kwargs.get('resolution')
-            c.execute('''
-                INSERT OR REPLACE INTO camera_attributes (device_id, resolution)
-                VALUES (?,?)
-            ''', (device_id, resolution))
+        c.execute(UPSERT_DEVICE_SQL, row)
+        log_command(c, op, device_id, row)
         conn.commit()
 
 
 # 设备基类
 class Device(abc.ABC):
+    # 设备类型名，由子类设置
+    device_type = None
+
     def __init__(self, device_id, name, energy_usage=0):
         self.__device_id = device_id
         self.__name = name
         self.__status = 'off'
-        self.__energy_usage = energy_usage
+        # 数据库里是 REAL，内存里也统一成 float，缓存的列表和直接读库的结果才能逐字节一致（0 和 0.0）
+        self.__energy_usage = float(energy_usage)
+        # 序列化缓存 (版本, 字典, JSON bytes)：状态或属性变化时版本加一，旧缓存自动失效
+        # 先修改字段再加版本号，并发读取时最多把旧数据存成旧版本的缓存，不会被当成新数据使用
+        self._version = 0
+        self._cache = None
 
     # 获取方法
     def get_id(self):
@@ -137,18 +339,42 @@ class Device(abc.ABC):
     def get_energy_usage(self):
         return self.__energy_usage
 
-    # 控制方法
+    # 控制方法，返回状态是否真的发生了变化
     def turn_on(self):
         if self.__status != 'on':
             self.__status = 'on'
             self.__energy_usage += 0.1
-            self.update_db()
+            self._touch()
+            self.update_db(energy_delta=0.1)
+            return True
+        return False
 
     def turn_off(self):
         if self.__status != 'off':
             self.__status = 'off'
             self.__energy_usage += 0.02
-            self.update_db()
+            self._touch()
+            self.update_db(energy_delta=0.02)
+            return True
+        return False
+
+    # 用数据库里的状态覆盖内存状态，不写回数据库
+    def apply_state(self, status, energy_usage):
+        energy_usage = float(energy_usage)
+        if status != self.__status or energy_usage != self.__energy_usage:
+            self.__status = status
+            self.__energy_usage = energy_usage
+            self._touch()
+
+    # 记录电表上报等额外的能耗，不改变开关状态
+    def add_energy(self, kwh, recorded_at=None):
+        self.__energy_usage += kwh
+        self._touch()
+        self.update_db(energy_delta=kwh, source='reading', recorded_at=recorded_at)
+
+    # 状态或属性变化后调用，调用方需要持有这个设备的分段锁
+    def _touch(self):
+        self._version += 1
 
     def __str__(self):
         return (
@@ -165,7 +391,58 @@ class Device(abc.ABC):
             'energy_usage': self.get_energy_usage()
         }
 
-    def update_db(self):
+    # 设备类型特有的属性，由子类提供
+    def get_attributes(self):
+        return {}
+
+    # 修改设备类型特有的属性，返回是否有变化，参数不合法时抛出 ValueError
+    def update_attributes(self, attributes):
+        raise ValueError('该设备没有可修改的属性')
+
+    # 基本信息加属性的完整字典，带缓存，调用方不能修改返回的字典
+    def to_dict(self):
+        cache = self._cache
+        if cache is not None and cache[0] == self._version:
+            return cache[1]
+        version = self._version
+        device_dict = self.change_to_dict()
+        device_dict.update(self.get_attributes())
+        self._cache = (version, device_dict, None)
+        return device_dict
+
+    # 缓存里有当前版本的字典/JSON 就返回，否则返回 None
+    def cached_dict(self):
+        cache = self._cache
+        if cache is not None and cache[0] == self._version:
+            return cache[1]
+        return None
+
+    def cached_json(self):
+        cache = self._cache
+        if cache is not None and cache[0] == self._version:
+            return cache[2]
+        return None
+
+    def to_json(self):
+        version = self._version
+        device_dict = self.to_dict()
+        cache = self._cache
+        if cache is not None and cache[0] == version and cache[2] is not None:
+            return cache[2]
+        fragment = encode_json(device_dict)
+        self._cache = (version, device_dict, fragment)
+        return fragment
+
+    # 当前状态的只读视图，调用方需要持有这个设备的分段锁；缓存里已有的字典和 JSON 直接带上，没有的等读取时再生成
+    def view(self):
+        cache = self._cache
+        if cache is None or cache[0] != self._version:
+            cache = (None, None, None)
+        return DeviceView(self.get_id(), self.get_name(), self.device_type, self.get_status(),
+                          self.get_energy_usage(), self.get_attributes(), cache[1], cache[2])
+
+    # 写回状态和能耗，命令日志和能耗读数在同一个事务里写入；source 为 command 时是开关，reading 时是上报的读数
+    def update_db(self, energy_delta=0.0, source='command', recorded_at=None):
         try:
             with get_db_connection() as conn:
                 c = conn.cursor()
@@ -175,17 +452,41 @@ class Device(abc.ABC):
                     energy_usage = ?
                     WHERE device_id = ?
                 ''', (self.__status, self.__energy_usage, self.__device_id))
+                if c.rowcount == 1:
+                    # 命令产生的读数和命令日志用同一个时间，补齐历史读数时靠它判断哪些命令已经有读数
+                    now = time.time()
+                    log_command(c, source, self.__device_id, [self.__status, self.__energy_usage], now)
+                    if energy_delta:
+                        record_energy(c, self.__device_id, self.device_type, energy_delta,
+                                      now if recorded_at is None else recorded_at, source)
                 conn.commit()
         except sqlite3.Error as e:
-            logging.error(f"数据库更新出错： {e}")
+            db_logger.error(f"数据库更新出错： {e}")
 
 
 # 子类
 class Light(Device):
-    def __init__(self, device_id, name, brightness=100):
+    device_type = 'light'
+
+    def __init__(self, device_id, name, brightness=100, save=True):
         super().__init__(device_id, name)
         self.__brightness = brightness
-        self.save_db('light', brightness=brightness)
+        if save:
+            self.save_db('light', brightness=brightness)
+
+    def get_attributes(self):
+        return {'brightness': self.__brightness}
+
+    def update_attributes(self, attributes):
+        brightness = attributes.get('brightness', self.__brightness)
+        if isinstance(brightness, bool) or not isinstance(brightness, int) or not 0 <= brightness <= 100:
+            raise ValueError('brightness 必须是 0 到 100 的整数')
+        if brightness == self.__brightness:
+            return False
+        self.__brightness = brightness
+        self._touch()
+        self.save_db('light', op='attributes', brightness=brightness)
+        return True
 
     def save_db(self, device_type, **kwargs):
         insert_or_replace_device(self.get_id(), self.get_name(), self.get_status(), self.get_energy_usage(), device_type,
@@ -193,10 +494,27 @@ class Light(Device):
 
 
 class Thermostat(Device):
-    def __init__(self, device_id, name, temperature=22):
+    device_type = 'thermostat'
+
+    def __init__(self, device_id, name, temperature=22, save=True):
         super().__init__(device_id, name)
         self.__temperature = temperature
-        self.save_db('thermostat', temperature=temperature)
+        if save:
+            self.save_db('thermostat', temperature=temperature)
+
+    def get_attributes(self):
+        return {'temperature': self.__temperature}
+
+    def update_attributes(self, attributes):
+        temperature = attributes.get('temperature', self.__temperature)
+        if isinstance(temperature, bool) or not isinstance(temperature, (int, float)):
+            raise ValueError('temperature 必须是数字')
+        if temperature == self.__temperature:
+            return False
+        self.__temperature = temperature
+        self._touch()
+        self.save_db('thermostat', op='attributes', temperature=temperature)
+        return True
 
     def save_db(self, device_type, **kwargs):
         insert_or_replace_device(self.get_id(), self.get_name(), self.get_status(), self.get_energy_usage(), device_type,
@@ -204,166 +522,2303 @@ class Thermostat(Device):
 
 
 class Camera(Device):
-    def __init__(self, device_id, name, resolution='1080p'):
+    device_type = 'camera'
+
+    def __init__(self, device_id, name, resolution='1080p', save=True):
         super().__init__(device_id, name)
         self.__resolution = resolution
-        self.save_db('camera', resolution=resolution)
+        if save:
+            self.save_db('camera', resolution=resolution)
+
+    def get_attributes(self):
+        return {'resolution': self.__resolution}
+
+    def update_attributes(self, attributes):
+        resolution = attributes.get('resolution', self.__resolution)
+        if not isinstance(resolution, str) or not resolution:
+            raise ValueError('resolution 必须是非空字符串')
+        if resolution == self.__resolution:
+            return False
+        self.__resolution = resolution
+        self._touch()
+        self.save_db('camera', op='attributes', resolution=resolution)
+        return True
 
     def save_db(self, device_type, **kwargs):
         insert_or_replace_device(self.get_id(), self.get_name(), self.get_status(), self.get_energy_usage(), device_type,
                                  **kwargs)
 
 
+# 设备类型与设备类的对应关系
+devices_classes = {
+    'light': Light,
+    'thermostat': Thermostat,
+    'camera': Camera
+}
+
+# 解析 GET /devices 的筛选和排序参数，参数不合法时抛出 ValueError
+def parse_device_filters(args):
+    filters = {}
+    if args.get('type'):
+        if args['type'] not in devices_classes:
+            raise ValueError(f"不支持的设备类型{args['type']}")
+        filters['type'] = args['type']
+    if args.get('status'):
+        if args['status'] not in ('on', 'off'):
+            raise ValueError(f"不支持的设备状态{args['status']}")
+        filters['status'] = args['status']
+    for key in ('min_energy', 'max_energy'):
+        if args.get(key) not in (None, ''):
+            filters[key] = float(args[key])
+    if args.get('order_by'):
+        if args['order_by'] not in DEVICE_ORDER_COLUMNS:
+            raise ValueError(f"不支持的排序字段{args['order_by']}")
+        filters['order_by'] = args['order_by']
+        filters['desc'] = args.get('order', 'asc').lower() == 'desc'
+    if args.get('limit') not in (None, ''):
+        filters['limit'] = int(args['limit'])
+        if filters['limit'] < 0:
+            raise ValueError('limit 不能小于 0')
+    return filters
+
+
+# 把分页的行编码成 CSV 或 NDJSON 文本块，结束时记录行数和速度，传入 stats 字典时也写到里面
+# 分页和编码在 smarthome_schema 里，命令行工具直接用 sqlite 连接调用同样的函数
+def iter_export_chunks(kind, fmt, batch_size=1000, stats=None):
+    stats = {} if stats is None else stats
+    with get_db_connection() as conn:
+        yield from encode_export_chunks(kind, fmt, iter_export_rows(conn, kind, batch_size), stats, encode_json)
+    total, elapsed = stats.get('rows', 0), stats.get('seconds', 0)
+    export_rows_total.inc((kind, fmt), total)
+    db_logger.info("导出 %s %d 行，%.0f 行/秒", kind, total, total / elapsed if elapsed > 0 else 0)
+
+
+# 流式导入设备，每 chunk_size 行一个事务；返回值的含义见 smarthome_schema.upsert_device_records
+def import_device_records(records, chunk_size=1000, max_errors=100):
+    result = None
+    with get_db_connection() as conn:
+        result = upsert_device_records(conn, records, chunk_size, max_errors)
+    if result is None:
+        raise sqlite3.Error('导入写入数据库失败')
+    import_rows_total.inc(('imported',), result['imported'])
+    import_rows_total.inc(('rejected',), result['rejected'])
+    return result
+
+
+# 把 [start, end) 拆成尽量粗的几段：整天用按天汇总，剩下的整点用按小时汇总，首尾不满一小时的部分读原始读数
+def plan_energy_range(start, end):
+    def split(lo, hi, seconds):
+        inner_lo = -(-lo // seconds) * seconds
+        inner_hi = hi // seconds * seconds
+        if inner_lo >= inner_hi:
+            return None
+        return inner_lo, inner_hi
+
+    def hour_level(lo, hi):
+        inner = split(lo, hi, ENERGY_PERIODS['hour'])
+        if inner is None:
+            return [('raw', lo, hi)]
+        return [('raw', lo, inner[0]), ('hour', inner[0], inner[1]), ('raw', inner[1], hi)]
+
+    inner = split(start, end, ENERGY_PERIODS['day'])
+    if inner is None:
+        segments = hour_level(start, end)
+    else:
+        segments = hour_level(start, inner[0]) + [('day', inner[0], inner[1])] + hour_level(inner[1], end)
+    return [(source, lo, hi) for source, lo, hi in segments if lo < hi]
+
+
+# 时间范围内每个设备（scope=device）或每种类型（scope=type）的总能耗，key 可以只查一个设备或类型
+def energy_totals(scope, start, end, key=None):
+    table, key_column = ENERGY_ROLLUP_TABLES[scope]
+    segments = plan_energy_range(start, end)
+    totals = {}
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        for source, lo, hi in segments:
+            if source == 'raw':
+                # 原始读数里没有类型的是 NULL，和汇总表一样按 '' 算，两边的结果才能合到同一个键上
+                column = f"COALESCE({key_column}, '')"
+                sql = f'SELECT {column}, SUM(kwh) FROM energy_readings WHERE recorded_at >= ? AND recorded_at < ?'
+                params = [lo, hi]
+            else:
+                column = key_column
+                sql = f'SELECT {column}, SUM(kwh) FROM {table} WHERE period = ? AND bucket >= ? AND bucket < ?'
+                params = [source, lo, hi]
+            if key is not None:
+                sql += f' AND {column} = ?'
+                params.append(key)
+            c.execute(sql + f' GROUP BY {column}', params)
+            for row_key, kwh in c.fetchall():
+                totals[row_key] = totals.get(row_key, 0.0) + kwh
+    return totals, segments
+
+
+# 按小时或按天的能耗序列，直接读对应的汇总表
+def energy_series(scope, period, start, end, key=None):
+    table, key_column = ENERGY_ROLLUP_TABLES[scope]
+    seconds = ENERGY_PERIODS[period]
+    sql = f'SELECT bucket, {key_column}, kwh, readings FROM {table} WHERE period = ? AND bucket >= ? AND bucket < ?'
+    params = [period, start // seconds * seconds, end]
+    if key is not None:
+        sql += f' AND {key_column} = ?'
+        params.append(key)
+    series = []
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql + f' ORDER BY bucket, {key_column}', params)
+        series = [{'bucket': datetime.utcfromtimestamp(bucket).isoformat() + 'Z', key_column: row_key,
+                   'kwh': kwh, 'readings': readings} for bucket, row_key, kwh, readings in c.fetchall()]
+    return series
+
+
+# 用 energy_readings 重新计算全部汇总表，返回是否成功
+def rebuild_energy_rollups():
+    committed = False
+    with get_db_connection() as conn:
+        rebuild_rollups(conn)
+        committed = True
+    return committed
+
+
+# 从命令日志补齐 energy_readings 出现之前的能耗，返回补上的读数条数，可以重复执行
+def backfill_energy_readings(batch_size=1000):
+    inserted = 0
+    with get_db_connection() as conn:
+        inserted = backfill_readings(conn, batch_size)
+    return inserted
+
+
+# 读出所有设备最近 windows 个窗口（每个 window_hours 小时，最后一个窗口包括当前这个不完整的小时）的能耗
+# 窗口合计在 SQL 里算好，返回设备 id、类型和 设备数 x 窗口数 的矩阵
+def load_energy_windows(end, window_hours, windows):
+    hour = ENERGY_PERIODS['hour']
+    last_bucket = int(end) // hour * hour
+    first_bucket = last_bucket - (window_hours * windows - 1) * hour
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT device_id, device_type FROM devices WHERE deleted_at IS NULL ORDER BY device_id')
+        devices = c.fetchall()
+        c.execute('''
+            SELECT device_id, (bucket - ?) / ?, SUM(kwh) FROM energy_rollup_device
+            WHERE period = 'hour' AND bucket >= ? AND bucket <= ?
+            GROUP BY device_id, (bucket - ?) / ?
+        ''', (first_bucket, window_hours * hour, first_bucket, last_bucket, first_bucket, window_hours * hour))
+        totals = c.fetchall()
+    device_ids = np.array([device_id for device_id, _ in devices], dtype=object)
+    device_types = np.array([device_type or '' for _, device_type in devices], dtype=object)
+    matrix = np.zeros((len(devices), windows))
+    if totals:
+        index = {device_id: i for i, (device_id, _) in enumerate(devices)}
+        rows = np.fromiter((index.get(device_id, -1) for device_id, _, _ in totals), dtype=np.int64, count=len(totals))
+        columns = np.fromiter((column for _, column, _ in totals), dtype=np.int64, count=len(totals))
+        kwh = np.fromiter((value for _, _, value in totals), dtype=np.float64, count=len(totals))
+        # 已经删除的设备还留着汇总数据，跳过
+        known = rows >= 0
+        matrix[rows[known], columns[known]] = kwh[known]
+    return device_ids, device_types, matrix
+
+
+# 按组求中位数：先按 (组, 值) 排序，每组的中位数在组内中间的一两个位置
+def group_medians(values, groups, group_count):
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    sizes = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    present = sizes > 0
+    medians = np.zeros(group_count)
+    lo = starts[present] + (sizes[present] - 1) // 2
+    hi = starts[present] + sizes[present] // 2
+    medians[present] = (sorted_values[lo] + sorted_values[hi]) / 2
+    return medians
+
+
+# 一次向量化计算所有设备的两种分数，totals 是 设备数 x 窗口数 的能耗，最后一列是最近的窗口：
+#   基线分数：最近窗口的能耗相对这个设备之前各个窗口的 z 分数，标准差至少取基线的 ANOMALY_MIN_SPREAD 倍，
+#     避免历史窗口很少、波动很小时一点正常波动就报异常
+#   同类分数：最近窗口的能耗相对同类型设备的稳健 z 分数（中位数和 MAD），MAD 为 0 时退回平均绝对偏差
+ANOMALY_MIN_SPREAD = 0.1
+
+
+def score_energy_anomalies(totals, device_types):
+    device_count = totals.shape[0]
+    recent = totals[:, -1]
+    history = totals[:, :-1]
+    if history.shape[1] >= 2:
+        baseline = history.mean(axis=1)
+        spread = np.maximum(history.std(axis=1), ANOMALY_MIN_SPREAD * baseline)
+    else:
+        baseline = recent.copy()
+        spread = np.zeros(device_count)
+    baseline_score = np.divide(recent - baseline, spread, out=np.zeros(device_count), where=spread > 0)
+
+    type_names, groups = np.unique(device_types, return_inverse=True)
+    medians = group_medians(recent, groups, len(type_names))
+    deviation = np.abs(recent - medians[groups])
+    mad = group_medians(deviation, groups, len(type_names))
+    mean_deviation = np.bincount(groups, weights=deviation, minlength=len(type_names)) / np.maximum(
+        np.bincount(groups, minlength=len(type_names)), 1)
+    scale = np.where(mad > 0, 1.4826 * mad, 1.2533 * mean_deviation)[groups]
+    peer_score = np.divide(recent - medians[groups], scale, out=np.zeros(device_count), where=scale > 0)
+    return {
+        'recent': recent,
+        'baseline': baseline,
+        'baseline_score': baseline_score,
+        'peer_median': medians[groups],
+        'peer_score': peer_score,
+    }
+
+
+# 检测能耗异常：最近 window_hours 小时的能耗和之前 baseline_windows 个同样长度的窗口、以及同类型设备比较
+def detect_energy_anomalies(end=None, window_hours=ANOMALY_WINDOW_HOURS, baseline_windows=ANOMALY_BASELINE_WINDOWS,
+                            threshold=ANOMALY_THRESHOLD):
+    start_time = time.perf_counter()
+    end = time.time() if end is None else end
+    device_ids, device_types, totals = load_energy_windows(end, window_hours, baseline_windows + 1)
+    anomalies = []
+    if len(device_ids):
+        scores = score_energy_anomalies(totals, device_types)
+        baseline_flag = np.abs(scores['baseline_score']) >= threshold
+        peer_flag = np.abs(scores['peer_score']) >= threshold
+        flagged = np.flatnonzero(baseline_flag | peer_flag)
+        strength = np.maximum(np.abs(scores['baseline_score']), np.abs(scores['peer_score']))
+        for i in flagged[np.argsort(-strength[flagged], kind='stable')]:
+            anomalies.append({
+                'device_id': device_ids[i],
+                'device_type': device_types[i] or None,
+                'recent_kwh': round(float(scores['recent'][i]), 6),
+                'baseline_kwh': round(float(scores['baseline'][i]), 6),
+                'peer_median_kwh': round(float(scores['peer_median'][i]), 6),
+                'baseline_score': round(float(scores['baseline_score'][i]), 3),
+                'peer_score': round(float(scores['peer_score'][i]), 3),
+                'reasons': [reason for reason, flag in (('baseline', baseline_flag[i]), ('peers', peer_flag[i])) if flag],
+            })
+    elapsed = time.perf_counter() - start_time
+    anomaly_detection_seconds.observe(elapsed)
+    return {
+        'generated_at': datetime.fromtimestamp(end).isoformat(),
+        'window_hours': window_hours,
+        'baseline_windows': baseline_windows,
+        'threshold': threshold,
+        'devices': len(device_ids),
+        'seconds': round(elapsed, 6),
+        'anomalies': anomalies,
+    }
+
+
+# 检查常用的筛选和排序是否都用上了索引，返回 (参数, 执行计划, 是否用到索引)
+def check_device_query_plans():
+    results = []
+    with get_db_connection() as conn:
+        results = explain_device_queries(conn)
+    return results
+
+
+# 设备片段的 JSON 编码，输出和 SmartHomeJSONProvider 的紧凑格式一致
+def encode_json(obj):
+    if orjson is not None and JSON_BACKEND != 'stdlib':
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(data):
+    if orjson is not None and JSON_BACKEND != 'stdlib':
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# 数据库一行里该设备类型对应的属性
+def row_attributes(row):
+    device_type, brightness, temperature, resolution = row[4:8]
+    if device_type == 'light':
+        return {'brightness': brightness}
+    if device_type == 'thermostat':
+        return {'temperature': temperature}
+    if device_type == 'camera':
+        return {'resolution': resolution}
+    return {}
+
+
+# 用数据库的一行数据创建设备对象，不写回数据库
+def build_device(row):
+    device_id, name, status, energy_usage, device_type, brightness, temperature, resolution = row
+    kwargs = {}
+    if device_type == 'light' and brightness is not None:
+        kwargs['brightness'] = brightness
+    elif device_type == 'thermostat' and temperature is not None:
+        kwargs['temperature'] = temperature
+    elif device_type == 'camera' and resolution is not None:
+        kwargs['resolution'] = resolution
+    device = devices_classes[device_type](device_id, name, save=False, **kwargs)
+    device.apply_state(status, energy_usage)
+    return device
+
+
+# 用数据库的一行数据创建只读视图，不创建设备对象
+def row_view(row):
+    return DeviceView(row[0], row[1], row[4], row[2], row[3], row_attributes(row))
+
+
+# 分段锁：按设备 id 的哈希选一把锁，不同设备的操作大多落在不同的锁上，不会互相阻塞
+class StripedLock:
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def for_key(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+# 一个设备在某个时刻的状态，创建后不再修改；完整的字典和 JSON 片段第一次用到时才生成并缓存，调用方不能修改
+class DeviceView:
+    __slots__ = ('device_id', 'name', 'device_type', 'status', 'energy_usage', 'attributes', '_dict', '_json')
+
+    def __init__(self, device_id, name, device_type, status, energy_usage, attributes, device_dict=None,
+                 fragment=None):
+        self.device_id = device_id
+        self.name = name
+        self.device_type = device_type
+        self.status = status
+        self.energy_usage = energy_usage
+        self.attributes = attributes
+        self._dict = device_dict
+        self._json = fragment
+
+    def cached_dict(self):
+        return self._dict
+
+    def cached_json(self):
+        return self._json
+
+    def to_dict(self):
+        if self._dict is None:
+            device_dict = {
+                'device_id': self.device_id,
+                'name': self.name,
+                'status': self.status,
+                'energy_usage': self.energy_usage
+            }
+            device_dict.update(self.attributes)
+            self._dict = device_dict
+        return self._dict
+
+    def to_json(self):
+        if self._json is None:
+            self._json = encode_json(self.to_dict())
+        return self._json
+
+
+# 读快照按设备加入的顺序分块保存视图，每块最多这么多个设备；一次发布只复制变化的设备所在的块
+FLEET_CHUNK_SIZE = 1024
+# 读快照的 index 按设备 id 的哈希分片，增删设备时只复制所在的那一片，不用复制整个 index
+FLEET_INDEX_SHARDS = 256
+
+
+# 整个设备集合在某个时刻的读快照，读者拿到引用后不用加锁就能遍历，遍历过程中发生的写入只会出现在下一个快照里
+# 发布之后包含哪些设备、顺序和状态都不再变化；唯一会原地修改的是全量加载时放进块里的数据库行或快照文件记录下标：
+# 第一次读到时换成同一个状态的视图缓存在块里，共用这个块的快照和正在遍历的读者看到的内容不变
+class FleetSnapshot:
+    def __init__(self, version, chunks=(), index=None, size=0, reader=None, base=None, base_json=None):
+        self.version = version
+        # 按顺序排列的块，每块是 device_id -> DeviceView，新快照和旧快照共用没有变化的块
+        self.chunks = chunks
+        # device_id -> 所在块的下标，按 hash(device_id) 分成 FLEET_INDEX_SHARDS 片，新旧快照共用没有变化的分片
+        self.index = [{} for _ in range(FLEET_INDEX_SHARDS)] if index is None else index
+        self.size = size
+        # 块里的整数是这个快照文件里的记录下标
+        self.reader = reader
+        # 直接建立在快照文件上的读快照（见 snapshot_fleet）：前 len(base) 块对应文件里连续的记录，
+        # 块为 None 表示和文件一致，第一次用到时才解码成 base 里的块，同一个文件上的所有读快照共用 base；
+        # base_json 是这样的块整块编码好的列表片段，列出全部设备时不用给每个设备生成视图
+        self.base = base
+        self.base_json = base_json
+        self._total_energy_usage = None
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, device_id):
+        return self._position(device_id) is not None
+
+    # 设备所在块的下标；快照文件里的设备不在 index 里，按 id 在文件里二分查找，记录下标就决定了它在哪一块
+    def _position(self, device_id):
+        position = self.index[hash(device_id) % FLEET_INDEX_SHARDS].get(device_id)
+        if position is None and self.base is not None:
+            record = self.reader.index_of(device_id)
+            if record is not None:
+                position = record // FLEET_CHUNK_SIZE
+                chunk = self.chunks[position]
+                # 这一块改过，设备可能已经被删除，或者删除后又加入到了末尾
+                if chunk is not None and device_id not in chunk:
+                    return None
+        return position
+
+    # 第 position 块，和快照文件一致的块这时才解码
+    def _chunk(self, position):
+        chunk = self.chunks[position]
+        if chunk is None:
+            chunk = self.base[position]
+            if chunk is None:
+                start = position * FLEET_CHUNK_SIZE
+                chunk = {row[0]: row for row in self.reader.rows(start, start + FLEET_CHUNK_SIZE)}
+                self.base[position] = chunk
+        return chunk
+
+    def get(self, device_id):
+        position = self._position(device_id)
+        if position is None:
+            return None
+        chunk = self._chunk(position)
+        view = chunk.get(device_id)
+        if view is not None and type(view) is not DeviceView:
+            view = chunk[device_id] = self._resolve(view)
+        return view
+
+    # 全量加载时块里放的是数据库行或快照文件的记录下标，第一次读到时才换成视图
+    def _resolve(self, entry):
+        return row_view(self.reader.row(entry) if type(entry) is int else entry)
+
+    # 第 position 块里的视图
+    def _chunk_views(self, position):
+        chunk = self._chunk(position)
+        for device_id, view in chunk.items():
+            if type(view) is not DeviceView:
+                view = chunk[device_id] = self._resolve(view)
+            yield view
+
+    # 按顺序遍历所有视图
+    def values(self):
+        for position in range(len(self.chunks)):
+            yield from self._chunk_views(position)
+
+    # 和快照文件一致的块整块编码成列表片段（不带方括号），返回 (片段, 设备数, 是否用了缓存)
+    def _base_fragment(self, position):
+        cached = self.base_json[position]
+        if cached is not None:
+            return cached + (True,)
+        start = position * FLEET_CHUNK_SIZE
+        devices_info = [device_row_to_dict(row) for row in self.reader.rows(start, start + FLEET_CHUNK_SIZE)]
+        cached = self.base_json[position] = (encode_json(devices_info)[1:-1], len(devices_info))
+        return cached + (False,)
+
+    # 在这个快照的基础上应用变化，返回新快照：只复制有变化的块和 index 分片，其余的和这个快照共用
+    # changes 是 device_id -> 新视图（None 表示删除），新设备按 changes 的顺序追加到末尾
+    def update(self, version, changes):
+        chunks, index, size = list(self.chunks), list(self.index), self.size
+        copied_chunks, copied_shards = set(), set()
+        for device_id, view in changes.items():
+            shard = hash(device_id) % FLEET_INDEX_SHARDS
+            position = index[shard].get(device_id)
+            indexed = position is not None
+            # 快照文件里的设备不在 index 里：还没改过的块和文件一致，改过的块已经复制到 chunks 里
+            if position is None and self.base is not None:
+                record = self.reader.index_of(device_id)
+                if record is not None:
+                    chunk = chunks[record // FLEET_CHUNK_SIZE]
+                    if chunk is None or device_id in chunk:
+                        position = record // FLEET_CHUNK_SIZE
+            if position is None:
+                if view is None:
+                    continue
+                if not chunks or chunks[-1] is None or len(chunks[-1]) >= FLEET_CHUNK_SIZE:
+                    chunks.append({})
+                    copied_chunks.add(len(chunks) - 1)
+                position = len(chunks) - 1
+                if shard not in copied_shards:
+                    index[shard] = dict(index[shard])
+                    copied_shards.add(shard)
+                index[shard][device_id] = position
+                size += 1
+            if position not in copied_chunks:
+                chunks[position] = dict(self._chunk(position))
+                copied_chunks.add(position)
+            if view is None:
+                del chunks[position][device_id]
+                if indexed:
+                    if shard not in copied_shards:
+                        index[shard] = dict(index[shard])
+                        copied_shards.add(shard)
+                    del index[shard][device_id]
+                size -= 1
+            else:
+                chunks[position][device_id] = view
+        fleet = FleetSnapshot(version, chunks, index, size, self.reader, self.base, self.base_json)
+        # 删除留下的空块太多时重新分块
+        if len(chunks) > 2 * (size // FLEET_CHUNK_SIZE + 1):
+            return build_fleet(version, ((device_id, entry) for position in range(len(chunks))
+                                         for device_id, entry in fleet._chunk(position).items()), self.reader)
+        return fleet
+
+    # 第一次用到时才计算，快照不会变，算一次就够
+    def total_energy_usage(self):
+        if self._total_energy_usage is None:
+            self._total_energy_usage = sum(view.energy_usage for view in self.values())
+        return self._total_energy_usage
+
+    # 在快照中筛选和排序，语义和 query_devices 一致
+    def select(self, filters):
+        views = []
+        for view in self.values():
+            if 'type' in filters and view.device_type != filters['type']:
+                continue
+            if 'status' in filters and view.status != filters['status']:
+                continue
+            if 'min_energy' in filters and view.energy_usage < filters['min_energy']:
+                continue
+            if 'max_energy' in filters and view.energy_usage > filters['max_energy']:
+                continue
+            views.append(view)
+        if 'order_by' in filters:
+            field = 'energy_usage' if filters['order_by'] == 'energy' else 'name'
+
+            # 和 SQLite 一样，升序时 NULL 排在最前面，降序时排在最后
+            def sort_key(view):
+                value = getattr(view, field)
+                return (False, '') if value is None else (True, value)
+            views.sort(key=sort_key, reverse=filters['desc'])
+        if 'limit' in filters:
+            views = views[:filters['limit']]
+        return views
+
+    # 使用每个视图缓存的字典，已经生成过的视图不用重新构造
+    def to_dicts(self, views=None):
+        devices_info = []
+        misses = 0
+        for view in (self.values() if views is None else views):
+            device_dict = view.cached_dict()
+            if device_dict is None:
+                misses += 1
+                device_dict = view.to_dict()
+            devices_info.append(device_dict)
+        device_cache_total.inc(('dict', 'hit'), len(devices_info) - misses)
+        device_cache_total.inc(('dict', 'miss'), misses)
+        return devices_info
+
+    # 把每个视图缓存的 JSON 片段拼成列表响应体，只有变化过的设备需要重新序列化
+    def to_json(self, views=None):
+        start = time.perf_counter()
+        fragments = []
+        hits = misses = 0
+
+        def add(views):
+            nonlocal hits, misses
+            for view in views:
+                fragment = view.cached_json()
+                if fragment is None:
+                    misses += 1
+                    fragment = view.to_json()
+                else:
+                    hits += 1
+                fragments.append(fragment)
+
+        if views is not None:
+            add(views)
+        else:
+            # 列出全部设备时，和快照文件一致的块直接用整块编码好的片段
+            for position in range(len(self.chunks)):
+                if self.chunks[position] is None:
+                    fragment, count, hit = self._base_fragment(position)
+                    if hit:
+                        hits += count
+                    else:
+                        misses += count
+                    fragments.append(fragment)
+                else:
+                    add(self._chunk_views(position))
+        device_cache_total.inc(('json', 'hit'), hits)
+        device_cache_total.inc(('json', 'miss'), misses)
+        body = b'[' + b','.join(fragments) + b']\n'
+        serialization_seconds.observe(time.perf_counter() - start)
+        return body
+
+
+# 按顺序把 (device_id, 视图、数据库行或快照文件记录下标) 分块，生成新的读快照
+def build_fleet(version, items, reader=None):
+    chunks, index, size = [], [{} for _ in range(FLEET_INDEX_SHARDS)], 0
+    for device_id, view in items:
+        if not chunks or len(chunks[-1]) >= FLEET_CHUNK_SIZE:
+            chunks.append({})
+        chunks[-1][device_id] = view
+        index[hash(device_id) % FLEET_INDEX_SHARDS][device_id] = len(chunks) - 1
+        size += 1
+    return FleetSnapshot(version, chunks, index, size, reader)
+
+
+# 直接建立在快照文件上的读快照：不解码任何记录，设备按文件里的顺序分块，第一次遍历到某一块时才解码
+def snapshot_fleet(version, reader):
+    chunk_count = -(-len(reader) // FLEET_CHUNK_SIZE)
+    return FleetSnapshot(version, [None] * chunk_count, None, len(reader), reader, [None] * chunk_count,
+                         [None] * chunk_count)
+
+
+# 从快照文件加载时用的 devices，用法和字典一样：没有写入过的设备不占内存，按 id 在快照文件里二分查找，值是记录下标；
+# 创建过对象、新加入和删除的设备记在 _changed 里（删除记为 None）。和字典一样只能在 _write_lock 里修改
+class SnapshotDevices:
+    _MISSING = object()
+
+    def __init__(self, reader):
+        self.reader = reader
+        self._changed = {}
+        # 排在快照文件里的设备之后的：新加入的设备，以及删除后又加入的设备
+        self._appended = set()
+        self._size = len(reader)
+
+    def __len__(self):
+        return self._size
+
+    def get(self, device_id, default=None):
+        device = self._changed.get(device_id, self._MISSING)
+        if device is self._MISSING:
+            device = self.reader.index_of(device_id)
+        return default if device is None else device
+
+    def __contains__(self, device_id):
+        return self.get(device_id) is not None
+
+    def __getitem__(self, device_id):
+        device = self.get(device_id)
+        if device is None:
+            raise KeyError(device_id)
+        return device
+
+    def __setitem__(self, device_id, device):
+        if self.get(device_id) is None:
+            self._size += 1
+            if device_id in self._changed or self.reader.index_of(device_id) is None:
+                # 和字典一样，新加入的设备排到最后
+                self._changed.pop(device_id, None)
+                self._appended.add(device_id)
+        self._changed[device_id] = device
+
+    def __delitem__(self, device_id):
+        if self.get(device_id) is None:
+            raise KeyError(device_id)
+        self._changed[device_id] = None
+        self._size -= 1
+
+    def pop(self, device_id, default=None):
+        device = self.get(device_id)
+        if device is None:
+            return default
+        del self[device_id]
+        return device
+
+    # 先按文件里的顺序，再按加入的顺序；要解码整个文件，只在测试和全量发布时用
+    def items(self):
+        changed, appended = self._changed, self._appended
+        for index, row in enumerate(self.reader.rows()):
+            device = changed.get(row[0], self._MISSING)
+            if device is self._MISSING:
+                yield row[0], index
+            elif device is not None and row[0] not in appended:
+                yield row[0], device
+        for device_id, device in list(changed.items()):
+            if device is not None and device_id in appended:
+                yield device_id, device
+
+    def __iter__(self):
+        return (device_id for device_id, _ in self.items())
+
+    def values(self):
+        return (device for _, device in self.items())
+
+
 # 设备控制类
+# devices 字典只在 _write_lock 里原地增删，其他线程只按 id 查找（单次 get/in 在 GIL 下是原子的），不遍历它；
+# 需要遍历设备集合的读接口都用读快照 self.fleet
 class DeviceController:
-    def __init__(self):
+    def __init__(self, stripes=64, publish_interval=FLEET_PUBLISH_INTERVAL):
         self.devices = {}
+        # 修改单个设备状态时用的分段锁
+        self.locks = StripedLock(stripes)
+        # 增删设备（替换 devices 字典）时用的锁
+        self._write_lock = threading.Lock()
+        # 已经应用到内存的最后一条变更日志
+        self.last_seq = 0
+        self._sync_lock = threading.Lock()
+        self._watch_conn = None
+        self._watch_pid = None
+        self._data_version = None
+        # 从二进制快照文件加载时保持打开，devices 里的整数是还没有创建设备对象的记录下标
+        self._reader = None
+        # 数据版本：设备增删、状态或属性变化都会加一，响应缓存用它判断是否过期
+        self._versions = count(1)
+        self.version = 0
+        # 读快照：写入时记下变化的设备，发布时只重新生成这些设备的视图，再整体替换 self.fleet
+        self.fleet = FleetSnapshot(0)
+        self.publish_interval = publish_interval
+        self._published_at = 0.0
+        self._publish_lock = threading.Lock()
+        # 保护 version 和待发布的设备集合，两者必须一起读写，否则快照的版本号和内容可能对不上
+        self._dirty_lock = threading.Lock()
+        # device_id -> 是否是新加入的设备，按记下的顺序排列，新设备按这个顺序追加到读快照末尾
+        self._dirty = {}
+        self._dirty_all = False
+
+    # 记下变化的设备并更新版本，device_ids 为 None 表示整个设备集合都可能变了
+    # added 为 True 表示这些设备刚加入 devices，要在持有 _write_lock 时调用，顺序才和 devices 一致
+    def _mark_dirty(self, device_ids=None, added=False):
+        with self._dirty_lock:
+            self.version = next(self._versions)
+            if device_ids is None:
+                self._dirty_all = True
+            elif added:
+                for device_id in device_ids:
+                    # 删除后又加入的设备在 devices 里排到了末尾，读快照里也要移到末尾
+                    self._dirty.pop(device_id, None)
+                    self._dirty[device_id] = True
+            else:
+                for device_id in device_ids:
+                    self._dirty.setdefault(device_id, False)
+
+    # 到了发布间隔才发布，别的线程正在发布时直接返回；调用方不能持有分段锁
+    def _maybe_publish(self):
+        if not self.publish_interval:
+            self.publish()
+        elif time.monotonic() - self._published_at >= self.publish_interval:
+            self.publish(blocking=False)
+
+    # 已有设备的状态或属性变了；调用方不能持有分段锁
+    def _bump_version(self, device_ids):
+        self._mark_dirty(device_ids)
+        self._maybe_publish()
+
+    # 把待发布的变化做成新的读快照并替换 self.fleet；blocking 为 False 时如果别的线程正在发布就直接返回
+    def publish(self, blocking=True):
+        if not self._publish_lock.acquire(blocking=blocking):
+            return self.fleet
+        try:
+            with self._dirty_lock:
+                dirty, dirty_all, version = self._dirty, self._dirty_all, self.version
+                self._dirty, self._dirty_all = {}, False
+            if not dirty and not dirty_all:
+                return self.fleet
+            devices = self.devices
+            if dirty_all:
+                # list() 在 GIL 下一次复制完，不会和原地增删设备交错
+                self.fleet = build_fleet(version, ((device_id, self._view(device_id, device))
+                                                   for device_id, device in list(devices.items())), self._reader)
+            else:
+                fleet = self.fleet
+                changes, readded = {}, {}
+                for device_id, added in dirty.items():
+                    device = devices.get(device_id)
+                    if device is None:
+                        changes[device_id] = None
+                        continue
+                    if added and device_id in fleet:
+                        readded[device_id] = None
+                    changes[device_id] = self._view(device_id, device)
+                if readded:
+                    # 删除后又加入的设备先从旧位置删掉，再追加到末尾
+                    fleet = fleet.update(version, readded)
+                self.fleet = fleet.update(version, changes)
+            self._published_at = time.monotonic()
+            return self.fleet
+        finally:
+            self._publish_lock.release()
+
+    # 整个设备集合刚被替换时发布读快照：build(version) 直接用数据库行或快照文件生成读快照，不用先给每个设备生成视图；
+    # 替换之后已经有写入的设备，仍然从设备对象生成视图
+    def _publish_loaded(self, build):
+        with self._publish_lock:
+            with self._dirty_lock:
+                self.version = version = next(self._versions)
+                dirty = self._dirty
+                self._dirty, self._dirty_all = {}, False
+            fleet = build(version)
+            if dirty:
+                devices = self.devices
+                changes = {}
+                for device_id in dirty:
+                    device = devices.get(device_id)
+                    changes[device_id] = None if device is None else self._view(device_id, device)
+                fleet = fleet.update(version, changes)
+            self.fleet = fleet
+            self._published_at = time.monotonic()
+
+    # 在设备的分段锁里生成只读视图；还没有创建设备对象的直接用记录下标，读取时再从快照文件解码
+    def _view(self, device_id, device):
+        if type(device) is int:
+            return device
+        with self.locks.for_key(device_id):
+            return device.view()
+
+    # 取设备对象，设备不存在返回 None；从快照文件加载、还没有写入过的设备这时才创建
+    # 只是把记录下标换成同一个设备的对象，不算增删，直接在 devices 里替换
+    def _device(self, device_id):
+        device = self.devices.get(device_id)
+        if type(device) is not int:
+            return device
+        with self._write_lock:
+            devices = self.devices
+            device = devices.get(device_id)
+            if type(device) is int:
+                device = build_device(devices.reader.row(device))
+                devices[device_id] = device
+            return device
+
+    # 单个设备的 JSON，设备不存在返回 None；还没有创建设备对象的直接从快照文件解码，不创建对象
+    def device_json(self, device_id):
+        devices = self.devices
+        device = devices.get(device_id)
+        if type(device) is int:
+            return row_view(devices.reader.row(device)).to_json()
+        return None if device is None else device.to_json()
+
+    # 读接口用的快照，不加锁；合并发布时如果已经超过发布间隔，顺便尝试发布一次
+    def snapshot(self):
+        fleet = self.fleet
+        if (fleet.version != self.version and self.publish_interval
+                and time.monotonic() - self._published_at >= self.publish_interval):
+            fleet = self.publish(blocking=False)
+        return fleet
 
     def load_devices_database(self):
         try:
             with get_db_connection() as conn:
                 c = conn.cursor()
-                c.execute('SELECT * FROM devices')
-                rows = c.fetchall()
-
-                devices_classes = {
-                    'light': Light,
-                    'thermostat': Thermostat,
-                    'camera': Camera
-                }
-
-                for x in rows:
-                    device_id, name, status, energy_usage, device_type = x
-                    kwargs = {}
-                    if device_type == 'light':
-                        c.execute('SELECT brightness FROM light_attributes WHERE device_id = ?', (device_id,))
-                        result = c.fetchone()
-                        if result:
-                            kwargs['brightness'] = result[0]
-                    elif device_type == 'thermostat':
-                        c.execute('SELECT temperature FROM thermostat_attributes WHERE device_id = ?', (device_id,))
-                        result = c.fetchone()
-                        if result:
-                            kwargs['temperature'] = result[0]
-                    elif device_type == 'camera':
-                        c.execute('SELECT resolution FROM camera_attributes WHERE device_id = ?', (device_id,))
-                        result = c.fetchone()
-                        if result:
-                            kwargs['resolution'] = result[0]
-
-                    device = devices_classes[device_type](device_id, name, **kwargs)
-                    # 使用公共方法设置状态和能量消耗
-                    if status == 'on':
-                        device.turn_on()
-                    else:
-                        device.turn_off()
-                    device._Device__energy_usage = energy_usage
-                    self.devices[device_id] = device
-                    device.update_db()
+                # 先记下日志位置再读设备，读的过程中发生的变更会在下次同步时重放
+                c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+                last_seq = c.fetchone()[0]
+                c.execute(DEVICE_ROW_SQL)
+                rows = [row for row in c.fetchall() if row[4] in devices_classes]
+                devices = {row[0]: build_device(row) for row in rows}
+                with self._write_lock:
+                    self.devices = devices
+                    self._reader = None
+                    self.last_seq = last_seq
+                    self._publish_loaded(lambda version: build_fleet(version, ((row[0], row) for row in rows)))
         except sqlite3.Error as e:
-            logging.error(f"数据库加载出错： {e}")
-
-    def add_device(self, device):
-        device_id = device.get_id()
-        if device_id not in self.devices:
-            self.devices[device_id] = device
-        else:
-            logging.warning(f"Device {device_id} 已经存在")
+            db_logger.error(f"数据库加载出错： {e}")
 
-    def remove_device(self, device_id):
-        if device_id in self.devices:
-            del self.devices[device_id]
+    # 检查其他进程写入的变更，只把新增的变更应用到内存
+    def sync_changes(self):
+        with self._sync_lock:
             try:
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute('DELETE FROM devices WHERE device_id = ?', (device_id,))
-                    c.execute('DELETE FROM light_attributes WHERE device_id = ?', (device_id,))
-                    c.execute('DELETE FROM thermostat_attributes WHERE device_id = ?', (device_id,))
-                    c.execute('DELETE FROM camera_attributes WHERE device_id = ?', (device_id,))
-                    conn.commit()
-                return True
+                # fork 之后不能沿用父进程的连接
+                if self._watch_conn is None or self._watch_pid != os.getpid():
+                    self._watch_conn = sqlite3.connect(db_name, check_same_thread=False)
+                    self._watch_pid = os.getpid()
+                    self._data_version = None
+                c = self._watch_conn.cursor()
+                # data_version 只有在别的连接提交后才会变化，没有变化就不用查日志
+                c.execute('PRAGMA data_version')
+                data_version = c.fetchone()[0]
+                if data_version == self._data_version:
+                    return 0
+                # MIN 和 MAX 分开查，各自只读主键索引的一端；合在一条语句里会扫描整张表
+                c.execute('SELECT MAX(seq) FROM change_log')
+                max_seq = c.fetchone()[0]
+                if max_seq is None or max_seq <= self.last_seq:
+                    self._data_version = data_version
+                    return 0
+                c.execute('SELECT MIN(seq) FROM change_log')
+                min_seq = c.fetchone()[0]
+                # 需要的日志已经被清理掉了，只能全量重新加载
+                if min_seq > self.last_seq + 1:
+                    self.load_devices_database()
+                    self._data_version = data_version
+                    return len(self.devices)
+
+                c.execute('SELECT device_id, op FROM change_log WHERE seq > ? AND seq <= ? ORDER BY seq',
+                          (self.last_seq, max_seq))
+                changed = {}
+                for device_id, op in c.fetchall():
+                    changed[device_id] = op
+                ids = list(changed)
+                rows = {}
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    c.execute(f'{DEVICE_ROW_SQL} AND d.device_id IN ({placeholders})', chunk)
+                    for row in c.fetchall():
+                        rows[row[0]] = row
+                self._apply_rows(ids, rows)
+                self.last_seq = max_seq
+                self._data_version = data_version
+                return len(ids)
             except sqlite3.Error as e:
-                logging.error(f"数据库删除出错： {e}")
-                return False
-        return False
+                db_logger.error(f"同步变更日志出错： {e}")
+                return 0
+
+    # 把数据库里的最新行应用到内存，行不存在说明设备已被删除或软删除
+    # 状态没变的设备不算变化，什么都没变时不更新版本
+    def _apply_rows(self, device_ids, rows):
+        with self._write_lock:
+            devices, changed, added = self.devices, [], []
+            for device_id in device_ids:
+                row = rows.get(device_id)
+                # 还没有创建对象的记录下标类型对不上，会直接换成新建的设备对象
+                device = devices.get(device_id)
+                if row is None or row[4] not in devices_classes:
+                    if device is not None:
+                        del devices[device_id]
+                        changed.append(device_id)
+                    continue
+                if device is None:
+                    devices[device_id] = build_device(row)
+                    added.append(device_id)
+                    continue
+                if (type(device) is devices_classes[row[4]] and device.get_name() == row[1]
+                        and device.get_attributes() == row_attributes(row)):
+                    with self.locks.for_key(device_id):
+                        if device.get_status() == row[2] and device.get_energy_usage() == row[3]:
+                            continue
+                        device.apply_state(row[2], row[3])
+                else:
+                    devices[device_id] = build_device(row)
+                changed.append(device_id)
+            if changed:
+                self._mark_dirty(changed)
+            if added:
+                self._mark_dirty(added, added=True)
+        if changed or added:
+            self._maybe_publish()
+        return len(changed) + len(added)
+
+    # 清理已经很旧的变更日志，落后太多的进程会自动全量重新加载
+    def trim_change_log(self, keep=CHANGE_LOG_KEEP):
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute('DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?', (keep,))
+                conn.commit()
+        except sqlite3.Error as e:
+            db_logger.error(f"清理变更日志出错： {e}")
 
-    def list_devices(self):
-        devices_info = []
-        for device in self.devices.values():
-            device_dict = device.change_to_dict()
-            device_type = None
+    # 在一个读事务里读出全部设备和两个日志的位置，压缩后写入 snapshots，返回快照包含的最后一条命令日志
+    # 从数据库而不是内存生成快照，内存可能还没同步其他 worker 的写入
+    def take_snapshot(self, keep=SNAPSHOT_KEEP):
+        log_seq = None
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            c.execute('SELECT COALESCE(MAX(seq), 0) FROM command_log')
+            log_seq = c.fetchone()[0]
+            c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+            change_seq = c.fetchone()[0]
+            c.execute('SELECT log_seq FROM snapshots ORDER BY snapshot_id DESC LIMIT 1')
+            latest = c.fetchone()
+            if latest is not None and latest[0] == log_seq:
+                conn.commit()
+                return log_seq
+            c.execute(DEVICE_ROW_SQL)
+            rows = c.fetchall()
+            conn.commit()
+            data = zlib.compress(encode_json(rows))
+            c.execute('''
+                INSERT INTO snapshots (log_seq, change_seq, device_count, data, created_at) VALUES (?,?,?,?,?)
+            ''', (log_seq, change_seq, len(rows), data, time.time()))
+            c.execute('''
+                DELETE FROM snapshots WHERE snapshot_id NOT IN (
+                    SELECT snapshot_id FROM snapshots ORDER BY snapshot_id DESC LIMIT ?
+                )
+            ''', (keep,))
+            conn.commit()
+            controller_logger.info("写入快照：%d 个设备，命令日志位置 %d", len(rows), log_seq)
+        return log_seq
+
+    # 用最近一次快照加上之后的命令日志恢复内存状态，耗时只和快照之后的日志条数有关
+    # 绕过 insert_or_replace_device 等接口直接写库的数据不在命令日志里，恢复后再从快照记下的变更日志位置
+    # 同步一次把它们补上；没有快照（或快照没有记录变更日志位置）时返回 False，由调用方全量加载
+    def restore_from_snapshot(self):
+        snapshot, tail = None, []
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            c.execute('SELECT log_seq, data, change_seq FROM snapshots ORDER BY snapshot_id DESC LIMIT 1')
+            snapshot = c.fetchone()
+            if snapshot is not None:
+                c.execute('SELECT op, device_id, payload FROM command_log WHERE seq > ? ORDER BY seq', (snapshot[0],))
+                tail = c.fetchall()
+            conn.commit()
+        if snapshot is None or snapshot[2] is None:
+            return False
+        change_seq = snapshot[2]
+        devices = {}
+        for row in decode_json(zlib.decompress(snapshot[1])):
+            if row[4] in devices_classes:
+                devices[row[0]] = build_device(row)
+        for op, device_id, payload in tail:
+            if op == 'remove':
+                devices.pop(device_id, None)
+                continue
+            payload = decode_json(payload)
+            if op in ('command', 'reading'):
+                device = devices.get(device_id)
+                if device is not None:
+                    device.apply_state(payload[0], payload[1])
+            elif payload[4] in devices_classes:
+                devices[device_id] = build_device(payload)
+        with self._write_lock:
+            self.devices = devices
+            self._reader = None
+            self.last_seq = change_seq
+            self._data_version = None
+            self._mark_dirty()
+        self.publish()
+        self.sync_changes()
+        controller_logger.info("从快照恢复 %d 个设备，重放命令日志 %d 条", len(devices), len(tail))
+        return True
+
+    # 把数据库里的当前设备写成二进制快照文件，返回写入的设备数
+    def write_snapshot_file(self, path):
+        result = None
+        with get_db_connection() as conn:
+            result = snapshot_rows(conn)
+        if result is None:
+            return 0
+        return write_snapshot(path, *result)
+
+    # 从二进制快照文件加载设备：只读文件头，不解码任何记录，文件保持 mmap 打开；按 id 查找设备时在文件里二分查找，
+    # 设备对象在第一次写入时才创建，读快照也直接建立在文件上；再通过变更日志追上快照之后的写入
+    # 被替换掉的旧快照文件不用手动关闭，没有读快照再引用它时 SnapshotReader 自己关闭
+    def load_from_snapshot(self, path):
+        reader = SnapshotReader(path)
+        devices = SnapshotDevices(reader)
+        with self._write_lock:
+            self.devices = devices
+            self._reader = reader
+            self.last_seq = reader.change_seq
+            self._data_version = None
+            self._publish_loaded(lambda version: snapshot_fleet(version, reader))
+        self.sync_changes()
+        controller_logger.info("从快照文件 %s 加载 %d 个设备", path, len(devices))
+
+    # 启动时恢复状态：优先二进制快照文件，其次数据库里的快照加命令日志，最后全量加载
+    def restore(self, snapshot_file=SNAPSHOT_FILE):
+        if snapshot_file and os.path.exists(snapshot_file):
+            try:
+                self.load_from_snapshot(snapshot_file)
+                return
+            except (OSError, ValueError) as e:
+                controller_logger.error(f"快照文件 {snapshot_file} 无法读取，改为从数据库加载： {e}")
+        if not self.restore_from_snapshot():
+            self.load_devices_database()
+
+    def add_device(self, device):
+        device_id = device.get_id()
+        with self._write_lock:
+            added = device_id not in self.devices
+            if added:
+                self.devices[device_id] = device
+                self._mark_dirty([device_id], added=True)
+        if added:
+            self._maybe_publish()
+            return
+        controller_logger.warning(f"Device {device_id} 已经存在")
+
+    def remove_device(self, device_id, soft=False):
+        removed = self.remove_devices(device_ids=[device_id], soft=soft)
+        return bool(removed)
+
+    # 批量删除：按 id 列表或筛选条件（和 GET /devices 的参数相同）选出设备，在一个事务里全部删除
+    # 定时任务和周期任务由外键级联删除；soft 为 True 时只打上 deleted_at，之后由 purge_deleted 分批删除
+    # 返回被删除的设备 id 列表，数据库出错时返回 None
+    def remove_devices(self, device_ids=None, filters=None, soft=False):
+        removed = []
+        committed = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            if filters is not None:
+                sql, params = build_device_query(filters)
+                c.execute(sql, params)
+                removed = [row[0] for row in c.fetchall()]
+            else:
+                ids = list(dict.fromkeys(device_ids or []))
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    c.execute(f'SELECT device_id FROM devices WHERE deleted_at IS NULL AND device_id IN ({placeholders})',
+                              chunk)
+                    removed.extend(row[0] for row in c.fetchall())
+            deleted_at = time.time()
+            for i in range(0, len(removed), 500):
+                chunk = removed[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                if soft:
+                    c.execute(f'UPDATE devices SET deleted_at = ? WHERE device_id IN ({placeholders})',
+                              [deleted_at] + chunk)
+                else:
+                    c.execute(f'DELETE FROM devices WHERE device_id IN ({placeholders})', chunk)
+            c.executemany('INSERT INTO command_log (op, device_id, created_at) VALUES (?,?,?)',
+                          [('remove', device_id, deleted_at) for device_id in removed])
+            conn.commit()
+            committed = True
+        if not committed:
+            return None
+        if removed:
+            with self._write_lock:
+                for device_id in removed:
+                    self.devices.pop(device_id, None)
+                self._mark_dirty(removed)
+            self._maybe_publish()
+            controller_logger.info("%s删除设备 %d 个", '软' if soft else '', len(removed))
+        return removed
+
+    # 真正删除软删除超过 older_than 秒的设备，每批一个短事务，批次之间让出写锁，不会长时间阻塞其他写入
+    def purge_deleted(self, batch_size=500, older_than=0.0, pause=0.0):
+        purged = 0
+        cutoff = time.time() - older_than
+        while True:
+            count = None
             with get_db_connection() as conn:
                 c = conn.cursor()
-                c.execute('SELECT device_type FROM devices WHERE device_id = ?', (device.get_id(),))
-                result = c.fetchone()
-                if result:
-                    device_type = result[0]
-            if device_type == 'light':
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute('SELECT brightness FROM light_attributes WHERE device_id = ?', (device.get_id(),))
-                    result = c.fetchone()
-                    if result:
-                        device_dict['brightness'] = result[0]
-            elif device_type == 'thermostat':
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute('SELECT temperature FROM thermostat_attributes WHERE device_id = ?', (device.get_id(),))
-                    result = c.fetchone()
-                    if result:
-                        device_dict['temperature'] = result[0]
-            elif device_type == 'camera':
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    c.execute('SELECT resolution FROM camera_attributes WHERE device_id = ?', (device.get_id(),))
-                    result = c.fetchone()
-                    if result:
-                        device_dict['resolution'] = result[0]
-            devices_info.append(device_dict)
+                c.execute('''
+                    DELETE FROM devices WHERE rowid IN (
+                        SELECT rowid FROM devices WHERE deleted_at IS NOT NULL AND deleted_at <= ? LIMIT ?
+                    )
+                ''', (cutoff, batch_size))
+                count = c.rowcount
+                conn.commit()
+            if count is None:
+                break
+            purged += count
+            if count < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        if purged:
+            controller_logger.info("清理软删除的设备 %d 个", purged)
+        return purged
+
+    # 从读快照列出设备，不用加锁，也不会看到遍历过程中的增删
+    def list_devices(self):
+        return self.snapshot().to_dicts()
+
+    # 修改设备属性，返回修改后的设备；设备不存在返回 None，参数不合法时抛出 ValueError
+    def update_attributes(self, device_id, attributes):
+        device = self._device(device_id)
+        if device is None:
+            return None
+        unknown = set(attributes) - set(device.get_attributes())
+        if unknown:
+            raise ValueError(f"不支持的属性{'、'.join(sorted(unknown))}")
+        with self.locks.for_key(device_id):
+            changed = device.update_attributes(attributes)
+        if changed:
+            self._bump_version([device_id])
+        return device
+
+    # 记录一次上报的能耗读数，设备不存在返回 None
+    def record_reading(self, device_id, kwh, recorded_at=None):
+        device = self._device(device_id)
+        if device is None:
+            return None
+        with self.locks.for_key(device_id):
+            device.add_energy(kwh, recorded_at)
+        self._bump_version([device_id])
+        return device
+
+    # 在读快照中筛选和排序，语义和 query_devices 一致
+    def filter_devices(self, filters):
+        fleet = self.snapshot()
+        return fleet.to_dicts(fleet.select(filters))
+
+    # 直接在数据库里筛选和排序（走索引），用于需要数据库最新数据的请求
+    def query_devices(self, filters):
+        sql, params = build_device_query(filters)
+        devices_info = []
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(sql, params)
+            devices_info = [device_row_to_dict(row) for row in c.fetchall()]
         return devices_info
 
     def execute_command(self, device_id, command):
-        device = self.devices.get(device_id)
+        device = self._device(device_id)
         if device:
             if command == 'on':
-                device.turn_on()
-                logging.info(f"Executed {command} on {device.get_name()}")
+                with self.locks.for_key(device_id):
+                    changed = device.turn_on()
+                if changed:
+                    self._bump_version([device_id])
+                controller_logger.info('Executed %s on %s', command, device.get_name())
                 return True
             elif command == 'off':
-                device.turn_off()
-                logging.info(f"Executed {command} on {device.get_name()}")
+                with self.locks.for_key(device_id):
+                    changed = device.turn_off()
+                if changed:
+                    self._bump_version([device_id])
+                controller_logger.info('Executed %s on %s', command, device.get_name())
                 return True
             else:
-                logging.warning(f"Invalid command: {command}")
+                controller_logger.warning(f"Invalid command: {command}")
                 return False
         else:
-            logging.warning(f"Device {device_id} not found")
+            controller_logger.warning(f"Device {device_id} not found")
             return False
 
 
+# 把 datetime、ISO 格式字符串或 Unix 时间戳统一转换成 Unix 时间戳
+def parse_run_at(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+    raise ValueError(f"无法识别的时间： {value!r}")
+
+
+# cron 表达式的别名
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+}
+
+
+# 解析 cron 的一个字段，支持 *、列表、范围和步长，例如 */5、1-5、0,30
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"无效的步长： {field}")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"cron 字段超出范围： {field}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+# 五段式 cron 表达式：分 时 日 月 周（0 和 7 都表示周日）
+class CronSchedule:
+    def __init__(self, expression):
+        expression = CRON_ALIASES.get(expression.strip(), expression)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron 表达式需要 5 个字段： {expression}")
+        self.expression = expression
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        weekdays = parse_cron_field(fields[4], 0, 7)
+        self.weekdays = frozenset(d % 7 for d in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        # 和标准 cron 一样，日和周都有限制时满足其一即可
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    # 计算严格晚于 ts 的下一次触发时间（本地时间）
+    def next_after(self, ts):
+        dt = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+            if dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+                continue
+            return dt.timestamp()
+        raise ValueError(f"cron 表达式没有可触发的时间： {self.expression}")
+
+
+# 成千上万条规则通常共用少数几个表达式，解析结果缓存起来
+@lru_cache(maxsize=1024)
+def parse_cron(expression):
+    return CronSchedule(expression)
+
+
+# 定时任务调度器：任务持久化在 SQLite，内存里用最小堆按执行时间排序，由后台线程执行
+class TaskScheduler:
+    def __init__(self, controller, tick=1.0):
+        self.controller = controller
+        self.tick = tick
+        # 堆里放 (run_at, task_id)，取消的任务只从 _pending 删除，出堆时再跳过
+        self._heap = []
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    # 启动时把所有待执行任务从数据库装进堆；认领后进程退出、一直停在 running 的任务重新放回 pending
+    def load_pending(self):
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute('''
+                    UPDATE scheduled_tasks SET status = 'pending'
+                    WHERE status = 'running' AND executed_at < ?
+                ''', (time.time() - TASK_RUNNING_TIMEOUT,))
+                conn.commit()
+                c.execute("SELECT task_id, device_id, command, run_at FROM scheduled_tasks WHERE status = 'pending'")
+                rows = c.fetchall()
+        except sqlite3.Error as e:
+            scheduler_logger.error(f"加载定时任务出错： {e}")
+            return
+        with self._cond:
+            self._pending = {task_id: (run_at, device_id, command) for task_id, device_id, command, run_at in rows}
+            self._heap = [(run_at, task_id) for task_id, (run_at, _, _) in self._pending.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = False
+        self.load_pending()
+        self._thread = threading.Thread(target=self._run, name='task-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add(self, device_id, command, run_at):
+        run_at = parse_run_at(run_at)
+        task_id = None
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            task_id = self._insert_task(c, device_id, command, run_at)
+            conn.commit()
+        if task_id is not None:
+            self._push(task_id, device_id, command, run_at)
+        return task_id
+
+    @staticmethod
+    def _insert_task(c, device_id, command, run_at):
+        c.execute('''
+            INSERT INTO scheduled_tasks (device_id, command, run_at, status, created_at)
+            VALUES (?,?,?,'pending',?)
+        ''', (device_id, command, run_at, time.time()))
+        return c.lastrowid
+
+    # 批量创建周期规则，返回规则 id 列表
+    def add_recurring(self, device_ids, command, cron):
+        schedule = parse_cron(cron)
+        now = time.time()
+        next_fire = schedule.next_after(now)
+        rule_ids = []
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            for device_id in device_ids:
+                c.execute('''
+                    INSERT INTO recurring_schedules (device_id, command, cron, next_fire, enabled, created_at)
+                    VALUES (?,?,?,?,1,?)
+                ''', (device_id, command, schedule.expression, next_fire, now))
+                rule_ids.append(c.lastrowid)
+            conn.commit()
+        with self._cond:
+            self._cond.notify()
+        return rule_ids
+
+    def remove_recurring(self, rule_id):
+        removed = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('DELETE FROM recurring_schedules WHERE rule_id = ?', (rule_id,))
+            removed = c.rowcount == 1
+            conn.commit()
+        return removed
+
+    # 只读取已经到期的规则（走 next_fire 索引），为每条规则生成一次性任务并写回下次触发时间
+    def fire_recurring(self, now=None, batch_size=1000):
+        now = time.time() if now is None else now
+        created = []
+        while True:
+            try:
+                with get_db_connection() as conn:
+                    c = conn.cursor()
+                    c.execute('''
+                        SELECT rule_id, device_id, command, cron, next_fire FROM recurring_schedules
+                        WHERE enabled = 1 AND next_fire <= ? ORDER BY next_fire LIMIT ?
+                    ''', (now, batch_size))
+                    rules = c.fetchall()
+                    batch = []
+                    for rule_id, device_id, command, cron, next_fire in rules:
+                        # 停机期间错过的触发只补一次，下次时间从现在往后算
+                        following = parse_cron(cron).next_after(max(now, next_fire))
+                        c.execute('''
+                            UPDATE recurring_schedules SET next_fire = ?, last_fired = ?
+                            WHERE rule_id = ? AND next_fire = ?
+                        ''', (following, now, rule_id, next_fire))
+                        if c.rowcount == 1:
+                            task_id = self._insert_task(c, device_id, command, next_fire)
+                            batch.append((task_id, device_id, command, next_fire))
+                    conn.commit()
+            except (sqlite3.Error, ValueError) as e:
+                scheduler_logger.error(f"触发周期任务出错： {e}")
+                break
+            for task_id, device_id, command, run_at in batch:
+                self._push(task_id, device_id, command, run_at)
+            created.extend(batch)
+            if len(rules) < batch_size:
+                break
+        return len(created)
+
+    def _push(self, task_id, device_id, command, run_at):
+        with self._cond:
+            self._pending[task_id] = (run_at, device_id, command)
+            heapq.heappush(self._heap, (run_at, task_id))
+            # 新任务比堆顶更早时要唤醒后台线程重新计算等待时间
+            if self._heap[0][1] == task_id:
+                self._cond.notify()
+
+    def cancel(self, task_id):
+        cancelled = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE scheduled_tasks SET status = 'cancelled' WHERE task_id = ? AND status = 'pending'",
+                      (task_id,))
+            cancelled = c.rowcount == 1
+            conn.commit()
+        with self._cond:
+            if self._pending.pop(task_id, None) is not None:
+                # 取消的任务太多时重建堆，避免堆里堆积无效条目
+                if len(self._heap) > 2 * len(self._pending) + 1024:
+                    self._heap = [(run_at, tid) for tid, (run_at, _, _) in self._pending.items()]
+                    heapq.heapify(self._heap)
+        return cancelled
+
+    def pending_count(self):
+        return len(self._pending)
+
+    # 取出所有到期任务
+    def _pop_due(self, now):
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                run_at, task_id = heapq.heappop(self._heap)
+                task = self._pending.pop(task_id, None)
+                if task is not None:
+                    due.append((task_id, task[1], task[2], run_at))
+        return due
+
+    # 执行到期任务：同一轮到期的任务在一个事务里认领成 running，执行完再逐个记成 done 或 failed，
+    # 认领和执行之间进程退出时任务停在 running，不会被当成已经执行过
+    def run_due(self, now=None):
+        now = time.time() if now is None else now
+        due = self._pop_due(now)
+        if not due:
+            return 0
+        claimed = []
+        committed = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            for task_id, device_id, command, run_at in due:
+                # 多个进程同时运行调度器时，只有认领成功的进程执行任务
+                c.execute('''
+                    UPDATE scheduled_tasks SET status = 'running', executed_at = ?
+                    WHERE task_id = ? AND status = 'pending'
+                ''', (now, task_id))
+                if c.rowcount == 1:
+                    claimed.append((task_id, device_id, command))
+            conn.commit()
+            committed = True
+        if not committed:
+            # 认领失败时这些任务在数据库里还是 pending，放回堆里，下一个间隔再试
+            scheduler_logger.error(f"认领定时任务失败，{len(due)} 个任务稍后重试")
+            for task_id, device_id, command, run_at in due:
+                self._push(task_id, device_id, command, now + self.tick)
+            return 0
+
+        results = []
+        failed = 0
+        for task_id, device_id, command in claimed:
+            ok = self.controller.execute_command(device_id, command)
+            failed += not ok
+            results.append(('done' if ok else 'failed', time.time(), task_id))
+        committed = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.executemany('''
+                UPDATE scheduled_tasks SET status = ?, executed_at = ?
+                WHERE task_id = ? AND status = 'running'
+            ''', results)
+            conn.commit()
+            committed = True
+        if not committed:
+            scheduler_logger.error(f"记录定时任务结果失败，{len(results)} 个任务停在 running")
+        scheduler_logger.info(f"执行定时任务 {len(claimed)} 个，失败 {failed} 个")
+        return len(claimed)
+
+    def _run(self):
+        while True:
+            try:
+                self.fire_recurring()
+                self.run_due()
+            except Exception as e:
+                scheduler_logger.error(f"定时任务执行出错： {e}")
+            with self._cond:
+                if self._stopped:
+                    return
+                timeout = self.tick
+                if self._heap:
+                    timeout = max(0, min(timeout, self._heap[0][0] - time.time()))
+                self._cond.wait(timeout)
+                if self._stopped:
+                    return
+
+
+# 按固定间隔在后台线程里执行 work 的基类
+class PeriodicWorker(abc.ABC):
+    name = 'periodic-worker'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @abc.abstractmethod
+    def work(self):
+        pass
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.work()
+            except Exception as e:
+                controller_logger.error(f"{self.name} 执行出错： {e}")
+
+
+# 后台按固定间隔清理软删除的设备
+class DevicePurger(PeriodicWorker):
+    name = 'device-purger'
+
+    def __init__(self, controller, interval=PURGE_INTERVAL, batch_size=PURGE_BATCH_SIZE, grace=PURGE_GRACE_SECONDS,
+                 pause=0.05):
+        super().__init__(interval)
+        self.controller = controller
+        self.batch_size = batch_size
+        self.grace = grace
+        self.pause = pause
+
+    def work(self):
+        self.controller.purge_deleted(self.batch_size, self.grace, self.pause)
+
+
+# 后台按固定间隔写快照，恢复时最多重放一个间隔内的命令日志
+class SnapshotWriter(PeriodicWorker):
+    name = 'snapshot-writer'
+
+    def __init__(self, controller, interval=SNAPSHOT_INTERVAL, keep=SNAPSHOT_KEEP, snapshot_file=SNAPSHOT_FILE):
+        super().__init__(interval)
+        self.controller = controller
+        self.keep = keep
+        self.snapshot_file = snapshot_file
+
+    def work(self):
+        self.controller.take_snapshot(self.keep)
+        if self.snapshot_file:
+            self.controller.write_snapshot_file(self.snapshot_file)
+
+
+# 后台按固定间隔清理旧的变更日志，避免日志表和同步的开销无限增长
+class ChangeLogTrimmer(PeriodicWorker):
+    name = 'change-log-trimmer'
+
+    def __init__(self, controller, interval=CHANGE_LOG_TRIM_INTERVAL, keep=CHANGE_LOG_KEEP):
+        super().__init__(interval)
+        self.controller = controller
+        self.keep = keep
+
+    def work(self):
+        self.controller.trim_change_log(self.keep)
+
+
+# 后台按固定间隔检测能耗异常，接口直接返回最近一次的结果
+class AnomalyDetector(PeriodicWorker):
+    name = 'anomaly-detector'
+
+    def __init__(self, interval=ANOMALY_INTERVAL):
+        super().__init__(interval)
+        self.latest = None
+
+    def work(self):
+        self.latest = detect_energy_anomalies()
+        anomaly_devices.set(len(self.latest['anomalies']))
+        return self.latest
+
+
+# 异步命令分发器：同一设备的命令放在一条通道里按顺序执行，不同设备的命令由线程池并行执行
+class CommandDispatcher:
+    def __init__(self, controller, workers=4, max_finished=10000, max_queued=COMMAND_QUEUE_SIZE):
+        self.controller = controller
+        self.workers = workers
+        self.max_finished = max_finished
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        # 有命令等待执行、而且当前没有线程在处理的设备
+        self._ready = queue.Queue()
+        # device_id -> 等待执行的命令 id，设备在处理中时通道保留，保证同一设备串行
+        self._lanes = {}
+        self._commands = {}
+        self._finished = OrderedDict()
+        self._threads = []
+        self._queued = 0
+        self._stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'wait_seconds_sum': 0.0,
+            'wait_seconds_max': 0.0,
+            'exec_seconds_sum': 0.0,
+            'exec_seconds_max': 0.0
+        }
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'command-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # 提交命令，返回命令 id；排队的命令已经达到 max_queued 时抛出 queue.Full
+    def submit(self, device_id, command):
+        command_id = uuid.uuid4().hex
+        with self._lock:
+            if self._queued >= self.max_queued:
+                self._stats['rejected'] += 1
+                raise queue.Full
+            self._ensure_workers()
+            self._commands[command_id] = {
+                'command_id': command_id,
+                'device_id': device_id,
+                'command': command,
+                'status': 'queued',
+                'result': None,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None
+            }
+            self._queued += 1
+            self._stats['submitted'] += 1
+            lane = self._lanes.get(device_id)
+            if lane is None:
+                self._lanes[device_id] = deque([command_id])
+                self._ready.put(device_id)
+            else:
+                lane.append(command_id)
+        return command_id
+
+    def get(self, command_id):
+        with self._lock:
+            record = self._commands.get(command_id)
+            return dict(record) if record else None
+
+    def _worker(self):
+        while True:
+            device_id = self._ready.get()
+            with self._lock:
+                command_id = self._lanes[device_id].popleft()
+                record = self._commands[command_id]
+                record['status'] = 'running'
+                record['started_at'] = time.time()
+                self._queued -= 1
+            try:
+                result = self.controller.execute_command(device_id, record['command'])
+            except Exception as e:
+                dispatcher_logger.error(f"异步命令执行出错： {e}")
+                result = False
+            finished_at = time.time()
+            with self._lock:
+                record['status'] = 'succeeded' if result else 'failed'
+                record['result'] = result
+                record['finished_at'] = finished_at
+                self._record_timing(record)
+                self._finished[command_id] = True
+                while len(self._finished) > self.max_finished:
+                    old_id, _ = self._finished.popitem(last=False)
+                    self._commands.pop(old_id, None)
+                # 通道里还有命令就重新排队，否则释放通道
+                if self._lanes[device_id]:
+                    self._ready.put(device_id)
+                else:
+                    del self._lanes[device_id]
+
+    def _record_timing(self, record):
+        wait = record['started_at'] - record['submitted_at']
+        execution = record['finished_at'] - record['started_at']
+        stats = self._stats
+        stats['succeeded' if record['result'] else 'failed'] += 1
+        stats['wait_seconds_sum'] += wait
+        stats['wait_seconds_max'] = max(stats['wait_seconds_max'], wait)
+        stats['exec_seconds_sum'] += execution
+        stats['exec_seconds_max'] = max(stats['exec_seconds_max'], execution)
+
+    # 按平均执行时间估计排队的命令多久能执行完，作为 503 的 Retry-After
+    def retry_after(self):
+        with self._lock:
+            done = self._stats['succeeded'] + self._stats['failed']
+            average = self._stats['exec_seconds_sum'] / done if done else 0.0
+            return max(1, math.ceil(self._queued * average / max(self.workers, 1)))
+
+    # 队列深度、等待时间和执行时间
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = self._queued
+            stats['queue_size'] = self.max_queued
+            stats['active_lanes'] = len(self._lanes)
+            stats['workers'] = self.workers
+        done = stats['succeeded'] + stats['failed']
+        stats['wait_seconds_avg'] = stats['wait_seconds_sum'] / done if done else 0.0
+        stats['exec_seconds_avg'] = stats['exec_seconds_sum'] / done if done else 0.0
+        return stats
+
+
 class SmartHomeHub:
     _instance = None
+    _instance_lock = threading.Lock()
 
     def __new__(cls):
+        # 双重检查加锁，初始化完成后才发布实例，避免多个线程各自创建一个
         if cls._instance is None:
-            cls._instance = super(SmartHomeHub, cls).__new__(cls)
-            cls._instance.controller = DeviceController()
-            cls._instance.controller.load_devices_database()
+            with cls._instance_lock:
+                if cls._instance is None:
+                    instance = super(SmartHomeHub, cls).__new__(cls)
+                    instance.controller = DeviceController()
+                    instance.controller.restore()
+                    instance.scheduler = TaskScheduler(instance.controller)
+                    instance.dispatcher = CommandDispatcher(instance.controller)
+                    instance.purger = DevicePurger(instance.controller)
+                    instance.snapshotter = SnapshotWriter(instance.controller)
+                    instance.change_log_trimmer = ChangeLogTrimmer(instance.controller)
+                    instance.anomaly_detector = AnomalyDetector()
+                    cls._instance = instance
         return cls._instance
 
     def schedule_task(self, device_id, command, time):
-        logging.info(f"Task scheduled: {command} {device_id} at {time}")
+        task_id = self.scheduler.add(device_id, command, time)
+        scheduler_logger.info(f"Task scheduled: {command} {device_id} at {time}")
+        return task_id
+
+    # 周期任务：到期时由调度器通过 schedule_task 同样的方式生成一次性任务
+    def schedule_recurring(self, device_ids, command, cron):
+        rule_ids = self.scheduler.add_recurring(device_ids, command, cron)
+        scheduler_logger.info(f"Recurring task scheduled: {command} {len(rule_ids)} devices at '{cron}'")
+        return rule_ids
 
     def display_status(self):
         return self.controller.list_devices()
 
     def total_energy_usage(self):
-        return sum(device.get_energy_usage() for device in self.controller.devices.values())
+        return self.controller.snapshot().total_energy_usage()
+
+
+# 可替换的 JSON 序列化：有 orjson 时用 orjson，否则用标准库 json
+# 中文不转义成 \uXXXX，也不排序键，响应体更小；序列化耗时记在 serialization_seconds
+class SmartHomeJSONProvider(DefaultJSONProvider):
+    ensure_ascii = False
+    sort_keys = False
+
+    def __init__(self, app, backend=JSON_BACKEND):
+        super().__init__(app)
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'stdlib'
+        if backend == 'orjson' and orjson is None:
+            logging.getLogger('smarthome.json').warning("没有安装 orjson，改用标准库 json")
+            backend = 'stdlib'
+        self.backend = backend
+
+    # 直接序列化成 bytes，响应体不用先生成 str 再编码一次
+    def dumps_bytes(self, obj, indent=False):
+        start = time.perf_counter()
+        try:
+            if self.backend == 'orjson':
+                # datetime 交给 default 处理，和标准库、Flask 默认一样输出 RFC 822 格式，不用 orjson 自己的 ISO 8601
+                option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                          | (orjson.OPT_INDENT_2 if indent else 0))
+                return orjson.dumps(obj, default=self.default, option=option)
+            separators = None if indent else (',', ':')
+            return json.dumps(obj, default=self.default, ensure_ascii=False, sort_keys=self.sort_keys,
+                              indent=2 if indent else None, separators=separators).encode('utf-8')
+        finally:
+            serialization_seconds.observe(time.perf_counter() - start)
+
+    def dumps(self, obj, **kwargs):
+        if self.backend == 'orjson' and not kwargs:
+            return self.dumps_bytes(obj).decode('utf-8')
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            serialization_seconds.observe(time.perf_counter() - start)
+
+    def loads(self, s, **kwargs):
+        if self.backend == 'orjson' and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+# 按 Accept-Encoding 选择压缩方式，brotli 可用时优先，客户端不接受压缩时返回 None
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress_body(body, encoding):
+    start = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        # mtime 固定为 0，同样的内容压缩结果也一样
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    compression_seconds.observe(time.perf_counter() - start, (encoding,))
+    compression_bytes_total.inc((encoding, 'in'), len(body))
+    compression_bytes_total.inc((encoding, 'out'), len(compressed))
+    return compressed
+
+
+# 设备列表响应缓存：key 是 (查询参数, 编码)，value 是 (响应体, 实际使用的编码)
+# 只保存一个数据版本的结果，版本一变化整个缓存作废
+class ResponseCache:
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version:
+                return None
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, version, key, entry):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# 令牌桶限流：每个 key 一个桶，按 rate 每秒补充令牌、最多存 burst 个，每个请求消耗一个
+# 桶按最近使用顺序放在 OrderedDict 里，查找、更新和淘汰都是 O(1)；空的 key 不占内存，用完的桶过一段时间自动淘汰
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=RATE_LIMIT_MAX_KEYS, idle_seconds=RATE_LIMIT_IDLE_SECONDS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # 一个请求要同时通过 keys 里的每个桶（例如用户和 IP）：先检查所有桶，都有令牌时才各扣一个，
+    # 被拒绝的请求不消耗任何桶的令牌；允许时返回 (0, None)，否则返回 (还要等多少秒, 没有令牌的 key)
+    def acquire(self, keys, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            balances = []
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    tokens = self.burst
+                else:
+                    tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                    self._buckets.move_to_end(key)
+                balances.append((key, tokens))
+            wait, blocked = 0.0, None
+            for key, tokens in balances:
+                if tokens < 1 and (1 - tokens) / self.rate > wait:
+                    wait, blocked = (1 - tokens) / self.rate, key
+            for key, tokens in balances:
+                self._buckets[key] = [tokens if blocked is not None else tokens - 1, now]
+            # 最久没用的桶在最前面，空闲太久或超过上限就淘汰；被淘汰的桶已经补满，相当于没有限流记录
+            while self._buckets:
+                oldest_key, (_, last_seen) = next(iter(self._buckets.items()))
+                if len(self._buckets) <= self.max_keys and now - last_seen < self.idle_seconds:
+                    break
+                del self._buckets[oldest_key]
+            return wait, blocked
+
+
+# 有界的准入闸门：最多 capacity 个请求同时执行，最多 queue_size 个排队，排队最多等 timeout 秒
+# 用执行耗时的滑动平均估计还要等多久，作为 503 的 Retry-After
+class AdmissionGate:
+    def __init__(self, name, capacity, queue_size, timeout):
+        self.name = name
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._service_seconds = 0.0
+        self._cond = threading.Condition()
+
+    # 成功时返回进入时间，被拒绝时返回 None
+    def acquire(self):
+        start = time.perf_counter()
+        with self._cond:
+            if self.active >= self.capacity:
+                if self.waiting >= self.queue_size:
+                    return self._reject('queue_full')
+                self.waiting += 1
+                deadline = start + self.timeout
+                try:
+                    while self.active >= self.capacity:
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            return self._reject('timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+        admitted = time.perf_counter()
+        admission_wait_seconds.observe(admitted - start, (self.name,))
+        admission_total.inc((self.name, 'admitted'))
+        return admitted
+
+    # 调用方需要持有 _cond
+    def _reject(self, reason):
+        self.rejected += 1
+        admission_total.inc((self.name, reason))
+        return None
+
+    def release(self, admitted):
+        elapsed = time.perf_counter() - admitted
+        with self._cond:
+            self.active -= 1
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * elapsed if self._service_seconds else elapsed
+            self._cond.notify()
+
+    # 按当前排队长度估计多少秒之后再试
+    def retry_after(self):
+        with self._cond:
+            backlog = (self.waiting + self.active) / max(self.capacity, 1)
+            return max(1, math.ceil(backlog * self._service_seconds))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'capacity': self.capacity,
+                'queue_size': self.queue_size,
+                'rejected': self.rejected,
+                'service_seconds': round(self._service_seconds, 6),
+            }
+
+
+# 保存的响应；status 为 None 表示第一次请求还在处理
+StoredResponse = namedtuple('StoredResponse', ('fingerprint', 'status', 'headers', 'body', 'created_at'))
+
+
+# 幂等键存储：key 是 (用户, Idempotency-Key)，按创建顺序放在 OrderedDict 里，最旧的在最前面，
+# 过期或超过上限时从前面淘汰；persist 为 True 时由数据库的主键决定哪个请求先占到这个键
+class IdempotencyStore:
+    FULL = StoredResponse(None, None, None, None, 0.0)
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS, persist=IDEMPOTENCY_PERSIST,
+                 pending_timeout=IDEMPOTENCY_PENDING_TIMEOUT):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.persist = persist
+        self.pending_timeout = pending_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # 淘汰过期的键，并给新键留出一个位置，返回是否还有位置；调用方需要持有 _lock
+    # 处理中的键不会因为容量被淘汰，否则同一个键的重试会把请求再执行一遍
+    def _evict(self, now):
+        while self._entries:
+            scope, entry = next(iter(self._entries.items()))
+            if now - entry.created_at < self.ttl:
+                break
+            del self._entries[scope]
+        if len(self._entries) < self.max_keys:
+            return True
+        oldest = next((scope for scope, entry in self._entries.items() if entry.status is not None), None)
+        if oldest is None:
+            return False
+        del self._entries[oldest]
+        return True
+
+    # 占用这个键：返回 None 表示由当前请求处理，FULL 表示处理中的键已经占满了容量，否则返回已有的记录
+    # 数据库里占用失败时抛出 sqlite3.Error，这时不能处理请求
+    def begin(self, scope, fingerprint):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is None:
+                if not self._evict(now):
+                    return self.FULL
+            if entry is None and not self.persist:
+                self._entries[scope] = StoredResponse(fingerprint, None, None, None, now)
+                return None
+        if entry is None:
+            entry = self._claim(scope, fingerprint, now)
+            if entry is None or entry.status is not None:
+                with self._lock:
+                    self._entries[scope] = entry or StoredResponse(fingerprint, None, None, None, now)
+        return entry
+
+    # 在数据库里占用这个键；已有记录过期了，或者处理中太久没有结果，就重新占用
+    def _claim(self, scope, fingerprint, now):
+        row = None
+        committed = False
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            c.execute('''
+                SELECT fingerprint, status, headers, body, created_at FROM idempotency_keys
+                WHERE username = ? AND idempotency_key = ?
+            ''', scope)
+            row = c.fetchone()
+            if row is None or now - row[4] >= self.ttl or (row[1] is None and now - row[4] >= self.pending_timeout):
+                c.execute('''
+                    INSERT OR REPLACE INTO idempotency_keys
+                    (username, idempotency_key, fingerprint, status, headers, body, created_at)
+                    VALUES (?,?,?,NULL,NULL,NULL,?)
+                ''', scope + (fingerprint, now))
+                row = None
+            conn.commit()
+            committed = True
+        if not committed:
+            raise sqlite3.Error('在数据库里占用幂等键失败')
+        if row is None:
+            return None
+        return StoredResponse(row[0], row[1], decode_json(row[2]) if row[2] else None, row[3], row[4])
+
+    # 保存第一次的响应
+    def finish(self, scope, fingerprint, status, headers, body):
+        with self._lock:
+            previous = self._entries.get(scope)
+            created_at = previous.created_at if previous is not None else time.time()
+            self._entries[scope] = StoredResponse(fingerprint, status, headers, body, created_at)
+        if self.persist:
+            now = time.time()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute('''
+                    UPDATE idempotency_keys SET status = ?, headers = ?, body = ?
+                    WHERE username = ? AND idempotency_key = ?
+                ''', (status, encode_json(headers).decode('utf-8'), body) + scope)
+                # 过期记录顺带清理，不需要每次都做
+                if now - self._purged_at >= min(self.ttl, 60):
+                    self._purged_at = now
+                    c.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - self.ttl,))
+                conn.commit()
+
+    # 处理失败时放弃这个键，客户端可以用同一个键重试
+    def abandon(self, scope):
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is not None and entry.status is None:
+                del self._entries[scope]
+        if self.persist:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute('DELETE FROM idempotency_keys WHERE username = ? AND idempotency_key = ? AND status IS NULL',
+                          scope)
+                conn.commit()
+
+
+# 解析 SMARTHOME_RATE_LIMITS，返回 {接口类别: RateLimiter}，off 或空字符串时不限流
+def parse_rate_limits(spec):
+    limiters = {}
+    if spec.strip().lower() in ('', 'off', '0'):
+        return limiters
+    for item in spec.split(','):
+        route_class, _, limit = item.strip().partition('=')
+        rate, _, burst = limit.partition('/')
+        rate = float(rate)
+        if rate <= 0:
+            continue
+        limiters[route_class.strip()] = RateLimiter(rate, float(burst) if burst else max(rate, 1.0))
+    return limiters
+
+
+# 按接口类别、用户和 IP 检查限流，超出时返回 429 响应，否则返回 None
+def check_rate_limit(route_class, keys):
+    limiter = rate_limiters.get(route_class)
+    if limiter is None:
+        return None
+    wait, blocked = limiter.acquire([(scope, key) for scope, key in keys if key is not None])
+    if blocked is None:
+        return None
+    rate_limited_total.inc((route_class, blocked[0]))
+    retry_after = max(1, math.ceil(wait))
+    response = jsonify({'error': f"请求过于频繁，请 {retry_after} 秒后重试"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# 接口类别：SMARTHOME_RATE_LIMITS 里单独配置了这个 endpoint 时用 endpoint 名，否则 GET 是 read，其它方法是 command
+def rate_limit_class():
+    if request.endpoint in rate_limiters:
+        return request.endpoint
+    return 'read' if request.method in ('GET', 'HEAD') else 'command'
 
 
 app = Flask(__name__)
+app.json = SmartHomeJSONProvider(app)
+device_list_cache = ResponseCache()
+rate_limiters = parse_rate_limits(RATE_LIMITS)
+idempotency_store = IdempotencyStore()
+admission_gates = {
+    'read': AdmissionGate('read', READ_CONCURRENCY, READ_QUEUE, READ_QUEUE_TIMEOUT),
+    'write': AdmissionGate('write', WRITE_CONCURRENCY, WRITE_QUEUE, WRITE_QUEUE_TIMEOUT),
+}
 xjy_hub = SmartHomeHub()
 
+
+# 启动后台任务：定时任务调度、软删除清理、快照、变更日志清理和能耗异常检测
+# 每个服务进程都要调用一次，重复调用没有影响；直接运行本文件时在 __main__ 里调用，WSGI 部署时由 wsgi.py 调用
+def start_background_workers():
+    xjy_hub.scheduler.start()
+    xjy_hub.purger.start()
+    xjy_hub.snapshotter.start()
+    xjy_hub.change_log_trimmer.start()
+    xjy_hub.anomaly_detector.start()
+
+# 抓取时才计算的指标
+metrics.gauge('smarthome_devices', '控制器中的设备数', function=lambda: len(xjy_hub.controller.devices))
+metrics.gauge('smarthome_total_energy_kwh', '所有设备的总能耗', function=lambda: xjy_hub.total_energy_usage())
+metrics.gauge('smarthome_scheduled_tasks_pending', '等待执行的定时任务数',
+              function=lambda: xjy_hub.scheduler.pending_count())
+metrics.gauge('smarthome_command_queue', '异步命令队列状态', ('stat',),
+              function=lambda: {(key,): value for key, value in xjy_hub.dispatcher.metrics().items()})
+metrics.gauge('smarthome_admission', '准入闸门的状态', ('gate', 'stat'),
+              function=lambda: {(name, key): value for name, gate in admission_gates.items()
+                                for key, value in gate.stats().items()})
+metrics.gauge('smarthome_idempotency_keys', '内存中保存的幂等键数', function=lambda: len(idempotency_store))
+metrics.gauge('smarthome_rate_limit_keys', '限流正在跟踪的用户和 IP 数', ('route_class',),
+              function=lambda: {(route_class,): len(limiter) for route_class, limiter in rate_limiters.items()})
+
+
+# 给每个请求分配 request id，并记录开始时间，日志里会带上这两个信息
+@app.before_request
+def start_request():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+
+# 请求结束时记录一条访问日志（smarthome.access 默认不输出，需要时单独调成 INFO）
+@app.after_request
+def finish_request(response):
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+    endpoint = request.endpoint or 'unknown'
+    http_requests_total.inc((endpoint, request.method, str(response.status_code)))
+    started = g.get('request_started')
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, (endpoint,))
+    trace = g.get('sql_trace')
+    if trace is not None:
+        sql_queries_per_request.observe(trace.queries, (endpoint,))
+        # 调试模式下把本次请求的 SQL 统计放进响应头
+        if app.debug:
+            response.headers['X-SQL-Queries'] = str(trace.queries)
+            response.headers['X-SQL-Connections'] = str(trace.connections)
+            response.headers['X-SQL-Time-ms'] = f"{trace.seconds * 1000:.2f}"
+            response.headers['X-SQL-N-Plus-One'] = str(len(trace.n_plus_one))
+    if access_logger.isEnabledFor(logging.INFO):
+        access_logger.info('request finished', extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code
+        })
+    return response
+
+
+# 压缩其他较大的响应；设备列表已经在接口里压缩并缓存过，带 Content-Encoding 的直接跳过
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 304)):
+        return response
+    if not (response.mimetype == 'application/json' or response.mimetype.startswith('text/')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress_body(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# 每个请求前先同步其他 worker 写入的变更，保证多进程部署时读到的不是旧数据
+@app.before_request
+def sync_from_other_workers():
+    xjy_hub.controller.sync_changes()
+
 # 密钥，用于JWT签名和验证
 SECRET_KEY = "a_showiix_showiix_showiix_showiix_1234567890abcdef"
 
@@ -376,10 +2831,10 @@ def register_user(username, password):
             conn.commit()
             return True
     except sqlite3.IntegrityError:
-        logging.error(f"用户 {username} 已存在")
+        db_logger.error(f"用户 {username} 已存在")
         return False
     except sqlite3.Error as e:
-        logging.error(f"注册用户时出错： {e}")
+        db_logger.error(f"注册用户时出错： {e}")
         return False
 
 
@@ -388,8 +2843,17 @@ def register_user(username, password):
 def login():
     # 从数据库验证用户信息
     data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求体必须是 JSON 对象'}), 400
     username = data.get('username')
     password = data.get('password')
+    # 用户名和密码不是字符串时不可能登录成功，直接拒绝，也避免把列表之类的值当成限流的键
+    if not isinstance(username, str) or not isinstance(password, str):
+        return jsonify({'error': 'Invalid credentials'}), 401
+    # 按 IP 和用户名限制登录频率，防止暴力破解
+    limited = check_rate_limit('login', (('ip', request.remote_addr), ('user', username)))
+    if limited is not None:
+        return limited
 
     try:
         with get_db_connection() as conn:
@@ -407,7 +2871,7 @@ def login():
                     token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
                     return jsonify({'token': token})
     except sqlite3.Error as e:
-        logging.error(f"登录时查询数据库出错： {e}")
+        db_logger.error(f"登录时查询数据库出错： {e}")
 
     return jsonify({'error': 'Invalid credentials'}), 401
 
@@ -420,95 +2884,325 @@ def token_required(f):
             return jsonify({'error': 'Token is missing!'}), 401
         try:
             token = token.replace('Bearer ', '')
-            data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            start = time.perf_counter()
+            try:
+                data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            finally:
+                jwt_decode_seconds.observe(time.perf_counter() - start)
         except jwt.ExpiredSignatureError:
             return jsonify({'error': 'Token has expired!'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'error': 'Invalid token!'}), 401
+        g.user = data.get('user')
+        limited = check_rate_limit(rate_limit_class(), (('user', g.user), ('ip', request.remote_addr)))
+        if limited is not None:
+            return limited
         return f(*args, **kwargs)
     return decorated
 
 
+# 重放时带回的响应头
+IDEMPOTENT_HEADERS = ('Content-Type', 'Location')
+
+
+# 幂等键装饰器，放在 token_required 下面、admission_required 上面，重放的请求不占用写入容量
+# 同一个用户的同一个 Idempotency-Key 只执行一次，之后的重试直接返回第一次的响应；
+# 第一次还在处理时返回 409，键被用于另一个不同的请求时返回 422；5xx 和 429 不保存，可以用同一个键重试
+def idempotent(f):
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key 不能超过 255 个字符'}), 400
+        scope = (g.get('user') or '', key)
+        digest = hashlib.sha256(f"{request.method} {request.full_path}\n".encode('utf-8'))
+        digest.update(request.get_data())
+        fingerprint = digest.hexdigest()
+        try:
+            entry = idempotency_store.begin(scope, fingerprint)
+        except sqlite3.Error as e:
+            db_logger.error(f"占用幂等键时出错： {e}")
+            entry = IdempotencyStore.FULL
+        if entry is IdempotencyStore.FULL:
+            # 无法确认这个键没有被处理过，宁可让客户端稍后重试，也不冒重复执行的风险
+            idempotency_total.inc(('unavailable',))
+            response = jsonify({'error': '暂时无法处理带 Idempotency-Key 的请求，请稍后重试'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                idempotency_total.inc(('mismatch',))
+                return jsonify({'error': 'Idempotency-Key 已经用于另一个不同的请求'}), 422
+            if entry.status is None:
+                idempotency_total.inc(('in_progress',))
+                response = jsonify({'error': '相同 Idempotency-Key 的请求正在处理'})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            idempotency_total.inc(('replayed',))
+            response = Response(entry.body, status=entry.status, headers=entry.headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except Exception:
+            idempotency_store.abandon(scope)
+            raise
+        if response.status_code >= 500 or response.status_code == 429 or response.is_streamed:
+            idempotency_store.abandon(scope)
+        else:
+            idempotency_total.inc(('stored',))
+            headers = {name: response.headers[name] for name in IDEMPOTENT_HEADERS if name in response.headers}
+            idempotency_store.finish(scope, fingerprint, response.status_code, headers, response.get_data())
+        return response
+    return decorated
+
+
+# 准入控制装饰器，放在 token_required 下面；闸门满了直接返回 503，不让请求在线程里堆积
+def admission_required(gate_name):
+    def decorator(f):
+        def decorated(*args, **kwargs):
+            gate = admission_gates[gate_name]
+            admitted = gate.acquire()
+            if admitted is None:
+                retry_after = gate.retry_after()
+                response = jsonify({'error': f"服务器繁忙，请 {retry_after} 秒后重试"})
+                response.status_code = 503
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+            try:
+                return f(*args, **kwargs)
+            finally:
+                gate.release(admitted)
+        return decorated
+    return decorator
+
+
+# 准入闸门的状态，用来调整容量和队列长度
+@app.route('/admission/stats', methods=['GET'], endpoint='get_admission_stats')
+@token_required
+def get_admission_stats():
+    return jsonify({name: gate.stats() for name, gate in admission_gates.items()})
+
+
+# Prometheus 抓取接口
+@app.route('/metrics', methods=['GET'], endpoint='metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # api 1
 @app.route('/devices', methods=['GET'], endpoint='get_devices')
 @token_required
+@admission_required('read')
 def get_devices():
-    devices = xjy_hub.display_status()
-    return jsonify(devices)
+    # 支持 type、status、min_energy、max_energy、order_by(energy/name)、order(asc/desc)、limit
+    # fresh=1 时直接查数据库，否则在内存里筛选
+    try:
+        filters = parse_device_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f"查询参数错误：{e}"}), 400
+    if request.args.get('fresh') in ('1', 'true'):
+        return jsonify(xjy_hub.controller.query_devices(filters))
+    # 从读快照拼接每个设备的 JSON 片段，整个列表是同一时刻的状态；快照版本没变时直接返回上次压缩好的响应体
+    controller = xjy_hub.controller
+    fleet = controller.snapshot()
+    requested = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    # 控制器可能被整个替换（例如测试），版本里带上控制器本身
+    version = (id(controller), fleet.version)
+    key = (request.query_string, requested)
+    entry = device_list_cache.get(version, key)
+    response_cache_total.inc(('hit' if entry is not None else 'miss',))
+    if entry is None:
+        body = fleet.to_json(fleet.select(filters) if filters else None)
+        encoding = None
+        if requested is not None and len(body) >= COMPRESS_MIN_BYTES:
+            body = compress_body(body, requested)
+            encoding = requested
+        entry = (body, encoding)
+        device_list_cache.put(version, key, entry)
+    body, encoding = entry
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 
 # api 2
 @app.route('/devices/<device_id>', methods=['GET'], endpoint='get_device')
 @token_required
+@admission_required('read')
 def get_device(device_id):
-    device = xjy_hub.controller.devices.get(device_id)
-    if device:
-        device_dict = device.change_to_dict()
-        device_type = None
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT device_type FROM devices WHERE device_id = ?', (device.get_id(),))
-            result = c.fetchone()
-            if result:
-                device_type = result[0]
-        if device_type == 'light':
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('SELECT brightness FROM light_attributes WHERE device_id = ?', (device.get_id(),))
-                result = c.fetchone()
-                if result:
-                    device_dict['brightness'] = result[0]
-        elif device_type == 'thermostat':
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('SELECT temperature FROM thermostat_attributes WHERE device_id = ?', (device.get_id(),))
-                result = c.fetchone()
-                if result:
-                    device_dict['temperature'] = result[0]
-        elif device_type == 'camera':
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('SELECT resolution FROM camera_attributes WHERE device_id = ?', (device.get_id(),))
-                result = c.fetchone()
-                if result:
-                    device_dict['resolution'] = result[0]
-        return jsonify(device_dict)
+    fragment = xjy_hub.controller.device_json(device_id)
+    if fragment is not None:
+        return Response(fragment, mimetype='application/json')
     else:
         return jsonify({'error': f"设备{device_id}不存在"}), 404
 
 
+# api 2.1 修改设备属性，例如 {"brightness": 60}
+@app.route('/devices/<device_id>', methods=['PATCH'], endpoint='update_device')
+@token_required
+@admission_required('write')
+def update_device(device_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data:
+        return jsonify({'error': '请求体必须是包含属性的 JSON 对象'}), 400
+    try:
+        device = xjy_hub.controller.update_attributes(device_id, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if device is None:
+        return jsonify({'error': f"设备{device_id}不存在"}), 404
+    return jsonify(device.to_dict())
+
+
 # api 3
 @app.route('/devices/<device_id>/<command>', methods=['POST'], endpoint='execute_command')
 @token_required
+@idempotent
+@admission_required('write')
 def execute_command(device_id, command):
+    # ?async=1 或 Prefer: respond-async 时放进分发队列，立即返回 202
+    if request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', ''):
+        try:
+            command_id = xjy_hub.dispatcher.submit(device_id, command)
+        except queue.Full:
+            admission_total.inc(('async', 'queue_full'))
+            retry_after = xjy_hub.dispatcher.retry_after()
+            response = jsonify({'error': f"命令队列已满，请 {retry_after} 秒后重试"})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        response = jsonify({'command_id': command_id, 'status_url': f"/commands/{command_id}"})
+        response.headers['Location'] = f"/commands/{command_id}"
+        return response, 202
     result = xjy_hub.controller.execute_command(device_id, command)
     return jsonify({'message': f"命令{command}已发送给设备{device_id},结果为{result}"})
 
 
+# 查看异步命令的执行状态
+@app.route('/commands/<command_id>', methods=['GET'], endpoint='get_command')
+@token_required
+def get_command(command_id):
+    record = xjy_hub.dispatcher.get(command_id)
+    if record is None:
+        return jsonify({'error': f"命令{command_id}不存在"}), 404
+    return jsonify(record)
+
+
+# 异步命令队列的指标
+@app.route('/commands/stats', methods=['GET'], endpoint='get_command_stats')
+@token_required
+def get_command_stats():
+    return jsonify(xjy_hub.dispatcher.metrics())
+
+
 # api 4
 @app.route('/energy_usage', methods=['GET'], endpoint='get_total_energy_usage')
 @token_required
+@admission_required('read')
 def get_total_energy_usage():
     total_energy_usage = xjy_hub.total_energy_usage()
     return jsonify({'total_energy_usage': total_energy_usage})
 
 
+# api 4.1 上报能耗读数，{"device_id": "L1", "kwh": 0.5, "recorded_at": "2024-01-01T10:00:00"} 或它们的列表
+@app.route('/energy_usage/readings', methods=['POST'], endpoint='record_energy_readings')
+@token_required
+@admission_required('write')
+def record_energy_readings():
+    data = request.get_json(silent=True)
+    readings = data if isinstance(data, list) else [data]
+    parsed = []
+    for reading in readings:
+        if not isinstance(reading, dict):
+            return jsonify({'error': '读数必须是 JSON 对象'}), 400
+        device_id = reading.get('device_id')
+        if device_id not in xjy_hub.controller.devices:
+            return jsonify({'error': f"设备{device_id}不存在"}), 404
+        try:
+            kwh = float(reading.get('kwh'))
+            recorded_at = parse_run_at(reading['recorded_at']) if reading.get('recorded_at') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': '无效的能耗或时间'}), 400
+        if not 0 <= kwh < float('inf'):
+            return jsonify({'error': 'kwh 必须是不小于 0 的有限数'}), 400
+        parsed.append((device_id, kwh, recorded_at))
+    for device_id, kwh, recorded_at in parsed:
+        xjy_hub.controller.record_reading(device_id, kwh, recorded_at)
+    return jsonify({'recorded': len(parsed)}), 201
+
+
+# api 4.2 能耗历史：带 period(hour/day) 时返回序列，否则返回时间范围内的合计
+# scope=device/type，key 只看一个设备或类型，start/end 是 ISO 时间或 Unix 时间戳，默认最近一天
+@app.route('/energy_usage/history', methods=['GET'], endpoint='get_energy_history')
+@token_required
+@admission_required('read')
+def get_energy_history():
+    scope = request.args.get('scope', 'device')
+    period = request.args.get('period')
+    if scope not in ENERGY_ROLLUP_TABLES:
+        return jsonify({'error': f"不支持的 scope {scope}"}), 400
+    if period is not None and period not in ENERGY_PERIODS:
+        return jsonify({'error': f"不支持的 period {period}"}), 400
+    try:
+        end = parse_run_at(request.args['end']) if request.args.get('end') else time.time()
+        start = parse_run_at(request.args['start']) if request.args.get('start') else end - ENERGY_PERIODS['day']
+    except (TypeError, ValueError):
+        return jsonify({'error': '无效的时间范围'}), 400
+    if start >= end:
+        return jsonify({'error': 'start 必须早于 end'}), 400
+    key = request.args.get('key')
+    if period is not None:
+        return jsonify({'scope': scope, 'period': period, 'series': energy_series(scope, period, start, end, key)})
+    totals, segments = energy_totals(scope, start, end, key)
+    return jsonify({
+        'scope': scope,
+        'start': datetime.utcfromtimestamp(start).isoformat() + 'Z',
+        'end': datetime.utcfromtimestamp(end).isoformat() + 'Z',
+        'totals': totals,
+        'sources': [source for source, _, _ in segments]
+    })
+
+
+# api 4.3 能耗异常设备：默认返回后台最近一次检测的结果
+# 带 window_hours/baseline_windows/threshold 参数或 fresh=1 时按参数现场计算
+@app.route('/energy_usage/anomalies', methods=['GET'], endpoint='get_energy_anomalies')
+@token_required
+@admission_required('read')
+def get_energy_anomalies():
+    custom = any(name in request.args for name in ('window_hours', 'baseline_windows', 'threshold'))
+    try:
+        window_hours = int(request.args.get('window_hours', ANOMALY_WINDOW_HOURS))
+        baseline_windows = int(request.args.get('baseline_windows', ANOMALY_BASELINE_WINDOWS))
+        threshold = float(request.args.get('threshold', ANOMALY_THRESHOLD))
+    except ValueError:
+        return jsonify({'error': '无效的检测参数'}), 400
+    if not 1 <= window_hours <= 24 * 31 or not 1 <= baseline_windows <= 90 or not threshold > 0:
+        return jsonify({'error': '检测参数超出范围'}), 400
+    if custom:
+        return jsonify(detect_energy_anomalies(None, window_hours, baseline_windows, threshold))
+    if request.args.get('fresh') in ('1', 'true') or xjy_hub.anomaly_detector.latest is None:
+        return jsonify(xjy_hub.anomaly_detector.work())
+    return jsonify(xjy_hub.anomaly_detector.latest)
+
+
 # api 5
 @app.route('/devices', methods=['POST'], endpoint='add_device')
 @token_required
+@idempotent
+@admission_required('write')
 def add_device():
     data = request.get_json()
     device_id = data.get('id')
     device_name = data.get('name')
     device_type = data.get('type')
 
-    device_classes = {
-        'light': Light,
-        'thermostat': Thermostat,
-        'camera': Camera
-    }
-
-    if device_type in device_classes:
+    if device_type in devices_classes:
         kwargs = {}
         if device_type == 'light':
             kwargs['brightness'] = data.get('brightness', 100)
@@ -517,7 +3211,7 @@ def add_device():
         elif device_type == 'camera':
             kwargs['resolution'] = data.get('resolution', '1080p')
 
-        device = device_classes[device_type](device_id, device_name, **kwargs)
+        device = devices_classes[device_type](device_id, device_name, **kwargs)
         xjy_hub.controller.add_device(device)
         return jsonify({'message': f"设备{device_name}已添加到控制器"})
     else:
@@ -527,14 +3221,220 @@ def add_device():
 # api 6
 @app.route('/devices/<device_id>', methods=['DELETE'], endpoint='delete_device')
 @token_required
+@admission_required('write')
 def delete_device(device_id):
-    result = xjy_hub.controller.remove_device(device_id)
+    result = xjy_hub.controller.remove_device(device_id, soft=delete_is_soft())
     if result:
         return jsonify({'message': f"设备{device_id}已删除"}), 200
     else:
         return jsonify({'error': f"设备{device_id}不存在或删除失败"}), 404
 
 
+# ?soft=1 / ?soft=0 可以覆盖默认的删除方式
+def delete_is_soft():
+    soft = request.args.get('soft')
+    if soft is None:
+        return SOFT_DELETE
+    return soft in ('1', 'true')
+
+
+# api 6.1 批量删除设备，请求体 {"device_ids": [...]} 或 {"selector": {"type": ..., "status": ..., ...}}
+@app.route('/devices', methods=['DELETE'], endpoint='delete_devices')
+@token_required
+@admission_required('write')
+def delete_devices():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求体必须是 JSON 对象'}), 400
+    soft = delete_is_soft()
+    if data.get('device_ids'):
+        if not isinstance(data['device_ids'], list):
+            return jsonify({'error': 'device_ids 必须是列表'}), 400
+        removed = xjy_hub.controller.remove_devices(device_ids=[str(x) for x in data['device_ids']], soft=soft)
+    elif data.get('selector'):
+        try:
+            filters = parse_device_filters(data['selector'])
+        except (TypeError, ValueError, AttributeError) as e:
+            return jsonify({'error': f"selector 参数错误：{e}"}), 400
+        # 空的筛选条件会删掉所有设备，不允许
+        if not set(filters) & {'type', 'status', 'min_energy', 'max_energy'}:
+            return jsonify({'error': 'selector 至少需要 type、status、min_energy、max_energy 中的一个'}), 400
+        removed = xjy_hub.controller.remove_devices(filters=filters, soft=soft)
+    else:
+        return jsonify({'error': '需要 device_ids 或 selector'}), 400
+    if removed is None:
+        return jsonify({'error': '批量删除失败'}), 500
+    return jsonify({'deleted': removed, 'count': len(removed), 'soft': soft}), 200
+
+
+# 定时任务行转换成字典
+def task_row_to_dict(row):
+    task_id, device_id, command, run_at, status, created_at, executed_at = row
+    return {
+        'task_id': task_id,
+        'device_id': device_id,
+        'command': command,
+        'run_at': datetime.fromtimestamp(run_at).isoformat(),
+        'status': status,
+        'created_at': created_at,
+        'executed_at': executed_at
+    }
+
+
+# api 7 创建定时任务
+@app.route('/schedules', methods=['POST'], endpoint='create_schedule')
+@token_required
+def create_schedule():
+    data = request.get_json() or {}
+    device_id = data.get('device_id')
+    command = data.get('command')
+    if device_id not in xjy_hub.controller.devices:
+        return jsonify({'error': f"设备{device_id}不存在"}), 404
+    if command not in ('on', 'off'):
+        return jsonify({'error': f"不支持的命令{command}"}), 400
+    try:
+        if data.get('run_at') is not None:
+            run_at = parse_run_at(data['run_at'])
+        else:
+            run_at = time.time() + float(data.get('delay', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': '无效的执行时间'}), 400
+    task_id = xjy_hub.schedule_task(device_id, command, run_at)
+    if task_id is None:
+        return jsonify({'error': '定时任务保存失败'}), 500
+    return jsonify({'task_id': task_id, 'run_at': datetime.fromtimestamp(run_at).isoformat()}), 201
+
+
+# api 8 查看定时任务
+@app.route('/schedules', methods=['GET'], endpoint='list_schedules')
+@token_required
+def list_schedules():
+    status = request.args.get('status', 'pending')
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    tasks = []
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT task_id, device_id, command, run_at, status, created_at, executed_at
+            FROM scheduled_tasks WHERE status = ? ORDER BY run_at LIMIT ?
+        ''', (status, limit))
+        tasks = [task_row_to_dict(row) for row in c.fetchall()]
+    return jsonify({'pending': xjy_hub.scheduler.pending_count(), 'tasks': tasks})
+
+
+@app.route('/schedules/<int:task_id>', methods=['GET'], endpoint='get_schedule')
+@token_required
+def get_schedule(task_id):
+    row = None
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT task_id, device_id, command, run_at, status, created_at, executed_at
+            FROM scheduled_tasks WHERE task_id = ?
+        ''', (task_id,))
+        row = c.fetchone()
+    if row is None:
+        return jsonify({'error': f"定时任务{task_id}不存在"}), 404
+    return jsonify(task_row_to_dict(row))
+
+
+# api 9 取消定时任务
+@app.route('/schedules/<int:task_id>', methods=['DELETE'], endpoint='delete_schedule')
+@token_required
+def delete_schedule(task_id):
+    if xjy_hub.scheduler.cancel(task_id):
+        return jsonify({'message': f"定时任务{task_id}已取消"}), 200
+    return jsonify({'error': f"定时任务{task_id}不存在或已执行"}), 404
+
+
+# api 10 创建周期任务，例如 {"device_ids": ["L1", "L2"], "command": "off", "cron": "0 23 * * 1-5"}
+@app.route('/schedules/recurring', methods=['POST'], endpoint='create_recurring_schedule')
+@token_required
+def create_recurring_schedule():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求体必须是 JSON 对象'}), 400
+    device_ids = data.get('device_ids') if 'device_ids' in data else [data.get('device_id')]
+    if (not isinstance(device_ids, list) or not device_ids
+            or not all(isinstance(device_id, str) for device_id in device_ids)):
+        return jsonify({'error': 'device_ids 必须是非空的设备 id 字符串列表'}), 400
+    command = data.get('command')
+    missing = [device_id for device_id in device_ids if device_id not in xjy_hub.controller.devices]
+    if missing:
+        return jsonify({'error': f"设备{','.join(map(str, missing))}不存在"}), 404
+    if command not in ('on', 'off'):
+        return jsonify({'error': f"不支持的命令{command}"}), 400
+    try:
+        rule_ids = xjy_hub.schedule_recurring(device_ids, command, data.get('cron', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'rule_ids': rule_ids}), 201
+
+
+@app.route('/schedules/recurring', methods=['GET'], endpoint='list_recurring_schedules')
+@token_required
+def list_recurring_schedules():
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    rules = []
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT rule_id, device_id, command, cron, next_fire, last_fired FROM recurring_schedules
+            WHERE enabled = 1 ORDER BY next_fire LIMIT ?
+        ''', (limit,))
+        for rule_id, device_id, command, cron, next_fire, last_fired in c.fetchall():
+            rules.append({
+                'rule_id': rule_id,
+                'device_id': device_id,
+                'command': command,
+                'cron': cron,
+                'next_fire': datetime.fromtimestamp(next_fire).isoformat(),
+                'last_fired': last_fired
+            })
+    return jsonify(rules)
+
+
+@app.route('/schedules/recurring/<int:rule_id>', methods=['DELETE'], endpoint='delete_recurring_schedule')
+@token_required
+def delete_recurring_schedule(rule_id):
+    if xjy_hub.scheduler.remove_recurring(rule_id):
+        return jsonify({'message': f"周期任务{rule_id}已删除"}), 200
+    return jsonify({'error': f"周期任务{rule_id}不存在"}), 404
+
+
+# api 11 流式导出设备或能耗数据，?format=csv|ndjson，默认 csv
+@app.route('/export/<kind>', methods=['GET'], endpoint='export_data')
+@token_required
+def export_data(kind):
+    if kind not in EXPORT_COLUMNS:
+        return jsonify({'error': f"不支持导出{kind}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': f"不支持的格式{fmt}"}), 400
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(iter_export_chunks(kind, fmt), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+    return response
+
+
+# api 12 流式导入设备，请求体是 CSV 或 NDJSON（?format=csv|ndjson，默认看 Content-Type）
+@app.route('/import/devices', methods=['POST'], endpoint='import_devices')
+@token_required
+@admission_required('write')
+def import_devices():
+    fmt = request.args.get('format') or ('ndjson' if 'ndjson' in (request.content_type or '') else 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': f"不支持的格式{fmt}"}), 400
+    text_stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    result = import_device_records(iter_import_records(text_stream, fmt, decode_json))
+    # 部分导入也要同步到内存，响应里说明哪些行已经提交
+    xjy_hub.controller.sync_changes()
+    if not result['completed']:
+        result['error'] = f"导入失败：{result['failed']['error']}"
+        return jsonify(result), 400
+    return jsonify(result), 200
+
+
 if __name__ == "__main__":
     init_db()
     
@@ -564,5 +3464,6 @@ if __name__ == "__main__":
     insert_or_replace_device('T2', '二号温控器', 'off', 0.8, 'thermostat', temperature=30)
     insert_or_replace_device('T3', '三号温控器', 'off', 0.9, 'thermostat', temperature=40)
 
+    start_background_workers()
     app.run(debug=True)
     
\ No newline at end of file
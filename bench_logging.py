@@ -0,0 +1,89 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+# 基准测试用临时目录，必须在导入 api_oop_ten_jwt 之前设置
+tmp_dir = tempfile.mkdtemp(prefix='smarthome_bench_logging_')
+os.environ['SMARTHOME_DB'] = os.path.join(tmp_dir, 'bench.db')
+os.environ.setdefault('SMARTHOME_LOG_FILE', os.path.join(tmp_dir, 'app.log'))
+
+import api_oop_ten_jwt as api
+import smarthome_logging
+
+
+# 原来的做法：basicConfig 同步写文件，日志在请求线程里直接落盘
+def setup_sync_file(filename):
+    smarthome_logging.stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.FileHandler(filename, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    return handler
+
+
+# 模拟慢磁盘：每写一条日志多等 latency 秒
+def slow_down(handler, latency):
+    emit = handler.emit
+
+    def slow_emit(record):
+        time.sleep(latency)
+        emit(record)
+    handler.emit = slow_emit
+
+
+def build_controller(device_count):
+    api.init_db()
+    for i in range(device_count):
+        api.insert_or_replace_device(f'B{i}', f'基准灯{i}', 'off', 0.0, 'light', brightness=100)
+    controller = api.DeviceController()
+    controller.load_devices_database()
+    return controller
+
+
+# 热路径：execute_command，数据库写入替换成空操作，只剩下内存操作和日志开销
+def run_commands(controller, ops, device_count):
+    start = time.perf_counter()
+    for i in range(ops):
+        controller.execute_command(f'B{i % device_count}', 'on' if (i // device_count) % 2 == 0 else 'off')
+    return (time.perf_counter() - start) / ops * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='日志对命令热路径的开销')
+    parser.add_argument('--ops', type=int, default=50000)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--io-latency', type=float, default=0.0,
+                        help='模拟每条日志写文件的耗时（秒），看同步写和队列写对请求线程的影响')
+    args = parser.parse_args()
+
+    controller = build_controller(args.devices)
+    api.Device.update_db = lambda self, *a, **k: None
+    log_file = os.path.join(tmp_dir, 'bench.log')
+
+    # 每个配置返回写文件的 handler，用来模拟慢磁盘
+    configs = [
+        ('关闭 (ERROR 级别)', lambda: smarthome_logging.setup_logging(log_file, level=logging.ERROR).handlers[0]),
+        ('同步 FileHandler', lambda: setup_sync_file(log_file)),
+        ('队列 + 文本', lambda: smarthome_logging.setup_logging(log_file, level=logging.INFO,
+                                                             json_format=False).handlers[0]),
+        ('队列 + JSON', lambda: smarthome_logging.setup_logging(log_file, level=logging.INFO).handlers[0]),
+    ]
+    baseline = None
+    for name, setup in configs:
+        handler = setup()
+        if args.io_latency:
+            slow_down(handler, args.io_latency)
+        run_commands(controller, min(1000, args.ops), args.devices)
+        per_op = run_commands(controller, args.ops, args.devices)
+        baseline = baseline if baseline is not None else per_op
+        print(f"{name:<20} {per_op:8.2f} us/命令  日志开销 {per_op - baseline:+8.2f} us")
+    smarthome_logging.stop_logging()
+
+
+if __name__ == '__main__':
+    main()
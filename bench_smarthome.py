@@ -0,0 +1,237 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+# 基准测试使用临时数据库和日志文件，必须在导入 api_oop_ten_jwt 之前设置
+tmp_dir = tempfile.mkdtemp(prefix='smarthome_bench_')
+os.environ['SMARTHOME_DB'] = os.path.join(tmp_dir, 'import.db')
+os.environ.setdefault('SMARTHOME_LOG_FILE', os.path.join(tmp_dir, 'app.log'))
+# 基准测试会在短时间内发大量请求，不做限流
+os.environ.setdefault('SMARTHOME_RATE_LIMITS', 'off')
+
+import api_oop_ten_jwt as api
+
+DEVICE_TYPES = ('light', 'thermostat', 'camera')
+# 设备名和真实数据一样用中文，序列化测试才能反映转义的开销
+DEVICE_NAMES = {'light': '灯', 'thermostat': '温控器', 'camera': '相机'}
+RESOLUTIONS = ('720p', '1080p', '2K', '4K')
+
+
+# 直接批量写入合成设备，不经过设备类的构造函数，生成大规模设备也很快
+def populate_fleet(size, seed=42):
+    rnd = random.Random(seed)
+    devices = []
+    for i in range(size):
+        device_type = DEVICE_TYPES[i % 3]
+        device_id = f'{device_type[0].upper()}{i}'
+        status = 'on' if rnd.random() < 0.3 else 'off'
+        brightness = rnd.randint(10, 100) if device_type == 'light' else None
+        temperature = rnd.randint(16, 28) if device_type == 'thermostat' else None
+        resolution = rnd.choice(RESOLUTIONS) if device_type == 'camera' else None
+        devices.append((device_id, f'{DEVICE_NAMES[device_type]}{i}', status, round(rnd.uniform(0, 50), 3), device_type,
+                        brightness, temperature, resolution))
+    with api.get_db_connection() as conn:
+        c = conn.cursor()
+        c.executemany('''
+            INSERT OR REPLACE INTO devices
+            (device_id, name, status, energy_usage, device_type, brightness, temperature, resolution)
+            VALUES (?,?,?,?,?,?,?,?)
+        ''', devices)
+        conn.commit()
+    return [row[0] for row in devices]
+
+
+# 每个规模使用一个全新的数据库
+def fresh_database(size):
+    api.db_name = os.path.join(tmp_dir, f'fleet_{size}.db')
+    if os.path.exists(api.db_name):
+        os.remove(api.db_name)
+    api.init_db()
+    api.register_user('bench', 'bench')
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return {'median': statistics.median(samples), 'min': min(samples), 'samples': len(samples)}
+
+
+def bench_size(size, repeat, request_count):
+    results = {}
+    fresh_database(size)
+    device_ids = populate_fleet(size)
+
+    def load():
+        controller = api.DeviceController()
+        controller.load_devices_database()
+        return controller
+    results['startup_load_devices_s'] = timed(load, repeat)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    controller = load()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    results['memory_per_device_bytes'] = {'median': allocated / size, 'min': allocated / size, 'samples': 1}
+
+    api.xjy_hub.controller = controller
+    results['list_devices_s'] = timed(controller.list_devices, repeat)
+    results.update(bench_serialization(controller.list_devices(), repeat))
+    results.update(bench_compression(controller.snapshot().to_json(), repeat))
+
+    rnd = random.Random(7)
+    sample_ids = [rnd.choice(device_ids) for _ in range(200)]
+
+    def single_commands():
+        for i, device_id in enumerate(sample_ids):
+            controller.execute_command(device_id, 'on' if i % 2 == 0 else 'off')
+    single = timed(single_commands, repeat)
+    results['single_command_s'] = {key: value / len(sample_ids) if key != 'samples' else value
+                                   for key, value in single.items()}
+
+    bulk_ids = device_ids[:min(size, 2000)]
+    state = {'command': 'on'}
+
+    def bulk_commands():
+        for device_id in bulk_ids:
+            controller.execute_command(device_id, state['command'])
+        state['command'] = 'off' if state['command'] == 'on' else 'on'
+    results[f'bulk_command_{len(bulk_ids)}_s'] = timed(bulk_commands, repeat)
+
+    client = api.app.test_client()
+    token = client.post('/login', json={'username': 'bench', 'password': 'bench'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def energy_requests():
+        for _ in range(request_count):
+            response = client.get('/energy_usage', headers=headers)
+            assert response.status_code == 200
+    energy = timed(energy_requests, repeat)
+    results['http_energy_usage_s'] = {key: value / request_count if key != 'samples' else value
+                                      for key, value in energy.items()}
+
+    def device_requests():
+        for device_id in sample_ids[:request_count]:
+            response = client.get(f'/devices/{device_id}', headers=headers)
+            assert response.status_code == 200
+    per_device = timed(device_requests, repeat)
+    count = len(sample_ids[:request_count])
+    results['http_get_device_s'] = {key: value / count if key != 'samples' else value
+                                    for key, value in per_device.items()}
+
+    def list_request():
+        response = client.get('/devices', headers=headers)
+        assert response.status_code == 200
+    results['http_list_devices_s'] = timed(list_request, repeat)
+
+    # 设备没有变化时重复轮询，命中压缩响应缓存
+    gzip_headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+
+    def gzip_list_request():
+        response = client.get('/devices', headers=gzip_headers)
+        assert response.status_code == 200
+    results['http_list_devices_gzip_s'] = timed(gzip_list_request, repeat)
+    return results
+
+
+# 同一份设备列表分别用 Flask 默认的 JSON 和 SmartHomeJSONProvider 的各个后端生成响应，比较耗时和字节数
+def bench_serialization(payload, repeat):
+    providers = {'flask_default': DefaultJSONProvider(api.app)}
+    providers['stdlib'] = api.SmartHomeJSONProvider(api.app, 'stdlib')
+    if api.orjson is not None:
+        providers['orjson'] = api.SmartHomeJSONProvider(api.app, 'orjson')
+    results = {}
+    for name, provider in providers.items():
+        results[f'json_{name}_s'] = timed(lambda: provider.response(payload), repeat)
+        size = len(provider.response(payload).get_data())
+        results[f'json_{name}_bytes'] = {'median': size, 'min': size, 'samples': 1}
+    return results
+
+
+# 设备列表响应体在不同压缩级别下的耗时和压缩后字节数
+def bench_compression(body, repeat):
+    results = {}
+    levels = [('gzip1', lambda: gzip.compress(body, compresslevel=1, mtime=0)),
+              ('gzip6', lambda: gzip.compress(body, compresslevel=6, mtime=0)),
+              ('gzip9', lambda: gzip.compress(body, compresslevel=9, mtime=0))]
+    if api.brotli is not None:
+        levels += [('br5', lambda: api.brotli.compress(body, quality=5)),
+                   ('br11', lambda: api.brotli.compress(body, quality=11))]
+    for name, compress in levels:
+        results[f'compress_{name}_s'] = timed(compress, repeat)
+        size = len(compress())
+        results[f'compress_{name}_bytes'] = {'median': size, 'min': size, 'samples': 1}
+    return results
+
+
+# 和基线比较，中位数变慢超过阈值的记为回归
+def compare(current, baseline, threshold):
+    regressions = []
+    for size, metrics in current['results'].items():
+        for name, value in metrics.items():
+            old = baseline.get('results', {}).get(size, {}).get(name)
+            if not old or not old.get('median'):
+                continue
+            ratio = value['median'] / old['median']
+            flag = 'REGRESSION' if ratio > 1 + threshold else ('faster' if ratio < 1 - threshold else '')
+            print(f"{size:>7} {name:<32} {old['median']:12.6f} -> {value['median']:12.6f}  x{ratio:5.2f} {flag}")
+            if flag == 'REGRESSION':
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='智能家居 API 和 DeviceController 基准测试')
+    parser.add_argument('--sizes', default='1000,10000', help='设备规模，逗号分隔，例如 1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=100, help='每轮 HTTP 请求数')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='基线结果 JSON，和本次结果比较')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定回归的变慢比例')
+    args = parser.parse_args()
+
+    current = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat
+        },
+        'results': {}
+    }
+    for size in [int(x) for x in args.sizes.split(',')]:
+        print(f"规模 {size} ...", flush=True)
+        current['results'][str(size)] = bench_size(size, args.repeat, args.requests)
+        for name, value in current['results'][str(size)].items():
+            print(f"    {name:<32} {value['median']:.6f}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"发现 {len(regressions)} 项性能回归")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+import smarthome_schema as schema
+
+
+# 根据文件扩展名推断格式
+def guess_format(path, default='csv'):
+    if path and path.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return default
+
+
+def cmd_export(conn, args):
+    fmt = args.format or guess_format(args.out)
+    out = sys.stdout if args.out == '-' else open(args.out, 'w', encoding='utf-8', newline='')
+    stats = {}
+    try:
+        pages = schema.iter_export_rows(conn, args.kind, args.batch_size)
+        for chunk in schema.encode_export_chunks(args.kind, fmt, pages, stats):
+            out.write(chunk)
+    except sqlite3.Error as e:
+        print(f"导出失败： {e}", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    rows, elapsed = stats['rows'], stats['seconds']
+    print(f"导出 {args.kind} {rows} 行，{elapsed:.3f} 秒，{rows / elapsed if elapsed > 0 else 0:.0f} 行/秒", file=sys.stderr)
+    return 0
+
+
+def cmd_import(conn, args):
+    fmt = args.format or guess_format(args.file)
+    source = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8', newline='')
+    try:
+        result = schema.upsert_device_records(conn, schema.iter_import_records(source, fmt), args.chunk_size)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    print(f"导入 {result['imported']} 行，跳过 {result['rejected']} 行，{result['seconds']:.3f} 秒，"
+          f"{result['rows_per_second']} 行/秒", file=sys.stderr)
+    for error in result['errors'][:20]:
+        print(f"  第 {error['line']} 行: {error['error']}", file=sys.stderr)
+    if not result['completed']:
+        failed = result['failed']
+        print(f"导入中断：第 {failed['first_line']}-{failed['last_line'] or '?'} 行没有提交（{failed['error']}），"
+              f"第 {result['applied_through_line']} 行及之前的有效行已经提交", file=sys.stderr)
+        return 1
+    return 1 if result['rejected'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='智能家居数据流式导出/导入工具')
+    parser.add_argument('--db', default=os.environ.get('SMARTHOME_DB', 'xjy_smarthome.db'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='导出设备或能耗数据')
+    export_parser.add_argument('kind', choices=('devices', 'energy'))
+    export_parser.add_argument('--out', default='-', help='输出文件，- 表示标准输出')
+    export_parser.add_argument('--format', choices=('csv', 'ndjson'), help='默认按扩展名推断，否则 csv')
+    export_parser.add_argument('--batch-size', type=int, default=1000)
+    import_parser = subparsers.add_parser('import', help='导入设备')
+    import_parser.add_argument('file', help='输入文件，- 表示标准输入')
+    import_parser.add_argument('--format', choices=('csv', 'ndjson'), help='默认按扩展名推断，否则 csv')
+    import_parser.add_argument('--chunk-size', type=int, default=1000, help='每个事务写入的行数')
+    args = parser.parse_args()
+
+    # 只用 smarthome_schema 和 sqlite 连接，不导入 api_oop_ten_jwt：导入应用会创建 SmartHomeHub 并加载全部设备，
+    # 导出导入本身只需要按主键分页读表、分批写表；正在运行的服务通过变更日志同步导入的设备
+    try:
+        schema.migrate(args.db)
+    except sqlite3.Error as e:
+        print(f"数据库迁移失败： {e}", file=sys.stderr)
+        return 1
+    with closing(sqlite3.connect(args.db)) as conn:
+        if args.command == 'export':
+            return cmd_export(conn, args)
+        return cmd_import(conn, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
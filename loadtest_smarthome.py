@@ -0,0 +1,348 @@
+import argparse
+import http.client
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# 只允许压测本机上的实例。压测只用一个用户、一个 token、一个 IP，服务端打开了按用户/按 IP 限流时会把大部分
+# 请求挡成 429，被压测的实例不要设置 SMARTHOME_RATE_LIMITS（默认 off）；429 会单独计数，出现时报告里会提示
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+ROOMS = ('客厅', '卧室', '书房', '厨房', '餐厅', '走廊', '阳台', '车库')
+RESOLUTIONS = (('720p', 0.2), ('1080p', 0.5), ('2K', 0.2), ('4K', 0.1))
+
+# 闭环压测的默认请求比例
+DEFAULT_MIX = {
+    'poll_devices': 35,
+    'poll_energy': 20,
+    'get_device': 10,
+    'command': 30,
+    'provision': 3,
+    'login': 2
+}
+
+
+def weighted_choice(rnd, weighted):
+    total = sum(weight for _, weight in weighted)
+    point = rnd.random() * total
+    for value, weight in weighted:
+        point -= weight
+        if point <= 0:
+            return value
+    return weighted[-1][0]
+
+
+# 生成设备：灯最多，其次是恒温器和摄像头，属性按常见取值分布
+def generate_fleet(size, seed=1):
+    rnd = random.Random(seed)
+    fleet = []
+    for i in range(size):
+        device_type = weighted_choice(rnd, (('light', 0.6), ('thermostat', 0.25), ('camera', 0.15)))
+        room = rnd.choice(ROOMS)
+        device = {'id': f'{device_type[0].upper()}{seed}-{i}', 'type': device_type}
+        if device_type == 'light':
+            device['name'] = f'{room}灯{i}'
+            device['brightness'] = rnd.choice((30, 50, 80, 100))
+        elif device_type == 'thermostat':
+            device['name'] = f'{room}温控器{i}'
+            device['temperature'] = rnd.randint(18, 26)
+        else:
+            device['name'] = f'{room}摄像头{i}'
+            device['resolution'] = weighted_choice(rnd, RESOLUTIONS)
+        fleet.append(device)
+    return fleet
+
+
+# 生成负载轨迹：开头的登录风暴、持续的仪表盘轮询、随机出现的开关命令突发和少量新设备接入
+def generate_trace(fleet, duration, users, poll_interval, bursts, burst_size, provision, seed=1):
+    rnd = random.Random(seed)
+    device_ids = [device['id'] for device in fleet]
+    events = []
+    for _ in range(users):
+        events.append({'t': rnd.uniform(0, 2), 'op': 'login'})
+    for user in range(users):
+        t = rnd.uniform(0, poll_interval)
+        while t < duration:
+            events.append({'t': t, 'op': 'poll_devices'})
+            events.append({'t': t + 0.05, 'op': 'poll_energy'})
+            t += poll_interval * rnd.uniform(0.8, 1.2)
+    for _ in range(bursts):
+        start = rnd.uniform(0, duration)
+        for _ in range(burst_size):
+            events.append({'t': start + rnd.expovariate(50), 'op': 'command',
+                           'device_id': rnd.choice(device_ids), 'command': rnd.choice(('on', 'off'))})
+    for device in generate_fleet(provision, seed=seed + 1000):
+        events.append({'t': rnd.uniform(0, duration), 'op': 'provision', 'device': device})
+    events.sort(key=lambda event: event['t'])
+    return events
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+# 每个线程一个 HTTP 连接，服务端关闭连接时自动重连
+class Client:
+    def __init__(self, base_url, username, password):
+        parts = urlsplit(base_url)
+        if parts.hostname not in LOCAL_HOSTS:
+            raise SystemExit(f"只允许压测本机地址，当前是 {parts.hostname}")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.username = username
+        self.password = password
+        self.local = threading.local()
+        self.token = None
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return conn
+
+    def request(self, method, path, body=None, auth=True):
+        headers = {'Content-Type': 'application/json'}
+        if auth and self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+                    conn.close()
+                    self.local.conn = None
+                return response.status, data
+            except (http.client.HTTPException, ConnectionError, OSError):
+                conn.close()
+                self.local.conn = None
+                if attempt == 1:
+                    raise
+
+    def login(self):
+        status, data = self.request('POST', '/login', {'username': self.username, 'password': self.password},
+                                    auth=False)
+        if status == 200:
+            self.token = json.loads(data)['token']
+        return status
+
+
+# 把一个操作转换成 (统计名称, 方法, 路径, 请求体)
+def build_request(event, rnd, device_ids):
+    op = event['op']
+    if op == 'login':
+        return 'POST /login', None
+    if op == 'poll_devices':
+        return 'GET /devices', ('GET', '/devices', None)
+    if op == 'poll_energy':
+        return 'GET /energy_usage', ('GET', '/energy_usage', None)
+    if op == 'get_device':
+        device_id = event.get('device_id') or rnd.choice(device_ids)
+        return 'GET /devices/<id>', ('GET', f'/devices/{device_id}', None)
+    if op == 'command':
+        device_id = event.get('device_id') or rnd.choice(device_ids)
+        command = event.get('command') or rnd.choice(('on', 'off'))
+        return 'POST /devices/<id>/<command>', ('POST', f'/devices/{device_id}/{command}', None)
+    if op == 'provision':
+        device = event.get('device') or generate_fleet(1, seed=rnd.randrange(1 << 30))[0]
+        return 'POST /devices', ('POST', '/devices', device)
+    raise ValueError(f"未知操作 {op}")
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.limited = defaultdict(int)
+
+    def record(self, name, latency, status):
+        with self.lock:
+            self.latencies[name].append(latency)
+            if status == 429:
+                self.limited[name] += 1
+            elif status is None or status >= 400:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        print(f"{'endpoint':<30} {'count':>7} {'err':>5} {'429':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        total = 0
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            total += len(values)
+            print(f"{name:<30} {len(values):>7} {self.errors[name]:>5} {self.limited[name]:>5} "
+                  f"{len(values) / elapsed:>8.1f} "
+                  f"{percentile(values, 50) * 1000:>8.2f} {percentile(values, 95) * 1000:>8.2f} "
+                  f"{percentile(values, 99) * 1000:>8.2f}")
+        print(f"合计 {total} 个请求，{elapsed:.1f} 秒，{total / elapsed:.1f} req/s")
+        limited = sum(self.limited.values())
+        if limited:
+            print(f"警告：{limited} 个请求被限流（429），结果不能反映服务端容量，"
+                  "请用 SMARTHOME_RATE_LIMITS=off 启动被压测的实例")
+
+
+def execute(client, recorder, event, rnd, device_ids, scheduled=None):
+    name, spec = build_request(event, rnd, device_ids)
+    start = time.perf_counter()
+    try:
+        if spec is None:
+            status = client.login()
+        else:
+            status, _ = client.request(*spec)
+    except Exception:
+        status = None
+    # 开环模式从计划发送时间开始算延迟，避免排队时间被漏掉
+    recorder.record(name, time.perf_counter() - (scheduled if scheduled is not None else start), status)
+
+
+def run_closed_loop(client, recorder, concurrency, duration, mix, device_ids, seed):
+    deadline = time.perf_counter() + duration
+    weighted = list(mix.items())
+
+    def worker(index):
+        rnd = random.Random(seed + index)
+        while time.perf_counter() < deadline:
+            execute(client, recorder, {'op': weighted_choice(rnd, weighted)}, rnd, device_ids)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# 开环：按计划时间发送，不等上一个请求返回；rate 模式用泊松到达，trace 模式按轨迹时间
+def run_open_loop(client, recorder, events, device_ids, max_workers, seed):
+    rnd = random.Random(seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for event in events:
+            scheduled = start + event['t']
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(execute, client, recorder, event, random.Random(rnd.random()), device_ids, scheduled)
+
+
+def poisson_events(rate, duration, mix, seed):
+    rnd = random.Random(seed)
+    weighted = list(mix.items())
+    events, t = [], 0.0
+    while True:
+        t += rnd.expovariate(rate)
+        if t >= duration:
+            return events
+        events.append({'t': t, 'op': weighted_choice(rnd, weighted)})
+
+
+def fetch_device_ids(client):
+    status, data = client.request('GET', '/devices')
+    if status == 429:
+        raise SystemExit('获取设备列表被限流，请用 SMARTHOME_RATE_LIMITS=off 启动被压测的实例')
+    if status != 200:
+        raise SystemExit(f"获取设备列表失败：HTTP {status}")
+    return [device['device_id'] for device in json.loads(data)] or ['L1']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='智能家居 API 负载测试工具（仅限本机）')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    fleet_parser = sub.add_parser('fleet', help='生成设备，写入文件或通过 POST /devices 接入')
+    fleet_parser.add_argument('--size', type=int, default=1000)
+    fleet_parser.add_argument('--seed', type=int, default=1)
+    fleet_parser.add_argument('--output', help='写入 NDJSON 文件，不指定则调用接口接入')
+
+    trace_parser = sub.add_parser('trace', help='生成负载轨迹 NDJSON')
+    trace_parser.add_argument('--fleet-size', type=int, default=1000)
+    trace_parser.add_argument('--duration', type=float, default=60)
+    trace_parser.add_argument('--users', type=int, default=50)
+    trace_parser.add_argument('--poll-interval', type=float, default=5)
+    trace_parser.add_argument('--bursts', type=int, default=5)
+    trace_parser.add_argument('--burst-size', type=int, default=200)
+    trace_parser.add_argument('--provision', type=int, default=20)
+    trace_parser.add_argument('--seed', type=int, default=1)
+    trace_parser.add_argument('--output', required=True)
+
+    run_parser = sub.add_parser('run', help='对本机实例施加负载并统计延迟（实例需用 SMARTHOME_RATE_LIMITS=off 启动）')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='闭环模式的并发数')
+    run_parser.add_argument('--rate', type=float, help='开环模式的每秒请求数（泊松到达）')
+    run_parser.add_argument('--trace', help='按轨迹文件回放（开环）')
+    run_parser.add_argument('--speed', type=float, default=1.0, help='轨迹回放倍速')
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--max-workers', type=int, default=64)
+    run_parser.add_argument('--mix', help='请求比例，例如 poll_devices=50,command=50')
+    run_parser.add_argument('--seed', type=int, default=1)
+
+    for p in (fleet_parser, run_parser):
+        p.add_argument('--url', default='http://127.0.0.1:5000')
+        p.add_argument('--user', default='showiix')
+        p.add_argument('--password', default='aa1312134353')
+    args = parser.parse_args()
+
+    if args.cmd == 'trace':
+        fleet = generate_fleet(args.fleet_size, args.seed)
+        events = generate_trace(fleet, args.duration, args.users, args.poll_interval, args.bursts,
+                                args.burst_size, args.provision, args.seed)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+        print(f"已写入 {len(events)} 个事件到 {args.output}")
+        return
+
+    client = Client(args.url, args.user, args.password)
+    status = client.login()
+    if status == 429:
+        raise SystemExit('登录被限流，请用 SMARTHOME_RATE_LIMITS=off 启动被压测的实例')
+    if status != 200:
+        raise SystemExit('登录失败，请检查用户名和密码')
+
+    if args.cmd == 'fleet':
+        fleet = generate_fleet(args.size, args.seed)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                for device in fleet:
+                    f.write(json.dumps(device, ensure_ascii=False) + '\n')
+            print(f"已写入 {len(fleet)} 个设备到 {args.output}")
+            return
+        recorder = Recorder()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for device in fleet:
+                pool.submit(execute, client, recorder, {'op': 'provision', 'device': device}, None, [])
+        recorder.report(time.perf_counter() - start)
+        return
+
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        mix = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    device_ids = fetch_device_ids(client)
+    recorder = Recorder()
+    start = time.perf_counter()
+    if args.trace:
+        with open(args.trace, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        for event in events:
+            event['t'] /= args.speed
+        run_open_loop(client, recorder, events, device_ids, args.max_workers, args.seed)
+    elif args.rate:
+        run_open_loop(client, recorder, poisson_events(args.rate, args.duration, mix, args.seed), device_ids,
+                      args.max_workers, args.seed)
+    else:
+        run_closed_loop(client, recorder, args.concurrency, args.duration, mix, device_ids, args.seed)
+    recorder.report(time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
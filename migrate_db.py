@@ -0,0 +1,72 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+
+import smarthome_schema as schema
+
+
+def main():
+    parser = argparse.ArgumentParser(description='智能家居数据库结构迁移工具')
+    parser.add_argument('--db', default=os.environ.get('SMARTHOME_DB', 'xjy_smarthome.db'))
+    parser.add_argument('--to', type=int, help='迁移到指定版本，默认最新版本')
+    parser.add_argument('--status', action='store_true', help='只显示当前版本和待执行的迁移')
+    parser.add_argument('--no-backup', action='store_true', help='迁移前不备份数据库文件')
+    parser.add_argument('--check-plans', action='store_true', help='检查设备筛选查询是否用到了索引')
+    parser.add_argument('--backfill-energy', action='store_true', help='从命令日志补齐能耗读数（迁移之后执行）')
+    parser.add_argument('--rebuild-rollups', action='store_true', help='用能耗读数重新计算小时/天汇总表（迁移之后执行）')
+    args = parser.parse_args()
+
+    # 只用 smarthome_schema，不导入 api_oop_ten_jwt：导入应用会创建 SmartHomeHub 并加载全部设备，
+    # 旧版本或空数据库上还会因为表不存在报错
+    with sqlite3.connect(args.db) as conn:
+        current = schema.get_schema_version(conn)
+    target = schema.SCHEMA_VERSION if args.to is None else args.to
+    pending = [(version, description) for version, description, _ in schema.MIGRATIONS if current < version <= target]
+    print(f"数据库 {args.db}：当前版本 {current}，最新版本 {schema.SCHEMA_VERSION}")
+    for version, description in pending:
+        print(f"  待执行 {version}: {description}")
+    if args.check_plans:
+        failed = False
+        with sqlite3.connect(args.db) as conn:
+            results = schema.explain_device_queries(conn)
+        for filters, plan, uses_index in results:
+            failed = failed or not uses_index
+            print(f"  {'OK  ' if uses_index else '全表扫描'} {filters}: {plan}")
+        return 1 if failed else 0
+    if args.status:
+        return 0
+
+    if pending:
+        if not args.no_backup and os.path.exists(args.db):
+            backup_file = f'{args.db}.v{current}.bak'
+            shutil.copyfile(args.db, backup_file)
+            print(f"已备份到 {backup_file}")
+        try:
+            before, after = schema.migrate(args.db, target)
+        except sqlite3.Error as e:
+            print(f"迁移失败，已回滚： {e}")
+            return 1
+        print(f"已从版本 {before} 迁移到版本 {after}")
+    if args.backfill_energy:
+        try:
+            with sqlite3.connect(args.db) as conn:
+                inserted = schema.backfill_readings(conn)
+        except sqlite3.Error as e:
+            print(f"补齐能耗读数失败： {e}")
+            return 1
+        print(f"从命令日志补齐能耗读数 {inserted} 条")
+    if args.rebuild_rollups:
+        try:
+            with sqlite3.connect(args.db) as conn:
+                schema.rebuild_rollups(conn)
+        except sqlite3.Error as e:
+            print(f"重建汇总表失败： {e}")
+            return 1
+        print("已重建能耗汇总表")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
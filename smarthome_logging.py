@@ -0,0 +1,136 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime
+
+from flask import g, has_request_context
+
+# 当前正在运行的后台写日志线程，重新配置时先停掉旧的
+_listener = None
+
+
+# 结构化日志：每条记录输出成一行 JSON，附带请求 id 和请求已耗时
+class JsonFormatter(logging.Formatter):
+    extra_fields = ('request_id', 'latency_ms', 'method', 'path', 'status')
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in self.extra_fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+# 在请求线程里补充请求上下文，必须在日志进入队列之前执行，后台线程里已经拿不到 flask.g
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            if getattr(record, 'request_id', None) is None:
+                record.request_id = g.get('request_id')
+            started = g.get('request_started')
+            if started is not None and getattr(record, 'latency_ms', None) is None:
+                record.latency_ms = round((time.perf_counter() - started) * 1000, 3)
+        return True
+
+
+# 标准库的 QueueHandler.prepare 会先格式化再 copy 整条记录，这里只把消息和异常文本固定下来，减少请求线程上的开销
+class LightQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# 解析 "smarthome.db=WARNING,smarthome.scheduler=INFO" 这样的按模块日志级别配置
+def parse_module_levels(text):
+    levels = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# 配置日志：请求线程只把记录放进队列，由后台线程写文件，文件按大小或按时间轮转
+def setup_logging(filename='app.log', level=logging.ERROR, rotate='size', max_bytes=10 * 1024 * 1024,
+                  backup_count=5, when='midnight', json_format=True, module_levels=None):
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    if rotate == 'time':
+        file_handler = logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backup_count,
+                                                                 encoding='utf-8')
+    elif rotate == 'size':
+        file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                            encoding='utf-8')
+    else:
+        file_handler = logging.FileHandler(filename, encoding='utf-8')
+    if json_format:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LightQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    # 两种格式都不输出调用位置和进程信息，不让请求线程上的每条记录去回溯调用栈、查进程号
+    logging._srcfile = None
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+# 从环境变量读取日志配置，没有设置时和原来的 basicConfig 行为一致（ERROR 级别写 app.log）
+def setup_logging_from_env(filename='app.log', level=logging.ERROR):
+    return setup_logging(
+        filename=os.environ.get('SMARTHOME_LOG_FILE', filename),
+        level=os.environ.get('SMARTHOME_LOG_LEVEL', level),
+        rotate=os.environ.get('SMARTHOME_LOG_ROTATE', 'size'),
+        max_bytes=int(os.environ.get('SMARTHOME_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        backup_count=int(os.environ.get('SMARTHOME_LOG_BACKUPS', 5)),
+        when=os.environ.get('SMARTHOME_LOG_WHEN', 'midnight'),
+        json_format=os.environ.get('SMARTHOME_LOG_JSON', '1') != '0',
+        module_levels=parse_module_levels(os.environ.get('SMARTHOME_LOG_MODULES'))
+    )
+
+
+# 进程退出前把队列里剩下的日志写完
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,660 @@
+import csv
+import io
+import json
+import logging
+import sqlite3
+import time
+
+# 数据库结构和迁移，以及依赖这些表和索引的查询、导出导入；不依赖 Flask 应用，导入时不会连接数据库，
+# 迁移、导出和快照工具只导入这个模块，不会启动应用、加载设备
+db_logger = logging.getLogger('smarthome.db')
+
+
+# 数据库结构迁移：用 PRAGMA user_version 记录当前版本，按顺序执行还没执行过的迁移，每个迁移在一个事务里完成
+# 版本 1：最初的结构（设备主表 + 按类型拆分的属性表），以及变更日志和定时任务表
+def migration_1_initial_schema(c):
+    # 创建主设备表
+    c.execute('''CREATE TABLE IF NOT EXISTS devices(
+           device_id TEXT PRIMARY KEY, -- 设备id
+           name TEXT,  -- 设备名
+           status TEXT,  -- 设备状态
+           energy_usage REAL,  -- 设备能量消耗
+           device_type TEXT -- 设备类型
+        )''')
+    # 创建灯光属性表
+    c.execute('''CREATE TABLE IF NOT EXISTS light_attributes(
+           device_id TEXT PRIMARY KEY,
+           brightness INTEGER,
+           FOREIGN KEY (device_id) REFERENCES devices(device_id)
+        )''')
+    # 创建恒温器属性表
+    c.execute('''CREATE TABLE IF NOT EXISTS thermostat_attributes(
+           device_id TEXT PRIMARY KEY,
+           temperature INTEGER,
+           FOREIGN KEY (device_id) REFERENCES devices(device_id)
+        )''')
+    # 创建摄像头属性表
+    c.execute('''CREATE TABLE IF NOT EXISTS camera_attributes(
+           device_id TEXT PRIMARY KEY,
+           resolution TEXT,
+           FOREIGN KEY (device_id) REFERENCES devices(device_id)
+        )''')
+    # 创建用户表
+    c.execute('''CREATE TABLE IF NOT EXISTS users(
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           username TEXT UNIQUE,
+           password TEXT
+        )''')
+    # 创建变更日志表，每次写入都会追加一条，seq 单调递增，供其他进程增量同步
+    c.execute('''CREATE TABLE IF NOT EXISTS change_log(
+           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT,
+           op TEXT,  -- upsert 或 delete
+           changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''')
+    # 用触发器保证所有写入路径都会记录变更
+    for table in ('devices', 'light_attributes', 'thermostat_attributes', 'camera_attributes'):
+        for event in ('INSERT', 'UPDATE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_log
+                   AFTER {event} ON {table}
+                   BEGIN
+                       INSERT INTO change_log (device_id, op) VALUES (NEW.device_id, 'upsert');
+                   END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS devices_delete_log
+           AFTER DELETE ON devices
+           BEGIN
+               INSERT INTO change_log (device_id, op) VALUES (OLD.device_id, 'delete');
+           END''')
+    # 创建定时任务表
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduled_tasks(
+           task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT,
+           command TEXT,
+           run_at REAL,  -- 执行时间（Unix 时间戳）
+           status TEXT DEFAULT 'pending',  -- pending/done/failed/cancelled
+           created_at REAL,
+           executed_at REAL
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_status_run_at ON scheduled_tasks(status, run_at)')
+    # 创建周期任务表，next_fire 是预先算好的下次触发时间
+    c.execute('''CREATE TABLE IF NOT EXISTS recurring_schedules(
+           rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT,
+           command TEXT,
+           cron TEXT,  -- 分 时 日 月 周
+           next_fire REAL,
+           enabled INTEGER DEFAULT 1,
+           created_at REAL,
+           last_fired REAL
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_recurring_schedules_next_fire ON recurring_schedules(enabled, next_fire)')
+
+
+# 版本 2：把属性合并进 devices 表，一次按主键读取就能拿到设备和全部属性
+# 兼容两种旧结构：api_oop_ten_jwt.py 的拆分属性表，以及 api_oop_forth.py 已经带属性列的宽表
+def migration_2_unified_devices(c):
+    c.execute('PRAGMA table_info(devices)')
+    columns = {row[1] for row in c.fetchall()}
+    for column, column_type in (('brightness', 'INTEGER'), ('temperature', 'INTEGER'), ('resolution', 'TEXT')):
+        if column not in columns:
+            c.execute(f'ALTER TABLE devices ADD COLUMN {column} {column_type}')
+    for table, column, device_type in (('light_attributes', 'brightness', 'light'),
+                                       ('thermostat_attributes', 'temperature', 'thermostat'),
+                                       ('camera_attributes', 'resolution', 'camera')):
+        c.execute(f'''
+            UPDATE devices SET {column} = (SELECT a.{column} FROM {table} a WHERE a.device_id = devices.device_id)
+            WHERE device_type = ? AND EXISTS (SELECT 1 FROM {table} a WHERE a.device_id = devices.device_id)
+        ''', (device_type,))
+        # 删除表时它上面的触发器也会一起删除
+        c.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+# 版本 3：按类型/状态筛选、按能耗范围筛选和排序、按名称排序用到的索引
+def migration_3_device_indexes(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_type_status ON devices(device_type, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_energy_usage ON devices(energy_usage)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_name ON devices(name)')
+
+
+# 版本 4：定时任务和周期任务通过外键级联删除，devices 表增加软删除用的 deleted_at
+# SQLite 不能给已有的表加外键，只能新建表、复制数据再改名；迁移连接没有打开外键约束，重建过程中不会触发级联
+def migration_4_cascade_and_soft_delete(c):
+    c.execute('PRAGMA table_info(devices)')
+    if 'deleted_at' not in {row[1] for row in c.fetchall()}:
+        c.execute('ALTER TABLE devices ADD COLUMN deleted_at REAL')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_devices_deleted_at ON devices(deleted_at) WHERE deleted_at IS NOT NULL')
+
+    c.execute('''CREATE TABLE scheduled_tasks_new(
+           task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT REFERENCES devices(device_id) ON DELETE CASCADE,
+           command TEXT,
+           run_at REAL,  -- 执行时间（Unix 时间戳）
+           status TEXT DEFAULT 'pending',  -- pending/done/failed/cancelled
+           created_at REAL,
+           executed_at REAL
+        )''')
+    # 设备已经不存在的任务不再保留
+    c.execute('''
+        INSERT INTO scheduled_tasks_new (task_id, device_id, command, run_at, status, created_at, executed_at)
+        SELECT task_id, device_id, command, run_at, status, created_at, executed_at FROM scheduled_tasks
+        WHERE device_id IN (SELECT device_id FROM devices)
+    ''')
+    c.execute('DROP TABLE scheduled_tasks')
+    c.execute('ALTER TABLE scheduled_tasks_new RENAME TO scheduled_tasks')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_status_run_at ON scheduled_tasks(status, run_at)')
+    # 级联删除按子表的 device_id 查找，没有索引的话每删一个设备都要扫一遍子表
+    c.execute('CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_device_id ON scheduled_tasks(device_id)')
+
+    c.execute('''CREATE TABLE recurring_schedules_new(
+           rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT REFERENCES devices(device_id) ON DELETE CASCADE,
+           command TEXT,
+           cron TEXT,  -- 分 时 日 月 周
+           next_fire REAL,
+           enabled INTEGER DEFAULT 1,
+           created_at REAL,
+           last_fired REAL
+        )''')
+    c.execute('''
+        INSERT INTO recurring_schedules_new (rule_id, device_id, command, cron, next_fire, enabled, created_at, last_fired)
+        SELECT rule_id, device_id, command, cron, next_fire, enabled, created_at, last_fired FROM recurring_schedules
+        WHERE device_id IN (SELECT device_id FROM devices)
+    ''')
+    c.execute('DROP TABLE recurring_schedules')
+    c.execute('ALTER TABLE recurring_schedules_new RENAME TO recurring_schedules')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_recurring_schedules_next_fire ON recurring_schedules(enabled, next_fire)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_recurring_schedules_device_id ON recurring_schedules(device_id)')
+
+
+# 版本 5：命令日志和快照
+# command_log 按顺序记录每个改变设备的操作及操作后的状态，重放时直接设置状态，重复重放结果不变
+# snapshots 保存某个日志位置时全部设备的压缩快照
+def migration_5_command_log(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS command_log(
+           seq INTEGER PRIMARY KEY AUTOINCREMENT,
+           op TEXT,  -- add/attributes/command/reading/remove
+           device_id TEXT,
+           payload TEXT,  -- JSON：add/attributes 是整行，command 是 [状态, 能耗]，remove 为空
+           created_at REAL
+        )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS snapshots(
+           snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           log_seq INTEGER,  -- 快照包含的最后一条命令日志
+           change_seq INTEGER,  -- 同一时刻变更日志的位置
+           device_count INTEGER,
+           data BLOB,  -- zlib 压缩的 JSON 行列表
+           created_at REAL
+        )''')
+
+
+# 版本 6：能耗读数和按小时/按天、按设备/按类型汇总的表
+# 汇总表由 energy_readings 上的触发器增量维护，和读数写入在同一个事务里；bucket 是 UTC 整点/零点的 Unix 时间戳
+ENERGY_PERIODS = {'hour': 3600, 'day': 86400}
+ENERGY_ROLLUP_TABLES = {'device': ('energy_rollup_device', 'device_id'), 'type': ('energy_rollup_type', 'device_type')}
+
+
+# 汇总表的增量触发器；主键里的 NULL 互不冲突，没有类型的设备按 '' 汇总，否则每条读数都会多出一行
+def create_rollup_trigger(c):
+    upserts = []
+    for table, key in ENERGY_ROLLUP_TABLES.values():
+        for period, seconds in ENERGY_PERIODS.items():
+            upserts.append(f'''
+                   INSERT INTO {table} (period, {key}, bucket, kwh, readings)
+                   VALUES ('{period}', COALESCE(NEW.{key}, ''), CAST(NEW.recorded_at / {seconds} AS INTEGER) * {seconds}, NEW.kwh, 1)
+                   ON CONFLICT (period, {key}, bucket) DO UPDATE SET
+                   kwh = kwh + excluded.kwh, readings = readings + 1;''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS energy_readings_rollup
+           AFTER INSERT ON energy_readings
+           BEGIN{''.join(upserts)}
+           END''')
+
+
+def migration_6_energy_rollups(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS energy_readings(
+           reading_id INTEGER PRIMARY KEY AUTOINCREMENT,
+           device_id TEXT,
+           device_type TEXT,
+           recorded_at REAL,
+           kwh REAL,  -- 这次读数新增的能耗
+           source TEXT  -- command（开关）、reading（上报的读数）、backfill（从命令日志补齐）
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_energy_readings_recorded_at ON energy_readings(recorded_at)')
+    for table, key in ENERGY_ROLLUP_TABLES.values():
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table}(
+               period TEXT,  -- hour 或 day
+               {key} TEXT,
+               bucket INTEGER,
+               kwh REAL,
+               readings INTEGER,
+               PRIMARY KEY (period, {key}, bucket)
+            )''')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table}(period, bucket)')
+    create_rollup_trigger(c)
+
+
+# 异常检测按 (period, bucket) 扫描设备汇总表，覆盖索引带上 device_id 和 kwh 就不用回表；它包含原来的 (period, bucket) 索引
+def migration_7_energy_rollup_covering_index(c):
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_energy_rollup_device_covering
+           ON energy_rollup_device(period, bucket, device_id, kwh)''')
+    c.execute('DROP INDEX IF EXISTS idx_energy_rollup_device_bucket')
+
+
+# 幂等键和第一次的响应，status 为空表示还在处理；同一个键按用户区分
+def migration_8_idempotency_keys(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys(
+           username TEXT,
+           idempotency_key TEXT,
+           fingerprint TEXT,  -- 方法、路径和请求体的哈希，同一个键不能用于不同的请求
+           status INTEGER,
+           headers TEXT,
+           body BLOB,
+           created_at REAL,
+           PRIMARY KEY (username, idempotency_key)
+        )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)')
+
+
+# 版本 6 的触发器把空的 device_type 原样写进主键，同一个桶里每条读数都单独成行：换成按 '' 汇总的触发器，已有的重复行合并成一行
+def migration_9_energy_rollup_null_keys(c):
+    c.execute('DROP TRIGGER IF EXISTS energy_readings_rollup')
+    create_rollup_trigger(c)
+    for table, key in ENERGY_ROLLUP_TABLES.values():
+        c.execute(f'''
+            INSERT INTO {table} (period, {key}, bucket, kwh, readings)
+            SELECT period, '', bucket, SUM(kwh), SUM(readings) FROM {table}
+            WHERE {key} IS NULL GROUP BY period, bucket
+            ON CONFLICT (period, {key}, bucket) DO UPDATE SET
+            kwh = kwh + excluded.kwh, readings = readings + excluded.readings
+        ''')
+        c.execute(f'DELETE FROM {table} WHERE {key} IS NULL')
+
+
+MIGRATIONS = [
+    (1, '初始结构', migration_1_initial_schema),
+    (2, '设备属性合并到 devices 表', migration_2_unified_devices),
+    (3, '设备筛选和排序索引', migration_3_device_indexes),
+    (4, '外键级联删除和软删除', migration_4_cascade_and_soft_delete),
+    (5, '命令日志和快照', migration_5_command_log),
+    (6, '能耗读数和汇总表', migration_6_energy_rollups),
+    (7, '设备能耗汇总覆盖索引', migration_7_energy_rollup_covering_index),
+    (8, '幂等键', migration_8_idempotency_keys),
+    (9, '能耗汇总空类型合并', migration_9_energy_rollup_null_keys),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+# 把 path 指向的数据库迁移到 target 版本（默认最新），返回 (迁移前版本, 迁移后版本)
+def migrate(path, target=None):
+    target = SCHEMA_VERSION if target is None else target
+    conn = sqlite3.connect(path)
+    # 自己控制事务，DDL 和 user_version 一起提交或一起回滚
+    conn.isolation_level = None
+    try:
+        current = get_schema_version(conn)
+        start_version = current
+        for version, description, migration in MIGRATIONS:
+            if version <= current or version > target:
+                continue
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            # 多个进程同时启动时，拿到写锁之后再确认一次版本，别的进程已经执行过的迁移不再重复执行
+            if get_schema_version(conn) >= version:
+                c.execute('COMMIT')
+                current = version
+                continue
+            try:
+                migration(c)
+                c.execute(f'PRAGMA user_version = {version}')
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            db_logger.warning(f"数据库已迁移到版本 {version}：{description}")
+            current = version
+        return start_version, current
+    finally:
+        conn.close()
+
+
+# 设备和属性都在 devices 表里，一次查询就能拿到；软删除的设备不读出来，追加条件时用 AND
+DEVICE_ROW_SQL = '''
+    SELECT d.device_id, d.name, d.status, d.energy_usage, d.device_type,
+           d.brightness, d.temperature, d.resolution
+    FROM devices d
+    WHERE d.deleted_at IS NULL
+'''
+
+
+# GET /devices 支持的排序字段和对应的列
+DEVICE_ORDER_COLUMNS = {
+    'energy': 'energy_usage',
+    'name': 'name'
+}
+
+
+# 把筛选条件拼成参数化 SQL，排序列只能来自白名单
+def build_device_query(filters):
+    where, params = [], []
+    if 'type' in filters:
+        where.append('d.device_type = ?')
+        params.append(filters['type'])
+    if 'status' in filters:
+        where.append('d.status = ?')
+        params.append(filters['status'])
+    if 'min_energy' in filters:
+        where.append('d.energy_usage >= ?')
+        params.append(filters['min_energy'])
+    if 'max_energy' in filters:
+        where.append('d.energy_usage <= ?')
+        params.append(filters['max_energy'])
+    sql = DEVICE_ROW_SQL
+    if where:
+        sql += ' AND ' + ' AND '.join(where)
+    if 'order_by' in filters:
+        sql += f" ORDER BY d.{DEVICE_ORDER_COLUMNS[filters['order_by']]} {'DESC' if filters['desc'] else 'ASC'}"
+    if 'limit' in filters:
+        sql += ' LIMIT ?'
+        params.append(filters['limit'])
+    return sql, params
+
+
+# 支持的设备类型，和应用里的设备类一一对应
+DEVICE_TYPES = ('light', 'thermostat', 'camera')
+
+
+# 设备和属性在同一行，不属于该类型的属性列为空
+# 不能用 INSERT OR REPLACE：REPLACE 会先删除旧行，外键级联会把这个设备的定时任务一起删掉
+UPSERT_DEVICE_SQL = '''
+    INSERT INTO devices
+    (device_id, name, status, energy_usage, device_type, brightness, temperature, resolution)
+    VALUES (?,?,?,?,?,?,?,?)
+    ON CONFLICT(device_id) DO UPDATE SET
+    name = excluded.name, status = excluded.status, energy_usage = excluded.energy_usage,
+    device_type = excluded.device_type, brightness = excluded.brightness,
+    temperature = excluded.temperature, resolution = excluded.resolution, deleted_at = NULL
+'''
+
+
+# 数据库的一行转换成和 list_devices 一样的字典
+def device_row_to_dict(row):
+    device_id, name, status, energy_usage, device_type, brightness, temperature, resolution = row
+    device_dict = {
+        'device_id': device_id,
+        'name': name,
+        'status': status,
+        'energy_usage': energy_usage
+    }
+    if device_type == 'light':
+        device_dict['brightness'] = brightness
+    elif device_type == 'thermostat':
+        device_dict['temperature'] = temperature
+    elif device_type == 'camera':
+        device_dict['resolution'] = resolution
+    return device_dict
+
+
+# 导出的列，devices 和 DEVICE_ROW_SQL 的列顺序一致；energy 是每次开关或上报读数新增的能耗
+EXPORT_COLUMNS = {
+    'devices': ('device_id', 'name', 'status', 'energy_usage', 'device_type', 'brightness', 'temperature', 'resolution'),
+    'energy': ('reading_id', 'recorded_at', 'device_id', 'device_type', 'kwh', 'source')
+}
+EXPORT_SQL = {
+    'devices': DEVICE_ROW_SQL + ' AND d.device_id > ? ORDER BY d.device_id LIMIT ?',
+    'energy': '''
+        SELECT reading_id, recorded_at, device_id, device_type, kwh, source
+        FROM energy_readings WHERE reading_id > ? ORDER BY reading_id LIMIT ?
+    '''
+}
+
+
+# 按主键分页读出要导出的行，每页是一条独立的短查询并且读完整页，
+# 不会因为下载慢的客户端一直占着读锁挡住写入；内存里最多只有一页数据
+def iter_export_rows(conn, kind, batch_size=1000):
+    last = '' if kind == 'devices' else 0
+    c = conn.cursor()
+    while True:
+        c.execute(EXPORT_SQL[kind], (last, batch_size))
+        rows = c.fetchall()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0]
+
+
+# 把分页的行编码成 CSV 或 NDJSON 文本块，结束时把行数和耗时写到 stats 里；encode 把一行的字典编码成 JSON bytes
+def encode_export_chunks(kind, fmt, pages, stats=None, encode=None):
+    encode = encode or (lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    columns = EXPORT_COLUMNS[kind]
+    start = time.perf_counter()
+    total = 0
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+    for rows in pages:
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            yield buffer.getvalue()
+        else:
+            yield (b'\n'.join(encode(dict(zip(columns, row))) for row in rows) + b'\n').decode('utf-8')
+        total += len(rows)
+    if stats is not None:
+        stats.update(rows=total, seconds=time.perf_counter() - start)
+
+
+# 校验一条导入的设备记录（CSV 的值都是字符串），返回可以写入 devices 的行，不合法时抛出 ValueError
+def parse_device_record(record):
+    if not isinstance(record, dict):
+        raise ValueError('不是合法的 JSON 对象')
+
+    def value(key):
+        raw = record.get(key)
+        return None if raw == '' else raw
+
+    device_id = value('device_id')
+    if not isinstance(device_id, str) or not device_id:
+        raise ValueError('缺少 device_id')
+    device_type = value('device_type')
+    if device_type not in DEVICE_TYPES:
+        raise ValueError(f"不支持的设备类型{device_type}")
+    status = value('status') or 'off'
+    if status not in ('on', 'off'):
+        raise ValueError(f"不支持的设备状态{status}")
+    energy_usage = float(value('energy_usage') or 0)
+    if energy_usage < 0:
+        raise ValueError('energy_usage 不能小于 0')
+    brightness = temperature = resolution = None
+    if device_type == 'light':
+        brightness = int(value('brightness') if value('brightness') is not None else 100)
+        if not 0 <= brightness <= 100:
+            raise ValueError('brightness 必须是 0 到 100 的整数')
+    elif device_type == 'thermostat':
+        temperature = float(value('temperature') if value('temperature') is not None else 22)
+        if temperature.is_integer():
+            temperature = int(temperature)
+    else:
+        resolution = str(value('resolution') or '1080p')
+    name = value('name')
+    return (device_id, device_id if name is None else str(name), status, energy_usage, device_type,
+            brightness, temperature, resolution)
+
+
+# 流式导入设备：records 是 (行号, 字典) 的迭代器，每 chunk_size 行一个事务，不合法的行跳过并记下原因
+# 写数据库或读输入出错时停止导入：applied_through_line 之前（含）除 errors 以外的行都已经提交，
+# failed 是没有提交的那一批的行号范围和原因，之后的行都没有处理，修正后可以从 failed 的第一行重新导入
+def upsert_device_records(conn, records, chunk_size=1000, max_errors=100):
+    start = time.perf_counter()
+    imported = 0
+    errors = []
+    error_count = 0
+    applied_through_line = 0
+    failed = None
+
+    def flush(rows):
+        c = conn.cursor()
+        try:
+            c.executemany(UPSERT_DEVICE_SQL, rows)
+            now = time.time()
+            c.executemany('INSERT INTO command_log (op, device_id, payload, created_at) VALUES (?,?,?,?)',
+                          [('add', row[0], json.dumps(row, ensure_ascii=False), now) for row in rows])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    chunk = []
+    first_line = last_line = 0
+    try:
+        for line_no, record in records:
+            last_line = line_no
+            first_line = first_line or line_no
+            try:
+                chunk.append(parse_device_record(record))
+            except (TypeError, ValueError) as e:
+                error_count += 1
+                if len(errors) < max_errors:
+                    errors.append({'line': line_no, 'error': str(e)})
+                continue
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                imported += len(chunk)
+                applied_through_line, chunk, first_line = line_no, [], 0
+        if chunk:
+            flush(chunk)
+            imported += len(chunk)
+        applied_through_line = last_line
+    except (sqlite3.Error, UnicodeDecodeError, csv.Error) as e:
+        first_line = first_line or applied_through_line + 1
+        # 读输入出错时不知道出错的那一批到哪一行结束
+        failed = {'first_line': first_line, 'last_line': last_line if last_line >= first_line else None, 'error': str(e)}
+    elapsed = time.perf_counter() - start
+    return {
+        'imported': imported,
+        'rejected': error_count,
+        'errors': errors,
+        'completed': failed is None,
+        'applied_through_line': applied_through_line,
+        'failed': failed,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(imported / elapsed) if elapsed > 0 else imported
+    }
+
+
+# 把文本流解析成 (行号, 字典)，CSV 第一行是表头，NDJSON 每行一个对象，空行跳过；decode 解析一行 JSON
+def iter_import_records(text_stream, fmt, decode=json.loads):
+    if fmt == 'csv':
+        reader = csv.DictReader(text_stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_no, line in enumerate(text_stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, decode(line)
+        except ValueError:
+            yield line_no, None
+
+
+# 生成二进制快照用的设备行，和命令日志、变更日志的位置在同一个读事务里取，返回 (行, 命令日志位置, 变更日志位置)
+def snapshot_rows(conn):
+    c = conn.cursor()
+    c.execute('BEGIN')
+    try:
+        c.execute('SELECT COALESCE(MAX(seq), 0) FROM command_log')
+        log_seq = c.fetchone()[0]
+        c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+        change_seq = c.fetchone()[0]
+        c.execute(DEVICE_ROW_SQL)
+        rows = c.fetchall()
+    finally:
+        conn.commit()
+    return rows, log_seq, change_seq
+
+
+# 用 EXPLAIN QUERY PLAN 检查常用的筛选和排序是否都用上了索引，返回 (参数, 执行计划, 是否用到索引)
+def explain_device_queries(conn):
+    cases = [
+        {'type': 'light'},
+        {'type': 'camera', 'status': 'on'},
+        {'min_energy': 1.0},
+        {'min_energy': 1.0, 'max_energy': 5.0},
+        {'order_by': 'energy', 'desc': True, 'limit': 10},
+        {'order_by': 'name', 'desc': False},
+        {'type': 'light', 'status': 'off', 'order_by': 'energy', 'desc': True},
+    ]
+    results = []
+    c = conn.cursor()
+    for filters in cases:
+        sql, params = build_device_query(filters)
+        c.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = '; '.join(row[-1] for row in c.fetchall())
+        results.append((filters, plan, 'USING INDEX' in plan or 'USING COVERING INDEX' in plan))
+    return results
+
+
+# 用 energy_readings 重新计算全部汇总表，在一个事务里完成
+def rebuild_rollups(conn):
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    for table, key_column in ENERGY_ROLLUP_TABLES.values():
+        c.execute(f'DELETE FROM {table}')
+        for period, seconds in ENERGY_PERIODS.items():
+            c.execute(f'''
+                INSERT INTO {table} (period, {key_column}, bucket, kwh, readings)
+                SELECT ?, COALESCE({key_column}, ''), CAST(recorded_at / {seconds} AS INTEGER) * {seconds}, SUM(kwh), COUNT(*)
+                FROM energy_readings GROUP BY COALESCE({key_column}, ''), CAST(recorded_at / {seconds} AS INTEGER)
+            ''', (period,))
+    conn.commit()
+
+
+# 从命令日志补齐 energy_readings 出现之前的能耗：同一设备相邻两次记录的能耗差就是这段时间新增的能耗
+# 上报的读数本来就有记录，只补命令；第一条命令读数之后的命令已经有读数了
+# 可以重复执行：补过的命令（不晚于已有的最后一条 backfill 读数）会跳过，不会重复计入汇总表
+def backfill_readings(conn, batch_size=1000):
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.execute("SELECT MIN(recorded_at) FROM energy_readings WHERE source = 'command'")
+    first_reading = c.fetchone()[0]
+    c.execute("SELECT MAX(recorded_at) FROM energy_readings WHERE source = 'backfill'")
+    last_backfilled = c.fetchone()[0]
+    reader = conn.cursor()
+    reader.execute('SELECT op, device_id, payload, created_at FROM command_log ORDER BY seq')
+    last_energy, device_types, batch = {}, {}, []
+    while True:
+        rows = reader.fetchmany(batch_size)
+        if not rows:
+            break
+        for op, device_id, payload, created_at in rows:
+            if op == 'remove':
+                last_energy.pop(device_id, None)
+                continue
+            payload = json.loads(payload)
+            if op in ('add', 'attributes'):
+                device_types[device_id] = payload[4]
+                last_energy[device_id] = payload[3]
+                continue
+            energy_usage = payload[1]
+            previous = last_energy.get(device_id)
+            last_energy[device_id] = energy_usage
+            if op != 'command' or previous is None or energy_usage <= previous:
+                continue
+            if first_reading is not None and created_at >= first_reading:
+                continue
+            if last_backfilled is not None and created_at <= last_backfilled:
+                continue
+            batch.append((device_id, device_types.get(device_id), created_at, energy_usage - previous, 'backfill'))
+    for i in range(0, len(batch), batch_size):
+        c.executemany('''
+            INSERT INTO energy_readings (device_id, device_type, recorded_at, kwh, source) VALUES (?,?,?,?,?)
+        ''', batch[i:i + batch_size])
+    conn.commit()
+    return len(batch)
@@ -0,0 +1,172 @@
+import math
+import mmap
+import os
+import struct
+import time
+
+# 二进制设备快照：文件头 + 定长设备记录 + 字符串表，所有整数都是小端
+# 记录按设备 id 的 UTF-8 字节排序，可以直接在 mmap 上二分查找，不用先建索引
+# 多个 worker 用 mmap 打开同一个文件时共享同一份物理内存页
+MAGIC = b'SHSNAP01'
+FORMAT_VERSION = 1
+# 魔数、格式版本、设备数、命令日志位置、变更日志位置、记录区偏移、字符串表偏移、生成时间
+HEADER = struct.Struct('<8sIIQQQQd')
+# id 偏移/长度、名称偏移/长度、类型、状态、数值属性（亮度/温度，NaN 表示空）、字符串属性（分辨率）偏移/长度、能耗
+RECORD = struct.Struct('<IHIHBBdIHd')
+DEVICE_TYPES = ('light', 'thermostat', 'camera')
+STATUSES = ('off', 'on')
+# 字符串为空时的偏移
+NO_STRING = 0xFFFFFFFF
+
+
+# rows 的列顺序和 DEVICE_ROW_SQL 一致，不认识的设备类型跳过；先写临时文件再改名，正在读旧文件的进程不受影响
+def write_snapshot(path, rows, log_seq=0, change_seq=0):
+    rows = sorted((row for row in rows if row[4] in DEVICE_TYPES), key=lambda row: row[0].encode('utf-8'))
+    records = bytearray(RECORD.size * len(rows))
+    strings = bytearray()
+
+    def add_string(value):
+        if value is None:
+            return NO_STRING, 0
+        data = str(value).encode('utf-8')
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    for index, row in enumerate(rows):
+        device_id, name, status, energy_usage, device_type, brightness, temperature, resolution = row
+        id_offset, id_length = add_string(device_id)
+        name_offset, name_length = add_string(name)
+        number = brightness if device_type == 'light' else temperature if device_type == 'thermostat' else None
+        text_offset, text_length = add_string(resolution if device_type == 'camera' else None)
+        RECORD.pack_into(records, index * RECORD.size, id_offset, id_length, name_offset, name_length,
+                         DEVICE_TYPES.index(device_type), 1 if status == 'on' else 0,
+                         math.nan if number is None else float(number), text_offset, text_length,
+                         float(energy_usage or 0.0))
+
+    records_offset = HEADER.size
+    strings_offset = records_offset + len(records)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(rows), log_seq, change_seq, records_offset, strings_offset,
+                            time.time()))
+        f.write(records)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+# 只读打开快照，按需解码记录，不把整个文件读进内存
+class SnapshotReader:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"快照文件 {path} 是空文件")
+        self._view = memoryview(self._mmap)
+        if len(self._view) < HEADER.size:
+            self.close()
+            raise ValueError(f"快照文件 {path} 不完整")
+        (magic, version, self.count, self.log_seq, self.change_seq, self._records_offset, self._strings_offset,
+         self.created_at) = HEADER.unpack_from(self._view)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"{path} 不是支持的快照文件")
+        if self._strings_offset != self._records_offset + self.count * RECORD.size or self._strings_offset > len(self._view):
+            self.close()
+            raise ValueError(f"快照文件 {path} 不完整")
+
+    def close(self):
+        # 先释放 memoryview，mmap 才能关闭
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._view = None
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 遍历到一半的 rows() 被丢弃时，它的记录切片可能比读快照晚释放；切片释放后 mmap 对象自己解除映射
+                pass
+            self._file.close()
+
+    # 没有显式关闭时，最后一个引用消失就关闭：被新快照替换后，正在遍历旧读快照的请求结束时释放 mmap
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, offset, length):
+        if offset == NO_STRING:
+            return None
+        start = self._strings_offset + offset
+        # 直接切 mmap 得到 bytes 再解码，比先切 memoryview 快
+        return self._mmap[start:start + length].decode('utf-8')
+
+    def _row(self, record):
+        id_offset, id_length, name_offset, name_length, type_code, status, number, text_offset, text_length, energy = record
+        device_type = DEVICE_TYPES[type_code]
+        if math.isnan(number):
+            number = None
+        elif device_type == 'light' or number.is_integer():
+            number = int(number)
+        return (self._string(id_offset, id_length), self._string(name_offset, name_length), STATUSES[status], energy,
+                device_type,
+                number if device_type == 'light' else None,
+                number if device_type == 'thermostat' else None,
+                self._string(text_offset, text_length))
+
+    # 第 index 条记录，列顺序和 DEVICE_ROW_SQL 一致
+    def row(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self._row(RECORD.unpack_from(self._view, self._records_offset + index * RECORD.size))
+
+    # 第 start 到 stop 条记录，比逐条调用 row() 快
+    def rows(self, start=0, stop=None):
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return
+        records = self._view[self._records_offset + start * RECORD.size:self._records_offset + stop * RECORD.size]
+        for record in RECORD.iter_unpack(records):
+            yield self._row(record)
+
+    def __iter__(self):
+        return self.rows()
+
+    def _id_bytes(self, index):
+        id_offset, id_length = struct.unpack_from('<IH', self._view, self._records_offset + index * RECORD.size)
+        start = self._strings_offset + id_offset
+        return self._mmap[start:start + id_length]
+
+    # 按设备 id 二分查找记录下标，找不到返回 None
+    def index_of(self, device_id):
+        key = device_id.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._id_bytes(lo) == key:
+            return lo
+        return None
+
+    # 按设备 id 查找记录，找不到返回 None
+    def find(self, device_id):
+        index = self.index_of(device_id)
+        return None if index is None else self.row(index)
+
+    # 只读能耗字段，不解码字符串
+    def total_energy_usage(self):
+        return sum(record[-1] for record in RECORD.iter_unpack(self._view[self._records_offset:self._strings_offset]))
@@ -0,0 +1,99 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from datetime import datetime
+
+import smarthome_schema as schema
+from smarthome_snapshot import SnapshotReader, write_snapshot
+
+
+def cmd_write(args):
+    start = time.perf_counter()
+    try:
+        with closing(sqlite3.connect(args.db)) as conn:
+            rows, log_seq, change_seq = schema.snapshot_rows(conn)
+    except sqlite3.Error as e:
+        print(f"读取数据库失败： {e}")
+        return 1
+    count = write_snapshot(args.out, rows, log_seq, change_seq)
+    print(f"已写入 {args.out}：{count} 个设备，{os.path.getsize(args.out)} 字节，"
+          f"耗时 {time.perf_counter() - start:.3f} 秒")
+    return 0
+
+
+def cmd_info(args):
+    with SnapshotReader(args.snapshot) as reader:
+        print(f"文件 {args.snapshot}：{os.path.getsize(args.snapshot)} 字节")
+        print(f"  设备数 {len(reader)}")
+        print(f"  命令日志位置 {reader.log_seq}，变更日志位置 {reader.change_seq}")
+        print(f"  生成时间 {datetime.fromtimestamp(reader.created_at).isoformat(timespec='seconds')}")
+        print(f"  总能耗 {reader.total_energy_usage():.2f}kWh")
+    return 0
+
+
+def cmd_get(args):
+    with SnapshotReader(args.snapshot) as reader:
+        row = reader.find(args.device_id)
+    if row is None:
+        print(f"设备{args.device_id}不存在")
+        return 1
+    print(schema.device_row_to_dict(row))
+    return 0
+
+
+# 比较从快照文件和从数据库读出全部设备的耗时；只计读数据本身，不创建设备对象，不导入应用
+def cmd_bench(args):
+    def timed(label, fn):
+        start = time.perf_counter()
+        result = fn()
+        print(f"  {label:<28} {time.perf_counter() - start:8.3f} 秒  {result}")
+
+    def open_snapshot():
+        with SnapshotReader(args.snapshot) as reader:
+            return f"{len(reader)} 个设备"
+
+    def scan_snapshot():
+        with SnapshotReader(args.snapshot) as reader:
+            return f"总能耗 {reader.total_energy_usage():.2f}"
+
+    def decode_snapshot():
+        with SnapshotReader(args.snapshot) as reader:
+            return f"{sum(1 for _ in reader.rows())} 个设备"
+
+    def read_database():
+        with closing(sqlite3.connect(args.db)) as conn:
+            return f"{len(conn.execute(schema.DEVICE_ROW_SQL).fetchall())} 个设备"
+
+    print(f"数据库 {args.db}，快照 {args.snapshot}")
+    timed('打开快照 (mmap)', open_snapshot)
+    timed('扫描快照能耗', scan_snapshot)
+    timed('解码快照全部记录', decode_snapshot)
+    timed('从数据库读全部设备', read_database)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='智能家居二进制设备快照工具')
+    parser.add_argument('--db', default=os.environ.get('SMARTHOME_DB', 'xjy_smarthome.db'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    write_parser = subparsers.add_parser('write', help='从数据库生成快照文件')
+    write_parser.add_argument('--out', default='devices.snap')
+    info_parser = subparsers.add_parser('info', help='显示快照文件信息')
+    info_parser.add_argument('snapshot')
+    get_parser = subparsers.add_parser('get', help='在快照里查找一个设备')
+    get_parser.add_argument('snapshot')
+    get_parser.add_argument('device_id')
+    bench_parser = subparsers.add_parser('bench', help='比较从快照和从数据库读出全部设备的耗时')
+    bench_parser.add_argument('snapshot')
+    args = parser.parse_args()
+
+    # 只用 smarthome_schema、smarthome_snapshot 和 sqlite 连接，不导入 api_oop_ten_jwt：导入应用会创建 SmartHomeHub 并加载全部设备
+    commands = {'write': cmd_write, 'info': cmd_info, 'get': cmd_get, 'bench': cmd_bench}
+    return commands[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
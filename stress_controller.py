@@ -0,0 +1,130 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+# 压力测试用临时数据库，必须在导入 api_oop_ten_jwt 之前设置
+tmp_dir = tempfile.mkdtemp(prefix='smarthome_stress_')
+os.environ['SMARTHOME_DB'] = os.path.join(tmp_dir, 'stress.db')
+
+import api_oop_ten_jwt as api
+
+
+# 统计每个线程真正改变了设备状态的次数，最后合并，用来核对有没有丢失更新
+thread_counts = threading.local()
+original_turn_on = api.Device.turn_on
+original_turn_off = api.Device.turn_off
+
+
+def counted_turn_on(self):
+    changed = original_turn_on(self)
+    if changed:
+        thread_counts.counter[(self.get_id(), 'on')] += 1
+    return changed
+
+
+def counted_turn_off(self):
+    changed = original_turn_off(self)
+    if changed:
+        thread_counts.counter[(self.get_id(), 'off')] += 1
+    return changed
+
+
+api.Device.turn_on = counted_turn_on
+api.Device.turn_off = counted_turn_off
+
+
+# 创建测试设备
+def build_controller(device_count, stripes):
+    api.init_db()
+    with api.get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM devices')
+        conn.commit()
+    for i in range(device_count):
+        api.insert_or_replace_device(f'S{i}', f'压测灯{i}', 'off', 0.0, 'light', brightness=100)
+    controller = api.DeviceController(stripes=stripes)
+    controller.load_devices_database()
+    return controller
+
+
+def run_round(controller, threads, ops_per_thread, device_count):
+    results = []
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed):
+        thread_counts.counter = Counter()
+        rnd = random.Random(seed)
+        barrier.wait()
+        for _ in range(ops_per_thread):
+            device_id = f'S{rnd.randrange(device_count)}'
+            controller.execute_command(device_id, rnd.choice(('on', 'off')))
+        results.append(thread_counts.counter)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = Counter()
+    for counter in results:
+        total.update(counter)
+    return elapsed, total
+
+
+# 能耗必须等于所有真实状态变化的增量之和，开关次数之差必须和最终状态一致
+def check_lost_updates(controller, counts):
+    errors = []
+    for device_id, device in controller.devices.items():
+        ons = counts[(device_id, 'on')]
+        offs = counts[(device_id, 'off')]
+        expected = 0.1 * ons + 0.02 * offs
+        if abs(device.get_energy_usage() - expected) > 1e-6:
+            errors.append(f"{device_id}: 能耗 {device.get_energy_usage():.4f} != 期望 {expected:.4f}")
+        if ons - offs != (1 if device.get_status() == 'on' else 0):
+            errors.append(f"{device_id}: 开 {ons} 次 关 {offs} 次，但状态是 {device.get_status()}")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DeviceController 多线程压力测试')
+    parser.add_argument('--devices', type=int, default=64)
+    parser.add_argument('--ops', type=int, default=2000, help='每个线程执行的命令数')
+    parser.add_argument('--threads', default='1,2,4,8')
+    parser.add_argument('--stripes', type=int, default=64, help='分段锁数量，1 相当于全局锁')
+    parser.add_argument('--io-latency', type=float, default=0.0005,
+                        help='模拟每次写设备/数据库的耗时（秒），0 表示真实写 SQLite')
+    args = parser.parse_args()
+
+    if args.io_latency > 0:
+        # 用 sleep 模拟设备 I/O，排除 SQLite 单写者对吞吐的影响，只看锁的效果
+        api.Device.update_db = lambda self, *args_, **kwargs: time.sleep(args.io_latency)
+
+    failed = False
+    baseline = None
+    for threads in [int(x) for x in args.threads.split(',')]:
+        controller = build_controller(args.devices, args.stripes)
+        elapsed, counts = run_round(controller, threads, args.ops, args.devices)
+        ops = threads * args.ops
+        throughput = ops / elapsed
+        baseline = baseline or throughput
+        errors = check_lost_updates(controller, counts)
+        failed = failed or bool(errors)
+        print(f"threads={threads:<3} stripes={args.stripes:<3} ops={ops:<7} "
+              f"{throughput:10.0f} ops/s  x{throughput / baseline:.2f}  "
+              f"{'OK' if not errors else f'丢失更新 {len(errors)} 个设备'}")
+        for error in errors[:5]:
+            print('    ' + error)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+# WSGI 入口，例如：SMARTHOME_DB=/data/smarthome.db gunicorn -w 4 -b 127.0.0.1:5000 wsgi:app
+# 每个 worker 进程导入本模块时先把数据库迁移到最新版本（新部署时会建好所有表），再启动自己的后台任务
+# （定时任务在数据库里认领，多个进程同时运行也只执行一次）；
+# 不要加 --preload，否则后台线程只在 master 进程里启动，fork 出来的 worker 里没有
+import os
+
+import smarthome_schema
+
+# 迁移要在导入应用之前执行：导入时会创建 SmartHomeHub 并从数据库加载设备
+smarthome_schema.migrate(os.environ.get('SMARTHOME_DB', 'xjy_smarthome.db'))
+
+from api_oop_ten_jwt import app, start_background_workers
+
+start_background_workers()